@@ -1,23 +1,27 @@
 # app.py  — Amazon FIFO: Inventory & Costing Portal
 # -----------------------------------------------
-# Tabs:
+# Pages (sidebar navigation; only the selected page runs):
 #   1) Inbound & Costs   : Batch+Costs (single grid), Duty Pools (by Category), Inbound Items
-#   2) Sales Upload      : Upload Amazon monthly CSV -> sales_raw
-#   3) Inventory         : View lot_balance
-#   4) Summary           : Run month, view month_summary
+#   2) Sales Upload      : Upload Amazon monthly CSVs (or a zip, one per marketplace) -> sales_raw
+#   3) Inventory         : lot_balance (paged, filtered) or on-hand as of a date (ledger.py)
+#   4) Summary           : Queue month runs / snapshots (SQL or in-process FIFO engine), job status, month_summary,
+#                          drill-down by marketplace / category / SKU / batch (rollup.py),
+#                          what-if COGS for changed freight / duty (whatif.py)
 #   5) Mapping           : Maintain SKU Map / Kit BOM / Products
 #
 # All labels are professional English. The "Batch header" and "Freight/Clearance" are merged
 # into ONE grid as you requested. No weight column. No "duty override". Duty is by category pool.
+# Inventory, Inbound Items and the Mapping grids load one filtered, sorted page at a time (grids.py).
 
 import os
 import io
 import json
-import urllib.parse as _url
+import time
+import functools
 import pandas as pd
 import streamlit as st
 
-# ---- DB helpers (psycopg v3) ----
+# ---- DB helpers (psycopg v3, pooled — see db.py) ----
 try:
     import psycopg
 except Exception:
@@ -27,90 +31,115 @@ except Exception:
     )
     st.stop()
 
+import fifo
+import grids
+import landed
+import ledger
+from loader import import_sales_files, import_sales_stream, infer_marketplace
+import whatif
+import worker
+import perf
+import rollup
+from db import (
+    connection, pipeline, fetch_df, merge, delete_keys, cache_stats, cache_clear, invalidate,
+)
 
-def _normalize_dsn(dsn: str) -> str:
-    """
-    Make Supabase DSN safe for psycopg3:
-      - remove unsupported URI query params (e.g. prepare_threshold)
-      - ensure sslmode=require exists
-    Works for both URI and key/value DSN.
-    """
-    dsn = dsn.strip()
-
-    # Key/value style (host=... port=... dbname=...):
-    if "://" not in dsn and "host=" in dsn:
-        # ensure sslmode=require
-        if "sslmode=" not in dsn:
-            dsn += " sslmode=require"
-        # remove prepare_threshold if present
-        parts = dsn.split()
-        parts = [p for p in parts if not p.startswith("prepare_threshold=")]
-        return " ".join(parts)
-
-    # URI style
-    if "://" in dsn:
-        parsed = _url.urlsplit(dsn)
-        q = _url.parse_qs(parsed.query, keep_blank_values=True)
 
-        # drop unsupported params
-        q.pop("prepare_threshold", None)
+# ---------- UI helpers ----------
+st.set_page_config(page_title="Amazon FIFO — Inventory & Costing", layout="wide")
+st.title("Amazon FIFO — Inventory & Costing")
+_run_started = time.perf_counter()
 
-        # ensure sslmode=require
-        if "sslmode" not in q:
-            q["sslmode"] = ["require"]
 
-        new_query = _url.urlencode(q, doseq=True)
-        dsn = _url.urlunsplit((parsed.scheme, parsed.netloc, parsed.path, new_query, parsed.fragment))
-        return dsn
+def fragment(fn=None, *, run_every=None):
+    """st.fragment that records how long its last (re)run took, for the debug panel."""
+    if fn is None:
+        return functools.partial(fragment, run_every=run_every)
 
-    return dsn
+    @st.fragment(run_every=run_every)
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            st.session_state.setdefault("rerun_ms", {})[fn.__name__] = round((time.perf_counter() - t) * 1000, 1)
+    return run
 
 
-@st.cache_resource(show_spinner=False)
-def get_conn():
+def editor_changes(key: str, original: pd.DataFrame, key_cols: list[str]) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Prefer a single DSN via secrets:
-      st.secrets["DB_DSN"]  # Supabase 'Transaction pooler' or 'Direct' string
-    Fallback to env var DB_DSN.
+    Rows to upsert and keys to delete, taken from st.data_editor's change set
+    (session_state[key]: edited_rows / added_rows / deleted_rows) instead of the whole grid.
+    Editing a key column counts as delete(old key) + upsert(new row).
     """
-    dsn = st.secrets.get("DB_DSN") or os.environ.get("DB_DSN")
-    if not dsn:
-        st.error(
-            "Missing DB_DSN. Please paste your Supabase connection string into "
-            "Streamlit → Settings → Secrets as DB_DSN."
-        )
-        st.stop()
-
-    safe_dsn = _normalize_dsn(dsn)
-    # Critical: disable prepared statements in code to work with pooler
-    return psycopg.connect(safe_dsn, autocommit=True, prepare_threshold=None)
-
-
-def fetch_df(sql: str, params: tuple | None = None) -> pd.DataFrame:
-    with get_conn().cursor() as cur:
-        cur.execute(sql, params or ())
-        cols = [d[0] for d in cur.description] if cur.description else []
-        rows = cur.fetchall() if cur.description else []
-    return pd.DataFrame(rows, columns=cols)
-
-
-def exec_sql(sql: str, params: tuple | None = None):
-    with get_conn().cursor() as cur:
-        cur.execute(sql, params or ())
-
-
-def exec_many(sql: str, rows: list[tuple]):
-    if not rows:
+    state = st.session_state.get(key) or {}
+    records, deleted = [], []
+    for pos, changes in state.get("edited_rows", {}).items():
+        old = original.iloc[int(pos)].to_dict()
+        new = {**old, **changes}
+        records.append(new)
+        if any(new[k] != old[k] for k in key_cols):
+            deleted.append({k: old[k] for k in key_cols})
+    records += [{c: r.get(c) for c in original.columns} for r in state.get("added_rows", [])]
+    deleted += original.iloc[[int(p) for p in state.get("deleted_rows", [])]][key_cols].to_dict("records")
+
+    upserts = pd.DataFrame(records, columns=original.columns).dropna(subset=key_cols)
+    deletes = pd.DataFrame(deleted, columns=key_cols).drop_duplicates()
+    if not deletes.empty and not upserts.empty:  # deleted then re-added under the same key
+        deletes = deletes.merge(upserts[key_cols], how="left", indicator=True)
+        deletes = deletes[deletes.pop("_merge") == "left_only"]
+    return upserts.reset_index(drop=True), deletes.reset_index(drop=True)
+
+
+def paged(key: str, grid: str, filters: dict) -> tuple[pd.DataFrame, str]:
+    """
+    One server-side page of `grid` (grids.page) with sort and prev/next controls.
+    Returns the page and the data_editor key for it: the key changes with the page,
+    so editor_changes() always diffs against the rows actually shown.
+    """
+    spec = grids.GRIDS[grid]
+    c1, c2, c3 = st.columns([2, 1, 1])
+    sort = c1.selectbox("Sort by", spec["sorts"], key=f"{key}_sort")
+    desc = c2.toggle("Descending", key=f"{key}_desc")
+    limit = c3.selectbox("Rows", [100, 200, 500, 1000], index=1, key=f"{key}_limit")
+
+    # Stack of cursors: [None (first page), after page 1, after page 2, ...]; reset when the query changes.
+    state = st.session_state.setdefault(f"{key}_pager", {"sig": None, "stack": [None]})
+    sig = repr((sorted(filters.items()), sort, desc, limit))
+    if state["sig"] != sig:
+        state.update(sig=sig, stack=[None])
+    df, nxt = grids.page(grid, filters, sort, desc, state["stack"][-1], limit)
+
+    p1, p2, p3 = st.columns([1, 3, 1])
+    p1.button("◀ Prev", key=f"{key}_prev", disabled=len(state["stack"]) == 1,
+              on_click=state["stack"].pop, use_container_width=True)
+    p2.caption(f"Page {len(state['stack'])} · {len(df):,} rows" + ("" if nxt else " · last page")
+               + " — save before changing page; unsaved edits are dropped.")
+    p3.button("Next ▶", key=f"{key}_next", disabled=nxt is None,
+              on_click=state["stack"].append, args=(nxt,), use_container_width=True)
+    return df, f"{key}:{abs(hash(sig))}:{len(state['stack'])}"
+
+
+def report_saved(label: str, upserts: pd.DataFrame, deletes: pd.DataFrame, key_cols: list[str],
+                 merged: dict | None = None):
+    """Confirm a diff save (with db.merge's counts and throughput) and list the keys it touched."""
+    if upserts.empty and deletes.empty:
+        st.info(f"{label}: no changes to save.")
         return
-    with get_conn().cursor() as cur:
-        cur.executemany(sql, rows)
-
-
-# ---------- UI helpers ----------
-st.set_page_config(page_title="Amazon FIFO — Inventory & Costing", layout="wide")
-st.title("Amazon FIFO — Inventory & Costing")
-
-TABS = st.tabs(["Inbound & Costs", "Sales Upload", "Inventory", "Summary", "Mapping"])
+    if merged and merged["rows"]:
+        st.success(
+            f"{label} saved: {merged['inserted']} inserted, {merged['updated']} updated, "
+            f"{merged['unchanged']} unchanged, {len(deletes)} deleted "
+            f"({merged['seconds'] * 1000:.0f} ms, {merged['rows_per_s']:,} rows/s)."
+        )
+    else:
+        st.success(f"{label} saved: {len(upserts)} upserted, {len(deletes)} deleted.")
+    with st.expander("Changed keys"):
+        st.dataframe(
+            pd.concat([upserts[key_cols].assign(change="upsert"), deletes.assign(change="delete")]),
+            use_container_width=True, hide_index=True,
+        )
 
 
 # ========== 1) Inbound & Costs ==========
@@ -118,133 +147,152 @@ def page_inbound():
     st.subheader("Batch & Cost (single grid) / Duty Pools (by Category)")
 
     left, right = st.columns([2, 2])
-
-    # -------- A. Batch + Costs (single grid) --------
     with left:
-        st.markdown("**Batch & Cost (merged)**")
-        batch_cols = [
-            "batch_id", "arrived_at", "dest_market", "note",
-            "freight_total", "clearance_total"
-        ]
-        # Load current data (merge batch + batch_cost)
-        df_batch = fetch_df("""
-            select b.batch_id,
-                   b.arrived_at,
-                   b.dest_market,
-                   b.note,
-                   coalesce(c.freight_total, 0)  as freight_total,
-                   coalesce(c.clearance_total,0) as clearance_total
-            from batch b
-            left join batch_cost c on c.batch_id = b.batch_id
-            order by b.arrived_at nulls last, b.batch_id
-        """)
-        if df_batch.empty:
-            df_batch = pd.DataFrame(columns=batch_cols)
-
-        df_batch = df_batch.reindex(columns=batch_cols)
-
-        edited_batch = st.data_editor(
-            df_batch,
-            num_rows="dynamic",
-            use_container_width=True,
-            column_config={
-                "batch_id": st.column_config.TextColumn("Batch ID", required=True),
-                "arrived_at": st.column_config.DateColumn("Arrived At"),
-                "dest_market": st.column_config.TextColumn("Destination Market", help="e.g. US / EU"),
-                "note": st.column_config.TextColumn("Note"),
-                "freight_total": st.column_config.NumberColumn("Freight Total"),
-                "clearance_total": st.column_config.NumberColumn("Clearance Total")
-            },
-            key="grid_batch"
-        )
+        grid_batch()
+    with right:
+        grid_duty()
 
-        if st.button("Save Batch & Costs", type="primary", use_container_width=True):
-            # Upsert into batch + batch_cost
-            rows = []
-            cost_rows = []
-            for _, r in edited_batch.fillna("").iterrows():
-                rows.append((
-                    r["batch_id"], r["arrived_at"] if r["arrived_at"] != "" else None,
-                    r["dest_market"], r["note"]
-                ))
-                cost_rows.append((
-                    r["batch_id"],
-                    float(r["freight_total"] or 0),
-                    float(r["clearance_total"] or 0)
-                ))
+    st.markdown("---")
+    grid_inbound()
+
+
+# -------- A. Batch + Costs (single grid) --------
+@fragment
+def grid_batch():
+    st.markdown("**Batch & Cost (merged)**")
+    batch_cols = [
+        "batch_id", "arrived_at", "dest_market", "note",
+        "freight_total", "clearance_total"
+    ]
+    # Load current data (merge batch + batch_cost)
+    df_batch = fetch_df("""
+        select b.batch_id,
+               b.arrived_at,
+               b.dest_market,
+               b.note,
+               coalesce(c.freight_total, 0)  as freight_total,
+               coalesce(c.clearance_total,0) as clearance_total
+        from batch b
+        left join batch_cost c on c.batch_id = b.batch_id
+        order by b.arrived_at nulls last, b.batch_id
+    """)
+    if df_batch.empty:
+        df_batch = pd.DataFrame(columns=batch_cols)
 
-            exec_many("""
-                insert into batch(batch_id, arrived_at, dest_market, note)
-                values (%s, %s, %s, %s)
-                on conflict(batch_id) do update set
-                  arrived_at = excluded.arrived_at,
-                  dest_market = excluded.dest_market,
-                  note = excluded.note
-            """, rows)
-
-            exec_many("""
-                insert into batch_cost(batch_id, freight_total, clearance_total)
-                values (%s, %s, %s)
-                on conflict(batch_id) do update set
-                  freight_total = excluded.freight_total,
-                  clearance_total = excluded.clearance_total
-            """, cost_rows)
-
-            st.success("Batch & Costs saved.")
-
-    # -------- B. Duty Pools (by Category) --------
-    with right:
-        st.markdown("**Duty Pools (by Category)**")
-        duty_cols = ["batch_id", "category", "duty_total"]
-        df_duty = fetch_df("""
-            select batch_id, category, duty_total
-            from duty_pool
-            order by batch_id, category
-        """)
-        if df_duty.empty:
-            df_duty = pd.DataFrame(columns=duty_cols)
-        df_duty = df_duty.reindex(columns=duty_cols)
-
-        edited_duty = st.data_editor(
-            df_duty,
-            num_rows="dynamic",
-            use_container_width=True,
-            column_config={
-                "batch_id": st.column_config.TextColumn("Batch ID", required=True),
-                "category": st.column_config.TextColumn("Category", required=True),
-                "duty_total": st.column_config.NumberColumn("Duty Total")
-            },
-            key="grid_duty"
-        )
+    df_batch = df_batch.reindex(columns=batch_cols)
 
-        if st.button("Save Duty Pools", use_container_width=True):
-            duty_rows = []
-            for _, r in edited_duty.fillna("").iterrows():
-                duty_rows.append((
-                    r["batch_id"], r["category"], float(r["duty_total"] or 0)
-                ))
-            exec_many("""
-                insert into duty_pool(batch_id, category, duty_total)
-                values (%s, %s, %s)
-                on conflict(batch_id, category) do update set
-                  duty_total = excluded.duty_total
-            """, duty_rows)
-            st.success("Duty pools saved.")
+    st.data_editor(
+        df_batch,
+        num_rows="dynamic",
+        use_container_width=True,
+        column_config={
+            "batch_id": st.column_config.TextColumn("Batch ID", required=True),
+            "arrived_at": st.column_config.DateColumn("Arrived At"),
+            "dest_market": st.column_config.TextColumn("Destination Market", help="e.g. US / EU"),
+            "note": st.column_config.TextColumn("Note"),
+            "freight_total": st.column_config.NumberColumn("Freight Total"),
+            "clearance_total": st.column_config.NumberColumn("Clearance Total")
+        },
+        key="grid_batch"
+    )
 
-    st.markdown("---")
+    if st.button("Save Batch & Costs", type="primary", use_container_width=True):
+        # Upsert only changed rows into batch + batch_cost; delete removed batches
+        key_cols = ["batch_id"]
+        upserts, deletes = editor_changes("grid_batch", df_batch, key_cols)
+        batch_ids = pd.concat([upserts["batch_id"], deletes["batch_id"]]).astype(str).tolist()
+        rows = []
+        cost_rows = []
+        for _, r in upserts.fillna("").iterrows():
+            rows.append((
+                r["batch_id"], r["arrived_at"] if r["arrived_at"] != "" else None,
+                r["dest_market"], r["note"]
+            ))
+            cost_rows.append((
+                r["batch_id"],
+                float(r["freight_total"] or 0),
+                float(r["clearance_total"] or 0)
+            ))
+
+        with pipeline() as conn:
+            fifo.mark_dirty_batches(conn, batch_ids)  # old arrival dates
+            del_keys = list(deletes.itertuples(index=False, name=None))
+            # A deleted batch takes its lots with it: items, and their balances so FIFO stops using them.
+            delete_keys("lot_balance", key_cols, del_keys, conn=conn)
+            delete_keys("inbound_items", key_cols, del_keys, conn=conn)
+            delete_keys("batch_cost", key_cols, del_keys, conn=conn)
+            delete_keys("batch", key_cols, del_keys, conn=conn)
+            merged = merge("batch", pd.DataFrame(rows, columns=["batch_id", "arrived_at", "dest_market", "note"]),
+                           key_cols, conn=conn)
+            merge("batch_cost", pd.DataFrame(cost_rows, columns=["batch_id", "freight_total", "clearance_total"]),
+                  key_cols, conn=conn)
+            fifo.mark_dirty_batches(conn, upserts["batch_id"].astype(str).tolist())  # new arrival dates
+            landed.mark_batches(conn, batch_ids)
+        with connection() as conn:
+            ledger.refresh_inbound(conn, batch_ids)
+
+        report_saved("Batch & Costs", upserts, deletes, key_cols, merged)
+
+
+# -------- B. Duty Pools (by Category) --------
+@fragment
+def grid_duty():
+    st.markdown("**Duty Pools (by Category)**")
+    duty_cols = ["batch_id", "category", "duty_total"]
+    df_duty = fetch_df("""
+        select batch_id, category, duty_total
+        from duty_pool
+        order by batch_id, category
+    """)
+    if df_duty.empty:
+        df_duty = pd.DataFrame(columns=duty_cols)
+    df_duty = df_duty.reindex(columns=duty_cols)
 
+    st.data_editor(
+        df_duty,
+        num_rows="dynamic",
+        use_container_width=True,
+        column_config={
+            "batch_id": st.column_config.TextColumn("Batch ID", required=True),
+            "category": st.column_config.TextColumn("Category", required=True),
+            "duty_total": st.column_config.NumberColumn("Duty Total")
+        },
+        key="grid_duty"
+    )
+
+    if st.button("Save Duty Pools", use_container_width=True):
+        key_cols = ["batch_id", "category"]
+        upserts, deletes = editor_changes("grid_duty", df_duty, key_cols)
+        duty_rows = []
+        for _, r in upserts.fillna("").iterrows():
+            duty_rows.append((
+                r["batch_id"], r["category"], float(r["duty_total"] or 0)
+            ))
+        with pipeline() as conn:
+            delete_keys("duty_pool", key_cols, list(deletes.itertuples(index=False, name=None)), conn=conn)
+            merged = merge("duty_pool", pd.DataFrame(duty_rows, columns=duty_cols), key_cols, conn=conn)
+            landed.mark_batches(conn, pd.concat([upserts["batch_id"], deletes["batch_id"]]))
+        report_saved("Duty pools", upserts, deletes, key_cols, merged)
+
+
+# -------- C. Inbound Items --------
+@fragment
+def grid_inbound():
     # -------- C. Inbound Items --------
     st.markdown("**Inbound Items**")
     in_cols = ["batch_id", "internal_sku", "category", "qty_in", "fob_unit", "cbm_per_unit"]
-    df_in = fetch_df("""
-        select batch_id, internal_sku, category, qty_in, fob_unit, cbm_per_unit
-        from inbound_items order by batch_id, internal_sku
-    """)
+    f1, f2, f3 = st.columns(3)
+    filters = {
+        "sku": f1.text_input("Internal SKU starts with", key="in_f_sku").strip(),
+        "batch": f2.text_input("Batch ID", key="in_f_batch").strip(),
+        "category": f3.text_input("Category", key="in_f_cat").strip(),
+    }
+    df_in, editor_key = paged("grid_inbound", "inbound_items", filters)
     if df_in.empty:
         df_in = pd.DataFrame(columns=in_cols)
     df_in = df_in.reindex(columns=in_cols)
 
-    edited_in = st.data_editor(
+    st.data_editor(
         df_in,
         num_rows="dynamic",
         use_container_width=True,
@@ -256,192 +304,436 @@ def page_inbound():
             "fob_unit": st.column_config.NumberColumn("FOB per Unit"),
             "cbm_per_unit": st.column_config.NumberColumn("CBM per Unit"),
         },
-        key="grid_inbound"
+        key=editor_key
     )
 
     colA, colB = st.columns(2)
     with colA:
         if st.button("Save Inbound Items", type="primary", use_container_width=True):
+            key_cols = ["batch_id", "internal_sku"]
+            upserts, deletes = editor_changes(editor_key, df_in, key_cols)
             rows = []
-            for _, r in edited_in.fillna("").iterrows():
+            for _, r in upserts.fillna("").iterrows():
                 rows.append((
                     r["batch_id"], r["internal_sku"], r["category"],
                     int(r["qty_in"] or 0),
                     float(r["fob_unit"] or 0.0),
                     float(r["cbm_per_unit"] or 0.0),
                 ))
-            exec_many("""
-                insert into inbound_items(batch_id, internal_sku, category, qty_in, fob_unit, cbm_per_unit)
-                values (%s, %s, %s, %s, %s, %s)
-                on conflict(batch_id, internal_sku) do update set
-                  category = excluded.category,
-                  qty_in = excluded.qty_in,
-                  fob_unit = excluded.fob_unit,
-                  cbm_per_unit = excluded.cbm_per_unit
-            """, rows)
-            st.success("Inbound items saved.")
+            del_keys = list(deletes.itertuples(index=False, name=None))
+            with pipeline() as conn:
+                delete_keys("inbound_items", key_cols, del_keys, conn=conn)
+                delete_keys("lot_balance", key_cols, del_keys, conn=conn)  # FIFO stops using deleted lots now
+                merged = merge("inbound_items", pd.DataFrame(rows, columns=in_cols), key_cols, conn=conn)
+                fifo.mark_dirty_inbound(conn, [(r[0], r[1]) for r in rows] + del_keys)
+                landed.mark_batches(conn, [r[0] for r in rows] + [k[0] for k in del_keys])
+            with connection() as conn:
+                ledger.refresh_inbound(conn, [r[0] for r in rows] + [k[0] for k in del_keys])
+            report_saved("Inbound items", upserts, deletes, key_cols, merged)
 
     with colB:
+        full = st.checkbox("Full rebuild (replay all history)", value=False,
+                           help="Default replays only changed SKUs from the nearest snapshot. Costs are rebuilt "
+                                "in full unless LANDED_INCREMENTAL=1 (then only batches edited since the last "
+                                "rebuild are repriced; check first with `python cli.py reconcile-costs`).")
         if st.button("Rebuild Costs & Inventory", use_container_width=True):
-            exec_sql("select rebuild_lot_costs();")
-            exec_sql("select rebuild_lot_balance();")
-            st.success("Costs and lot balance rebuilt.")
+            job_id = worker.enqueue("rebuild", full=full)
+            st.success(f"Rebuild queued as job #{job_id} — follow it in the Summary page.")
 
 
 # ========== 2) Sales Upload ==========
 def page_sales_upload():
     st.subheader("Upload Monthly Sales CSV (Amazon export) → sales_raw")
     ym = st.text_input("Year-Month (YYYY-MM)", value="")
-    file = st.file_uploader("Upload Amazon monthly CSV", type=["csv"])
+    files = st.file_uploader(
+        "Upload Amazon monthly CSVs (one per marketplace) or a zip of them", type=["csv", "zip"],
+        accept_multiple_files=True,
+        help="Files without a marketplace column take it from the file name (amazon.de_…, …_UK_…).",
+    )
 
-    if st.button("Import to sales_raw", type="primary", disabled=not (file and ym)):
-        try:
-            raw = pd.read_csv(file)
-        except Exception:
-            raw = pd.read_csv(file, encoding="utf-8", engine="python")
-
-        cols = raw.columns.str.lower()
-        raw.columns = cols
-
-        def pick(*names, default=None):
-            for n in names:
-                if n in raw.columns:
-                    return raw[n]
-            return default
-
-        df = pd.DataFrame({
-            "ym": ym,
-            "date_time": pick("date/time", "date_time", "purchase-date"),
-            "marketplace": pick("marketplace", "marketplace-domain", default="amazon.com"),
-            "order_id": pick("order id", "order-id", "order_id"),
-            "amazon_sku": pick("sku", "seller-sku", "asin", "amazon_sku"),
-            "qty": pd.to_numeric(pick("quantity", "quantity-purchased", "qty", default=0), errors="coerce").fillna(0).astype(int)
-        })
-
-        df = df.dropna(subset=["date_time", "order_id", "amazon_sku"])
-        rows = [tuple(x) for x in df[["ym","date_time","marketplace","order_id","amazon_sku","qty"]].values.tolist()]
-        exec_many("""
-            insert into sales_raw(ym, date_time, marketplace, order_id, amazon_sku, qty)
-            values (%s, %s, %s, %s, %s, %s)
-        """, rows)
-        st.success(f"Imported {len(rows)} rows into sales_raw.")
+    if st.button("Import to sales_raw", type="primary", disabled=not (files and ym)):
+        if len(files) == 1 and not files[0].name.lower().endswith(".zip"):
+            marketplace = infer_marketplace(files[0].name)
+            st.caption(f"Marketplace from the file name: {marketplace}" if marketplace else
+                       "No marketplace in the file name: the file's marketplace column is used, else amazon.com.")
+            bar = st.progress(0.0, text="Importing…")
+            n = import_sales_stream(
+                files[0], ym, marketplace,
+                on_progress=lambda frac, rows: bar.progress(frac, text=f"Importing… {rows:,} rows"),
+            )
+            bar.progress(1.0, text=f"Imported {n:,} rows")
+            reports = None
+        else:
+            t = time.perf_counter()
+            bar = st.progress(0.0, text="Parsing and loading…")
+            done = []
+
+            def on_file(r):
+                done.append(r)  # a zip counts as one upload but reports each CSV inside
+                bar.progress(min(len(done) / len(files), 1.0), text=f"{len(done)} file(s) done — {r['file']}")
+
+            reports = import_sales_files([(f.name, f.getvalue()) for f in files], ym, on_file=on_file)
+            bar.progress(1.0, text=f"{len(reports)} file(s) in {time.perf_counter() - t:.1f}s")
+            n = sum(r["rows"] for r in reports if r["status"] == "ok")
+        with connection() as conn:
+            fifo.mark_dirty_sales(conn, ym)
+        st.success(f"Imported {n} rows into sales_raw.")
+        if reports:
+            report = pd.DataFrame(reports)[["file", "marketplace", "marketplace_source", "status", "rows", "parse_s", "load_s", "error"]]
+            failed = report["status"].eq("failed").sum()
+            if failed:
+                st.error(f"{failed} file(s) failed and were not loaded; the others were (one transaction per file).")
+            st.dataframe(report.round({"parse_s": 2, "load_s": 2}), use_container_width=True, hide_index=True)
 
 
 # ========== 3) Inventory ==========
 def page_inventory():
-    st.subheader("Current Inventory (lot_balance)")
-    df = fetch_df("""
-        select internal_sku, batch_id, qty_remaining
-        from lot_balance
-        order by internal_sku, batch_id
-    """)
+    c1, c2 = st.columns([1, 2])
+    as_of = c1.date_input("As of", value=None, help="Empty: current lot_balance. A date: on-hand at the end "
+                                                     "of that day, from the movement ledger.")
+
+    if as_of is None:
+        st.subheader("Current Inventory (lot_balance)")
+        f1, f2, f3 = st.columns([2, 2, 1])
+        filters = {
+            "sku": f1.text_input("Internal SKU starts with", key="inv_f_sku").strip(),
+            "batch": f2.text_input("Batch ID", key="inv_f_batch").strip(),
+            "nonzero": f3.toggle("Hide zero balances", key="inv_f_nonzero"),
+        }
+        df, _ = paged("inv_grid", "lot_balance", filters)
+        st.dataframe(df, use_container_width=True, hide_index=True)
+        return
+
+    sku_text = c2.text_input("Internal SKUs (comma-separated, optional)", value="")
+    skus = [s.strip() for s in sku_text.split(",") if s.strip()] or None
+
+    st.subheader(f"Inventory as of {as_of:%Y-%m-%d}")
+    t = time.perf_counter()
+    with connection() as conn:
+        df = ledger.inventory_as_of(as_of, skus, conn=conn)
+    st.caption(f"{len(df):,} lots · {(time.perf_counter() - t) * 1000:.0f} ms "
+               "(nearest month checkpoint + ledger replay; Python-engine allocations only)")
     st.dataframe(df, use_container_width=True)
 
 
 # ========== 4) Summary ==========
 def page_summary():
     st.subheader("Run Month & View Summary")
-    ym = st.text_input("Year-Month (YYYY-MM)", value="")
+    m1, m2 = st.columns(2)
+    ym = m1.text_input("Year-Month (YYYY-MM)", value="")
+    end_ym = m2.text_input(
+        "Through (YYYY-MM, optional)", value="",
+        help="Backfill every month from Year-Month through this one in a single job. "
+             "The Python engine loads the opening stock once and carries it from month to month.",
+    ).strip() or None
+    engine = st.radio(
+        "FIFO engine", ["SQL (run_month)", "Python (in-process)", "Reconcile (dry run)"],
+        horizontal=True,
+        help="Reconcile runs both engines on the same data in a rolled-back transaction and shows the differences."
+    )
+    workers = 1
+    if engine.startswith("Python"):
+        workers = st.number_input(
+            "Parallel SKU shards (processes)", min_value=1, max_value=os.cpu_count() or 1,
+            value=fifo.default_workers(), help="FIFO is split by SKU hash and run on a process pool."
+        )
+    if ym:
+        missing = fifo.unmapped(yms=ym)
+        if not missing.empty:
+            st.warning(
+                f"{len(missing)} Amazon SKUs sold in {ym} have no mapping "
+                f"({int(missing['qty'].sum()):,} units will be left out) — see the Mapping page."
+            )
     c1, c2 = st.columns([1,2])
     with c1:
         if st.button("Run Month (map → costs → FIFO → summarize)", type="primary", disabled=not ym):
-            exec_sql("select run_month(%s);", (ym,))
-            st.success(f"Month {ym} processed.")
+            if engine.startswith("Reconcile") and end_ym:
+                st.error("Reconcile compares a single month; clear “Through”.")
+            elif engine.startswith("Reconcile"):
+                try:
+                    with connection() as conn:
+                        rec = fifo.reconcile(conn, ym)
+                except ValueError as e:
+                    st.error(str(e))
+                    st.stop()
+                (st.success if rec["ok"] else st.error)(
+                    "Python engine matches run_month." if rec["ok"] else "Python engine differs from run_month."
+                )
+                st.dataframe(rec["summary"], use_container_width=True)
+                if not rec["balances"].empty:
+                    st.markdown("**Lot balance mismatches**")
+                    st.dataframe(rec["balances"], use_container_width=True)
+            else:
+                if engine.startswith("Python"):
+                    job_id = worker.enqueue("run_month", ym, engine="python", workers=int(workers), end_ym=end_ym)
+                else:
+                    job_id = worker.enqueue("run_month", ym, engine="sql", end_ym=end_ym)
+                st.success(f"{ym}{'..' + end_ym if end_ym else ''} queued as job #{job_id}.")
     with c2:
         if st.button("Snapshot Month (inventory & summary)", disabled=not ym):
-            exec_sql("select snapshot_month(%s);", (ym,))
-            st.info(f"Snapshot for {ym} created in month_history.")
+            job_id = worker.enqueue("snapshot", ym)
+            st.info(f"Snapshot for {ym} queued as job #{job_id}.")
+
+    job_status()
 
     st.markdown("**month_summary**")
     df = fetch_df("select ym, orders, units, cogs, updated_at from month_summary order by ym desc limit 24;")
     st.dataframe(df, use_container_width=True)
 
+    with st.expander("Breakdown: month × marketplace × category × SKU × batch", expanded=True):
+        rollup_panel(df["ym"].tolist())
+
+    with st.expander("What-if: landed cost / COGS"):
+        whatif_panel(df["ym"].tolist())
+
+    with st.expander("Performance: stage durations per month"):
+        perf_panel()
+
+
+@fragment
+def rollup_panel(months):
+    """Drill-down over sales_rollup (rollup.py): grouped in SQL, never scans fifo_alloc."""
+    if not months:
+        st.caption("No months in month_summary yet.")
+        return
+    dims = st.multiselect("Group by", rollup.DIMS, default=["ym", "marketplace"], key="rollup_dims")
+    f1, f2, f3, f4, f5 = st.columns(5)
+    newest_first = sorted(months, reverse=True)
+    filters = {
+        "from_ym": f1.selectbox("From", newest_first, index=min(11, len(months) - 1), key="rollup_from"),
+        "to_ym": f2.selectbox("Through", newest_first, key="rollup_to"),
+        "marketplace": f3.text_input("Marketplace", key="rollup_mkt").strip(),
+        "category": f4.text_input("Category", key="rollup_cat").strip(),
+        "sku": f5.text_input("Internal SKU starts with", key="rollup_sku").strip(),
+    }
+    t = time.perf_counter()
+    df = rollup.drill(dims, filters)
+    st.caption(f"{len(df):,} rows · {(time.perf_counter() - t) * 1000:.0f} ms · largest COGS first (500 max). "
+               "orders_max counts an order once per cell it spans; month_summary.orders is exact.")
+    gaps = rollup.uncovered([m for m in months if filters["from_ym"] <= m <= filters["to_ym"]])
+    if not gaps.empty:
+        st.warning("Not in the breakdown (run by the SQL engine, which keeps no allocations — re-run with the "
+                   "Python engine to include them): "
+                   + ", ".join(f"{r.ym} ({r.reason})" for r in gaps.itertuples()))
+    if len(dims) == 1 and not df.empty:
+        st.bar_chart(df.set_index(dims[0])["cogs"])
+    st.dataframe(df, use_container_width=True, hide_index=True)
+
+
+@fragment
+def whatif_panel(months):
+    """Scenario COGS for one month, computed in memory (whatif.py); nothing is written."""
+    if not months:
+        st.caption("No months in month_summary yet.")
+        return
+    c1, c2 = st.columns([2, 1])
+    ym = c1.selectbox("Month", months, key="whatif_ym")
+    model = st.session_state.get("whatif_model")
+    if c2.button("Reload costs & allocations") or model is None or model["ym"] != ym:
+        try:
+            with connection() as conn:
+                model = st.session_state["whatif_model"] = whatif.load_model(ym, conn=conn)
+        except ValueError as e:
+            st.session_state.pop("whatif_model", None)
+            st.warning(str(e))
+            return
+
+    st.caption("Percent changes to the cost pools; blank Batch ID / Category = all. Freight and clearance "
+               "are split per batch by CBM, duty per batch and category by FOB value.")
+    overrides = st.data_editor(
+        pd.DataFrame([{"pool": "freight", "batch_id": "", "category": "", "pct": 0.0}]),
+        num_rows="dynamic", use_container_width=True, hide_index=True, key="whatif_overrides",
+        column_config={
+            "pool": st.column_config.SelectboxColumn("Pool", options=list(whatif.POOLS), required=True),
+            "batch_id": st.column_config.TextColumn("Batch ID"),
+            "category": st.column_config.TextColumn("Category"),
+            "pct": st.column_config.NumberColumn("Change %", step=1.0, format="%.1f"),
+        },
+    )
+    try:
+        result = whatif.simulate(model, overrides.dropna(subset=["pool"]).to_dict("records"))
+    except ValueError as e:
+        st.error(str(e))
+        return
+    st.caption(f"{len(model['lots']):,} consumed lots · loaded in {model['load_seconds'] * 1000:.0f} ms · "
+               f"scenario in {result['seconds'] * 1000:.1f} ms")
+    unmatched = [o for o in result["overrides"] if o["lots"] == 0]
+    if unmatched:
+        st.warning("No consumed lot matches: " + "; ".join(f"{o['pool']} {o['batch_id']}/{o['category']}"
+                                                          for o in unmatched))
+    st.dataframe(whatif.compare(model, result), use_container_width=True, hide_index=True)
+    st.markdown("**Lots with the largest COGS change**")
+    st.dataframe(whatif.lot_changes(model, result, top=200), use_container_width=True, hide_index=True)
+
+
+def perf_panel():
+    """Charts run_log (written by the worker when PERF_LOG is on) so regressions show up as data grows."""
+    stages = perf.stage_history()
+    if stages.empty:
+        st.caption("No instrumented runs yet (run_log is written by the worker unless PERF_LOG=0).")
+        return
+    stages = stages[stages["ym"].notna()]
+    kinds = sorted(stages["kind"].unique())
+    kind = st.selectbox("Job kind", kinds, index=kinds.index("run_month") if "run_month" in kinds else 0)
+    sel = stages[stages["kind"] == kind]
+    # Latest run per month: one bar group per month, one series per stage.
+    latest = sel.sort_values("started_at").groupby("ym")["run_id"].last()
+    sel = sel[sel["run_id"].isin(latest)]
+    st.bar_chart(sel.pivot_table(index="ym", columns="stage", values="seconds", aggfunc="sum"), y_label="seconds")
+    st.dataframe(
+        sel.pivot_table(index="ym", columns="stage", values="rows", aggfunc="sum"),
+        use_container_width=True,
+    )
+
+    runs = perf.runs(50)
+    st.markdown("**Runs**")
+    st.dataframe(runs, use_container_width=True, hide_index=True)
+    run_id = st.selectbox("Query breakdown for run", runs["run_id"].tolist())
+    if run_id:
+        st.dataframe(perf.query_breakdown(run_id), use_container_width=True, hide_index=True)
+
+
+@fragment(run_every=2)
+def job_status():
+    """Background jobs (run by `python worker.py`), polled every 2 seconds."""
+    st.markdown("**Jobs**")
+    jobs = worker.list_jobs()
+    if jobs.empty:
+        st.caption("No jobs yet. Start the worker with `python worker.py`.")
+        return
+    # The worker writes from another process: when a job finishes, drop cached reads and refresh the page.
+    finished = set(jobs.loc[jobs["status"].isin(["done", "failed"]), "id"])
+    seen = st.session_state.setdefault("jobs_finished", finished)
+    if finished - seen:
+        st.session_state["jobs_finished"] = finished
+        invalidate()
+        st.rerun()
+    running = jobs[jobs["status"].isin(["queued", "running"])]
+    for _, j in running.iterrows():
+        st.progress(
+            float(j["pct"] or 0) / 100,
+            text=f"#{j['id']} {j['kind']} {j['ym'] or ''} — {j['status']}" + (f" · {j['stage']}" if j["stage"] else ""),
+        )
+    st.dataframe(
+        jobs[["id", "kind", "ym", "status", "stage", "pct", "seconds", "stages", "error", "created_at"]],
+        use_container_width=True, hide_index=True,
+    )
+
 
 # ========== 5) Mapping ==========
 def page_mapping():
     st.subheader("SKU Map / Kit BOM / Products")
 
     c1, c2 = st.columns(2)
-
-    # SKU Map
     with c1:
-        st.markdown("**SKU Map (Amazon → Internal)**")
-        df = fetch_df("""
-          select amazon_sku, marketplace, internal_sku, unit_multiplier, active
-          from sku_map order by amazon_sku
-        """)
-        if df.empty:
-            df = pd.DataFrame(columns=["amazon_sku","marketplace","internal_sku","unit_multiplier","active"])
-        edit = st.data_editor(
-            df, num_rows="dynamic", use_container_width=True,
-            column_config={
-                "amazon_sku": st.column_config.TextColumn("Amazon SKU", required=True),
-                "marketplace": st.column_config.TextColumn("Marketplace", required=True),
-                "internal_sku": st.column_config.TextColumn("Internal SKU", required=True),
-                "unit_multiplier": st.column_config.NumberColumn("Unit Multiplier"),
-                "active": st.column_config.CheckboxColumn("Active")
-            },
-            key="map_grid"
-        )
-        if st.button("Save SKU Map", use_container_width=True):
-            rows = []
-            for _, r in edit.fillna({"unit_multiplier":1,"active":True}).iterrows():
-                rows.append((
-                    r["amazon_sku"], r["marketplace"], r["internal_sku"],
-                    int(r["unit_multiplier"] or 1), bool(r["active"])
-                ))
-            exec_many("""
-                insert into sku_map(amazon_sku, marketplace, internal_sku, unit_multiplier, active)
-                values(%s,%s,%s,%s,%s)
-                on conflict(amazon_sku, marketplace) do update set
-                  internal_sku = excluded.internal_sku,
-                  unit_multiplier = excluded.unit_multiplier,
-                  active = excluded.active
-            """, rows)
-            st.success("SKU Map saved.")
-
-    # Kit BOM
+        grid_sku_map()
     with c2:
-        st.markdown("**Kit BOM (for bundles)**")
-        df = fetch_df("""
-          select amazon_sku, marketplace, component_sku, component_qty
-          from kit_bom order by amazon_sku, component_sku
-        """)
-        if df.empty:
-            df = pd.DataFrame(columns=["amazon_sku","marketplace","component_sku","component_qty"])
-        edit = st.data_editor(
-            df, num_rows="dynamic", use_container_width=True,
-            column_config={
-                "amazon_sku": st.column_config.TextColumn("Amazon SKU", required=True),
-                "marketplace": st.column_config.TextColumn("Marketplace", required=True),
-                "component_sku": st.column_config.TextColumn("Component SKU", required=True),
-                "component_qty": st.column_config.NumberColumn("Component Qty", required=True),
-            },
-            key="bom_grid"
-        )
-        if st.button("Save Kit BOM", use_container_width=True):
-            rows = []
-            for _, r in edit.fillna({"component_qty":1}).iterrows():
-                rows.append((
-                    r["amazon_sku"], r["marketplace"], r["component_sku"], int(r["component_qty"] or 1)
-                ))
-            exec_many("""
-                insert into kit_bom(amazon_sku, marketplace, component_sku, component_qty)
-                values(%s,%s,%s,%s)
-                on conflict(amazon_sku, marketplace, component_sku) do update set
-                  component_qty = excluded.component_qty
-            """, rows)
-            st.success("Kit BOM saved.")
+        grid_kit_bom()
 
     st.markdown("---")
+    grid_products()
+
+    missing = fifo.unmapped()
+    with st.expander(f"Unmapped Amazon SKUs ({len(missing)})", expanded=not missing.empty):
+        st.caption("Sold SKUs with no SKU Map / Kit BOM entry; FIFO leaves their sales out.")
+        st.dataframe(missing, use_container_width=True, hide_index=True)
+
+
+# SKU Map
+@fragment
+def grid_sku_map():
+    st.markdown("**SKU Map (Amazon → Internal)**")
+    f1, f2, f3 = st.columns(3)
+    filters = {
+        "sku": f1.text_input("Amazon SKU starts with", key="map_f_sku").strip(),
+        "marketplace": f2.text_input("Marketplace", key="map_f_mkt").strip(),
+        "internal_sku": f3.text_input("Internal SKU starts with", key="map_f_int").strip(),
+    }
+    df, editor_key = paged("map_grid", "sku_map", filters)
+    if df.empty:
+        df = pd.DataFrame(columns=["amazon_sku","marketplace","internal_sku","unit_multiplier","active"])
+    st.data_editor(
+        df, num_rows="dynamic", use_container_width=True,
+        column_config={
+            "amazon_sku": st.column_config.TextColumn("Amazon SKU", required=True),
+            "marketplace": st.column_config.TextColumn("Marketplace", required=True),
+            "internal_sku": st.column_config.TextColumn("Internal SKU", required=True),
+            "unit_multiplier": st.column_config.NumberColumn("Unit Multiplier"),
+            "active": st.column_config.CheckboxColumn("Active")
+        },
+        key=editor_key
+    )
+    if st.button("Save SKU Map", use_container_width=True):
+        key_cols = ["amazon_sku", "marketplace"]
+        upserts, deletes = editor_changes(editor_key, df, key_cols)
+        keys = list(pd.concat([upserts[key_cols], deletes]).drop_duplicates().itertuples(index=False, name=None))
+        rows = []
+        for _, r in upserts.fillna({"unit_multiplier":1,"active":True}).iterrows():
+            rows.append((
+                r["amazon_sku"], r["marketplace"], r["internal_sku"],
+                int(r["unit_multiplier"] or 1), bool(r["active"])
+            ))
+        with pipeline() as conn:
+            delete_keys("sku_map", key_cols, list(deletes.itertuples(index=False, name=None)), conn=conn)
+            merged = merge("sku_map", pd.DataFrame(rows, columns=list(df.columns)), key_cols, conn=conn)
+            fifo.mapping_changed(conn, keys)  # re-resolve + mark old and new targets dirty
+        report_saved("SKU Map", upserts, deletes, key_cols, merged)
+
+
+# Kit BOM
+@fragment
+def grid_kit_bom():
+    st.markdown("**Kit BOM (for bundles)**")
+    f1, f2, f3 = st.columns(3)
+    filters = {
+        "sku": f1.text_input("Amazon SKU starts with", key="bom_f_sku").strip(),
+        "marketplace": f2.text_input("Marketplace", key="bom_f_mkt").strip(),
+        "component_sku": f3.text_input("Component SKU starts with", key="bom_f_comp").strip(),
+    }
+    df, editor_key = paged("bom_grid", "kit_bom", filters)
+    if df.empty:
+        df = pd.DataFrame(columns=["amazon_sku","marketplace","component_sku","component_qty"])
+    st.data_editor(
+        df, num_rows="dynamic", use_container_width=True,
+        column_config={
+            "amazon_sku": st.column_config.TextColumn("Amazon SKU", required=True),
+            "marketplace": st.column_config.TextColumn("Marketplace", required=True),
+            "component_sku": st.column_config.TextColumn("Component SKU", required=True),
+            "component_qty": st.column_config.NumberColumn("Component Qty", required=True),
+        },
+        key=editor_key
+    )
+    if st.button("Save Kit BOM", use_container_width=True):
+        key_cols = ["amazon_sku", "marketplace", "component_sku"]
+        upserts, deletes = editor_changes(editor_key, df, key_cols)
+        keys = list(
+            pd.concat([upserts[key_cols[:2]], deletes[key_cols[:2]]]).drop_duplicates().itertuples(index=False, name=None)
+        )
+        rows = []
+        for _, r in upserts.fillna({"component_qty":1}).iterrows():
+            rows.append((
+                r["amazon_sku"], r["marketplace"], r["component_sku"], int(r["component_qty"] or 1)
+            ))
+        with pipeline() as conn:
+            delete_keys("kit_bom", key_cols, list(deletes.itertuples(index=False, name=None)), conn=conn)
+            merged = merge("kit_bom", pd.DataFrame(rows, columns=list(df.columns)), key_cols, conn=conn)
+            fifo.mapping_changed(conn, keys)  # re-resolve + mark old and new components dirty
+        report_saved("Kit BOM", upserts, deletes, key_cols, merged)
+
+
+# Products
+@fragment
+def grid_products():
     st.markdown("**Products (Internal catalog)**")
-    dfp = fetch_df("""
-      select internal_sku, category, cbm_per_unit, active
-      from product order by internal_sku
-    """)
+    f1, f2 = st.columns(2)
+    filters = {
+        "sku": f1.text_input("Internal SKU starts with", key="prod_f_sku").strip(),
+        "category": f2.text_input("Category", key="prod_f_cat").strip(),
+    }
+    dfp, editor_key = paged("prod_grid", "product", filters)
     if dfp.empty:
         dfp = pd.DataFrame(columns=["internal_sku","category","cbm_per_unit","active"])
-    editp = st.data_editor(
+    st.data_editor(
         dfp, num_rows="dynamic", use_container_width=True,
         column_config={
             "internal_sku": st.column_config.TextColumn("Internal SKU", required=True),
@@ -449,35 +741,42 @@ def page_mapping():
             "cbm_per_unit": st.column_config.NumberColumn("CBM per Unit"),
             "active": st.column_config.CheckboxColumn("Active")
         },
-        key="prod_grid"
+        key=editor_key
     )
     if st.button("Save Products", use_container_width=True):
+        key_cols = ["internal_sku"]
+        upserts, deletes = editor_changes(editor_key, dfp, key_cols)
         rows = []
-        for _, r in editp.fillna({"cbm_per_unit":0,"active":True}).iterrows():
+        for _, r in upserts.fillna({"cbm_per_unit":0,"active":True}).iterrows():
             rows.append((r["internal_sku"], r["category"], float(r["cbm_per_unit"] or 0), bool(r["active"])))
-        exec_many("""
-            insert into product(internal_sku, category, cbm_per_unit, active)
-            values (%s,%s,%s,%s)
-            on conflict(internal_sku) do update set
-              category = excluded.category,
-              cbm_per_unit = excluded.cbm_per_unit,
-              active = excluded.active
-        """, rows)
-        st.success("Products saved.")
+        with pipeline() as conn:
+            delete_keys("product", key_cols, list(deletes.itertuples(index=False, name=None)), conn=conn)
+            merged = merge("product", pd.DataFrame(rows, columns=list(dfp.columns)), key_cols, conn=conn)
+        report_saved("Products", upserts, deletes, key_cols, merged)
 
 
 # ---------- Render ----------
-with TABS[0]:
-    page_inbound()
-
-with TABS[1]:
-    page_sales_upload()
-
-with TABS[2]:
-    page_inventory()
-
-with TABS[3]:
-    page_summary()
-
-with TABS[4]:
-    page_mapping()
+# Only the selected page executes on a rerun (and only its queries run);
+# each grid is a fragment, so its Save button reruns just that grid.
+nav = st.navigation([
+    st.Page(page_inbound, title="Inbound & Costs", default=True),
+    st.Page(page_sales_upload, title="Sales Upload"),
+    st.Page(page_inventory, title="Inventory"),
+    st.Page(page_summary, title="Summary"),
+    st.Page(page_mapping, title="Mapping"),
+])
+nav.run()
+
+
+# ---------- Debug panel ----------
+st.session_state.setdefault("rerun_ms", {})["full script"] = round((time.perf_counter() - _run_started) * 1000, 1)
+with st.sidebar.expander("Debug: rerun latency (ms)"):
+    st.write(st.session_state["rerun_ms"])
+
+with st.sidebar.expander("Debug: query cache"):
+    stats = cache_stats()
+    st.metric("Hit rate", f"{stats['hit_rate']:.0%}")
+    st.write({k: stats[k] for k in ("hits", "misses", "entries", "mb", "evictions")})
+    if st.button("Clear query cache"):
+        cache_clear()
+        st.rerun()
@@ -0,0 +1,90 @@
+# bench/coldstart.py — cold-start cost of the headless entry points
+#
+#   python bench/coldstart.py [--repeat 7] [--out result.json] [--compare previous.json]
+#
+# Starts a fresh interpreter per sample and reports the best and median wall time to
+# import each core module and to print `cli.py --help`; the bare interpreter start
+# is listed as its own row for reference. Also records which heavy
+# modules (streamlit, pandas, numpy) each import pulls in — streamlit must never appear.
+# No database is needed: importing opens no connection.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("streamlit", "pandas", "numpy")
+
+TARGETS = {
+    "python": "pass",
+    "import db": "import db",
+    "import perf": "import perf",
+    "import worker": "import worker",
+    "import loader": "import loader",
+    "import fifo": "import fifo",
+    "cli --help": "import cli, contextlib, io\nwith contextlib.redirect_stdout(io.StringIO()):\n"
+                  "    try: cli.main(['--help'])\n    except SystemExit: pass",
+}
+
+
+def _sample(code: str) -> float:
+    t = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True, capture_output=True)
+    return time.perf_counter() - t
+
+
+def _loaded(code: str) -> list[str] | str:
+    probe = f"{code}\nimport sys, json\nprint(json.dumps([m for m in {HEAVY!r} if m in sys.modules]))"
+    out = subprocess.run([sys.executable, "-c", probe], cwd=ROOT, capture_output=True, text=True)
+    if out.returncode:
+        return "error: " + (out.stderr.strip().splitlines() or ["?"])[-1]
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run(repeat: int) -> dict:
+    rows = []
+    for name, code in TARGETS.items():
+        loaded = _loaded(code)
+        if isinstance(loaded, str):
+            rows.append({"target": name, "status": loaded})
+            print(f"  {name:<14} {loaded}", file=sys.stderr)
+            continue
+        samples = [_sample(code) for _ in range(repeat)]
+        rows.append({"target": name, "status": "ok", "best_s": round(min(samples), 4),
+                     "median_s": round(statistics.median(samples), 4), "loads": loaded})
+        print(f"  {name:<14} best {min(samples):7.3f}s  median {statistics.median(samples):7.3f}s  "
+              f"loads {', '.join(loaded) or '-'}", file=sys.stderr)
+    return {"python": sys.version.split()[0], "repeat": repeat, "targets": rows}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Measure import / CLI cold-start times.")
+    ap.add_argument("--repeat", type=int, default=7)
+    ap.add_argument("--out")
+    ap.add_argument("--compare")
+    args = ap.parse_args()
+
+    result = run(args.repeat)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            before = {r["target"]: r.get("best_s") for r in json.load(f)["targets"]}
+        for r in result["targets"]:
+            b, a = before.get(r["target"]), r.get("best_s")
+            ratio = f"{a / b:6.2f}x" if a and b else "     -"
+            print(f"{r['target']:<14} {b if b is not None else '-':>8} {a if a is not None else '-':>8} {ratio}",
+                  file=sys.stderr)
+    if any("streamlit" in (r.get("loads") or []) for r in result["targets"]):
+        sys.exit("streamlit was imported by a headless entry point")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# bench/fetch.py — db.fetch_df (tuples) vs db.fetch_frame (COPY, typed) on large reads
+#
+#   BENCH_DSN=postgresql://localhost/fifo_bench?sslmode=disable \
+#   python bench/fetch.py [--seed-data --months 2024-01:3 --orders 200000 --skus 5000] [--repeat 3] [--out result.json]
+#
+# Reads lot_balance (+ batch / cost, the FIFO engine's lot query), a month of demand
+# and a month of fifo_alloc both ways, uncached, and reports per query and path:
+# best wall time, rows/s, peak Python allocation while reading (one extra run under
+# tracemalloc, so tracing does not skew the timings) and the resulting DataFrame's size.
+# --seed-data first fills the scratch database from bench/synth.py and runs the Python
+# engine once so fifo_alloc has rows.
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synth  # noqa: E402
+
+
+def _queries(ym):
+    import fifo
+    return {
+        "lots": (fifo.LOTS_SQL, None),
+        "demand": (fifo.DEMAND_SQL, {"yms": [ym], "skus": None}),
+        "fifo_alloc": ("select * from fifo_alloc where ym = %s", (ym,)),
+    }
+
+
+def _measure(fn, repeat):
+    """Best of `repeat` untraced runs, plus one run under tracemalloc for the peak."""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        t = time.perf_counter()
+        df = fn()
+        seconds = time.perf_counter() - t
+        best = seconds if best is None else min(best, seconds)
+        del df
+    gc.collect()
+    tracemalloc.start()
+    df = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "seconds": round(best, 4),
+        "rows": len(df),
+        "rows_per_s": round(len(df) / best) if best else None,
+        "peak_mb": round(peak / 1024 / 1024, 1),
+        "frame_mb": round(df.memory_usage(deep=True).sum() / 1024 / 1024, 1),
+    }
+
+
+def run(args) -> dict:
+    from db import connection, fetch_df, fetch_frame
+
+    months = synth.parse_months(args.months)
+    with connection() as conn:
+        if args.seed_data:
+            import fifo
+            data = synth.generate(skus=args.skus, months=months, orders_per_month=args.orders, seed=args.seed)
+            synth.load(conn, data, reset=True)
+            conn.execute("""
+                insert into lot_balance(internal_sku, batch_id, qty_remaining)
+                select internal_sku, batch_id, qty_in from inbound_items
+            """)
+            fifo.run_month(conn, months[0])
+        results = []
+        for name, (sql, params) in _queries(months[0]).items():
+            # conn= bypasses the query cache, so every repeat really reads.
+            tuples = _measure(lambda: fetch_df(sql, params, conn=conn), args.repeat)
+            frame = _measure(lambda: fetch_frame(sql, params, conn=conn), args.repeat)
+            results.append({"query": name, "fetch_df": tuples, "fetch_frame": frame,
+                            "speedup": round(tuples["seconds"] / frame["seconds"], 2) if frame["seconds"] else None,
+                            "memory_ratio": round(frame["frame_mb"] / tuples["frame_mb"], 2) if tuples["frame_mb"] else None})
+            print(f"  {name:<12} tuples {tuples['seconds']:8.3f}s {tuples['frame_mb']:8.1f}MB   "
+                  f"copy {frame['seconds']:8.3f}s {frame['frame_mb']:8.1f}MB", file=sys.stderr)
+    return {"months": months, "repeat": args.repeat, "results": results}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Compare fetch_df and fetch_frame on a scratch Postgres.")
+    ap.add_argument("--dsn", default=os.environ.get("BENCH_DSN"), help="scratch database (default: $BENCH_DSN)")
+    ap.add_argument("--months", default="2024-01:1", help="comma list, or START:COUNT; the first is read")
+    ap.add_argument("--seed-data", action="store_true", help="truncate and refill the input tables first")
+    ap.add_argument("--orders", type=int, default=200_000, help="orders per month (--seed-data)")
+    ap.add_argument("--skus", type=int, default=5000)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--out")
+    args = ap.parse_args()
+
+    if not args.dsn:
+        ap.error("set BENCH_DSN (or --dsn) to a scratch database")
+    os.environ["DB_DSN"] = args.dsn
+    os.environ.setdefault("PERF_LOG", "0")
+    from db import _secret
+    if _secret("DB_DSN") != args.dsn:  # secrets.toml wins over the environment in db.py
+        ap.error("a .streamlit/secrets.toml DB_DSN is in effect; run from a directory without one")
+
+    result = run(args)
+    text = json.dumps(result, indent=2, default=str)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
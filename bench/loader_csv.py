@@ -0,0 +1,91 @@
+# bench/loader_csv.py — rows/sec of loader.parse_sales_csv on a synthetic settlement report
+#
+#   python bench/loader_csv.py --rows 1000000 [--legacy-rows 50000]
+#
+# Parsing only (no database). --legacy-rows also times the previous iterrows +
+# dateutil implementation on a smaller sample for comparison.
+
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TYPES = np.array(["Order", "Order", "Order", "Refund", "FBA Inventory Fee", "Transfer", "Service Fee"])
+TZS = np.array(["PST", "PDT"])
+
+
+def synth_settlement(rows: int, seed: int = 0) -> bytes:
+    """A settlement report with Amazon's US date format and a realistic type mix."""
+    rng = np.random.default_rng(seed)
+    ts = pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 30 * 86400, rows), unit="s")
+    df = pd.DataFrame({
+        "date/time": ts.strftime("%b %-d, %Y %-I:%M:%S %p") + " " + rng.choice(TZS, rows),
+        "settlement id": "1234567890",
+        "type": rng.choice(TYPES, rows),
+        "order id": [f"111-{i:07d}-{i % 9973:07d}" for i in range(rows)],
+        "sku": np.char.add("SKU-", rng.integers(0, 5000, rows).astype(str)),
+        "description": "Widget, assorted",
+        "quantity": rng.integers(1, 4, rows),
+        "marketplace": "amazon.com",
+        "fulfillment": "Amazon",
+        "product sales": rng.random(rows).round(2) * 50,
+        "total": rng.random(rows).round(2) * 40,
+    })
+    buf = io.StringIO()
+    df.to_csv(buf, index=False)
+    return buf.getvalue().encode()
+
+
+def legacy_parse(file_bytes: bytes, marketplace: str) -> list[dict]:
+    """The pre-vectorization loop, kept here only as the benchmark baseline."""
+    from dateutil import parser
+    df = pd.read_csv(io.BytesIO(file_bytes))
+    col = {c.lower(): c for c in df.columns}
+    rows = []
+    for _, r in df.iterrows():
+        try:
+            happened_at = parser.parse(str(r[col["date/time"]]))
+        except Exception:
+            continue
+        rows.append({
+            "happened_at": happened_at.isoformat(),
+            "type": str(r[col["type"]]),
+            "order_id": str(r[col["order id"]]),
+            "amazon_sku": str(r[col["sku"]]),
+            "quantity": int(pd.to_numeric(r[col["quantity"]], errors="coerce") or 0),
+            "marketplace": marketplace,
+            "payload": {k: str(r[k]) for k in df.columns},
+        })
+    return [x for x in rows if x["type"] in ("Order", "order") and x["quantity"] > 0]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=1_000_000)
+    ap.add_argument("--legacy-rows", type=int, default=0)
+    args = ap.parse_args()
+
+    from loader import parse_sales_csv
+
+    data = synth_settlement(args.rows)
+    t = time.perf_counter()
+    out = parse_sales_csv(data, "amazon.com")
+    dt = time.perf_counter() - t
+    print(f"vectorized: {args.rows:,} lines -> {len(out):,} orders in {dt:.2f}s ({args.rows / dt:,.0f} rows/s)")
+
+    if args.legacy_rows:
+        data = synth_settlement(args.legacy_rows)
+        t = time.perf_counter()
+        legacy_parse(data, "amazon.com")
+        dt = time.perf_counter() - t
+        print(f"legacy:     {args.legacy_rows:,} lines in {dt:.2f}s ({args.legacy_rows / dt:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# bench/pipeline.py — end-to-end timings of the costing pipeline on synthetic data
+#
+#   BENCH_DSN=postgresql://localhost/fifo_bench?sslmode=disable \
+#   python bench/pipeline.py --months 2024-01:6 --orders 50000 --skus 2000 --containers 40 \
+#                            [--engine python|sql] [--out result.json] [--compare previous.json]
+#
+# Runs against a scratch database only (BENCH_DSN, never DB_DSN): the input tables are
+# truncated and refilled from bench/synth.py. Stages timed, in order:
+#   load_inputs       COPY of the generated batch / cost / duty / mapping tables
+#   parse_csv         loader.parse_sales_csv per month (no database)
+#   import_loader     loader.load_sales_raw_from_csv per month (rows removed again afterwards)
+#   import_app        loader.import_sales_stream per month — the Sales Upload page path
+#   rebuild_lot_costs select rebuild_lot_costs() (skipped if the function is not installed)
+#   lot_balance       select rebuild_lot_balance(), or lot_balance seeded from inbound_items
+#   fifo <ym>         fifo.run_month (python) or select run_month(ym) (sql), per month;
+#                     includes summarize (month_summary)
+# Every stage also reports its database time and row counts from the perf hooks.
+# The JSON result goes to stdout (and --out); --compare prints the ratio per stage.
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synth  # noqa: E402
+
+
+class Recorder:
+    """Stage timer; database calls inside a stage are summed through a perf hook."""
+
+    def __init__(self):
+        self.stages = []
+        self._db = None
+
+    def hook(self, event):
+        if self._db is not None and event["op"] != "stage":
+            self._db["db_seconds"] += event["seconds"]
+            self._db["db_calls"] += 1
+            self._db["db_rows"] += max(event["rows"] or 0, 0)
+
+    def stage(self, name, fn, **extra):
+        self._db = {"db_seconds": 0.0, "db_calls": 0, "db_rows": 0}
+        t = time.perf_counter()
+        try:
+            out = fn()
+            status = "ok"
+        except _Skip as e:
+            out, status = None, f"skipped: {e}"
+        finally:
+            seconds = time.perf_counter() - t
+            db, self._db = self._db, None
+        row = {"stage": name, "seconds": round(seconds, 4), "status": status,
+               **{k: round(v, 4) if isinstance(v, float) else v for k, v in db.items()}, **extra}
+        if isinstance(out, dict):
+            row.update(out)
+        elif isinstance(out, int):
+            row["rows"] = out
+        if row.get("rows") and seconds > 0:
+            row["rows_per_s"] = round(row["rows"] / seconds)
+        self.stages.append(row)
+        print(f"  {name:<24} {seconds:9.3f}s  {status}", file=sys.stderr)
+        return out
+
+
+class _Skip(Exception):
+    pass
+
+
+def _skip(reason):
+    raise _Skip(reason)
+
+
+def _has_function(conn, name):
+    from db import fetch_df
+    return bool(fetch_df("select 1 from pg_proc where proname = %s limit 1", (name,), conn=conn).shape[0])
+
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args) -> dict:
+    import fifo
+    import loader
+    import perf
+    from db import connection, exec_sql
+
+    months = synth.parse_months(args.months)
+    params = {
+        "containers": args.containers, "skus": args.skus, "kits": args.kits,
+        "marketplaces": args.marketplaces.split(","), "months": months,
+        "orders_per_month": args.orders, "seed": args.seed,
+    }
+    rec = Recorder()
+    perf.add_hook(rec.hook)
+
+    data = rec.stage("generate", lambda: synth.generate(**params))
+    csvs = {ym: synth.settlement_csv(m, seed=args.seed) for ym, m in data["sales_raw"].groupby("ym")}
+
+    with connection() as conn:
+        inputs = [t for t in synth.TABLES if t != "sales_raw"]
+        rec.stage("load_inputs", lambda: {"rows": sum(synth.load(conn, data, inputs, reset=True).values())})
+
+        rec.stage("parse_csv", lambda: sum(len(loader.parse_sales_csv(b, "")) for b in csvs.values()))
+        if args.skip_loader:
+            rec.stage("import_loader", lambda: _skip("--skip-loader"))
+        else:
+            rec.stage("import_loader", lambda: sum(loader.load_sales_raw_from_csv(b, "") for b in csvs.values()))
+            exec_sql("delete from sales_raw where ym is null", conn=conn)
+        rec.stage("import_app", lambda: sum(
+            loader.import_sales_stream(io.BytesIO(b), ym) for ym, b in csvs.items()
+        ))
+
+        def costs():
+            if not _has_function(conn, "rebuild_lot_costs"):
+                _skip("rebuild_lot_costs() not installed")
+            exec_sql("select rebuild_lot_costs()", conn=conn)
+
+        def balances():
+            if _has_function(conn, "rebuild_lot_balance"):
+                exec_sql("select rebuild_lot_balance()", conn=conn)
+                return {"method": "rebuild_lot_balance()"}
+            exec_sql("""
+                insert into lot_balance(internal_sku, batch_id, qty_remaining)
+                select internal_sku, batch_id, qty_in from inbound_items
+                on conflict (internal_sku, batch_id) do update set qty_remaining = excluded.qty_remaining
+            """, conn=conn)
+            return {"method": "seeded from inbound_items"}
+
+        rec.stage("rebuild_lot_costs", costs)
+        rec.stage("lot_balance", balances)
+
+        for ym in months:
+            if args.engine == "python":
+                rec.stage(f"fifo {ym}", lambda: fifo.run_month(conn, ym, args.workers), ym=ym)
+            else:
+                rec.stage(f"fifo {ym}", lambda: exec_sql("select run_month(%s)", (ym,), conn=conn), ym=ym)
+
+    perf.remove_hook(rec.hook)
+    fifo_rows = [s for s in rec.stages if s["stage"].startswith("fifo ")]
+    return {
+        "meta": {
+            "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_rev": _git_rev(), "python": platform.python_version(), "machine": platform.machine(),
+            "cpus": os.cpu_count(), "engine": args.engine, "workers": args.workers,
+        },
+        "params": params,
+        "input_rows": {k: len(v) for k, v in data.items()},
+        "stages": rec.stages,
+        "totals": {
+            "seconds": round(sum(s["seconds"] for s in rec.stages), 4),
+            "fifo_seconds": round(sum(s["seconds"] for s in fifo_rows), 4),
+        },
+    }
+
+
+def compare(result: dict, previous: dict):
+    before = {s["stage"]: s["seconds"] for s in previous.get("stages", [])}
+    print(f"{'stage':<24} {'before':>10} {'after':>10} {'ratio':>7}", file=sys.stderr)
+    for s in result["stages"]:
+        b = before.get(s["stage"])
+        ratio = f"{s['seconds'] / b:6.2f}x" if b else "     -"
+        print(f"{s['stage']:<24} {b if b is not None else '-':>10} {s['seconds']:>10} {ratio:>7}", file=sys.stderr)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the costing pipeline on a scratch Postgres.")
+    ap.add_argument("--dsn", default=os.environ.get("BENCH_DSN"), help="scratch database (default: $BENCH_DSN)")
+    ap.add_argument("--containers", type=int, default=40)
+    ap.add_argument("--skus", type=int, default=2000)
+    ap.add_argument("--kits", type=int, default=200)
+    ap.add_argument("--marketplaces", default="amazon.com,amazon.ca")
+    ap.add_argument("--months", default="2024-01:3", help="comma list, or START:COUNT")
+    ap.add_argument("--orders", type=int, default=50_000, help="orders per month")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--engine", choices=["python", "sql"], default="python")
+    ap.add_argument("--workers", type=int, default=None, help="FIFO shards (python engine)")
+    ap.add_argument("--skip-loader", action="store_true", help="skip loader.load_sales_raw_from_csv (slow)")
+    ap.add_argument("--out")
+    ap.add_argument("--compare")
+    args = ap.parse_args()
+
+    if not args.dsn:
+        ap.error("set BENCH_DSN (or --dsn) to a scratch database; its input tables are truncated")
+    os.environ["DB_DSN"] = args.dsn
+    os.environ.setdefault("PERF_LOG", "0")  # timings go to the JSON, not to run_log
+    from db import _secret
+    if _secret("DB_DSN") != args.dsn:  # secrets.toml wins over the environment in db.py
+        ap.error("a .streamlit/secrets.toml DB_DSN is in effect; run from a directory without one")
+
+    result = run(args)
+    text = json.dumps(result, indent=2, default=str)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+# bench/synth.py — synthetic data for the whole costing pipeline
+#
+#   python bench/synth.py --out /tmp/synth [--containers 40 --skus 2000 --kits 200 \
+#                         --marketplaces amazon.com,amazon.ca --months 2024-01,2024-02 --orders 50000]
+#
+# generate() builds batch, batch_cost, duty_pool, product, inbound_items, sku_map,
+# kit_bom and sales_raw frames (deterministic for a seed); settlement_csv() renders a
+# month of sales as an Amazon settlement report, the input of both CSV import paths.
+# load() COPYs the frames into a scratch database (bench/pipeline.py does that for you).
+
+import argparse
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CATEGORIES = ["apparel", "home", "kitchen", "toys", "electronics", "garden", "beauty", "sports"]
+# Settlement report times are local to the marketplace:
+# (standard, daylight) zone abbreviations with their UTC offsets in hours.
+MARKET_TZ = {
+    "amazon.com": (("PST", -8), ("PDT", -7)), "amazon.ca": (("EST", -5), ("EDT", -4)),
+    "amazon.co.uk": (("GMT", 0), ("BST", 1)), "amazon.de": (("CET", 1), ("CEST", 2)),
+    "amazon.co.jp": (("JST", 9), ("JST", 9)),
+}
+FEE_TYPES = ["FBA Inventory Fee", "Transfer", "Service Fee"]
+
+# Tables the pipeline reads, with the columns the app and the engines use. Only for a
+# scratch database: creates what is missing and never alters existing tables.
+# sales_raw also carries loader.py's columns so both import paths can be timed.
+BENCH_DDL = """
+create table if not exists batch (
+  batch_id text primary key, arrived_at date, dest_market text, note text
+);
+create table if not exists batch_cost (
+  batch_id text primary key, freight_total numeric, clearance_total numeric
+);
+create table if not exists duty_pool (
+  batch_id text, category text, duty_total numeric, primary key (batch_id, category)
+);
+create table if not exists product (
+  internal_sku text primary key, category text, cbm_per_unit numeric, active boolean default true
+);
+create table if not exists inbound_items (
+  batch_id text, internal_sku text, category text, qty_in integer, fob_unit numeric, cbm_per_unit numeric,
+  primary key (batch_id, internal_sku)
+);
+create table if not exists sku_map (
+  amazon_sku text, marketplace text, internal_sku text, unit_multiplier integer default 1,
+  active boolean default true, primary key (amazon_sku, marketplace)
+);
+create table if not exists kit_bom (
+  amazon_sku text, marketplace text, component_sku text, component_qty integer,
+  primary key (amazon_sku, marketplace, component_sku)
+);
+create table if not exists sales_raw (
+  ym text, date_time timestamptz, marketplace text, order_id text, amazon_sku text, qty integer,
+  happened_at timestamptz, type text, quantity integer, payload text
+);
+create unique index if not exists sales_raw_loader_key on sales_raw(order_id, amazon_sku, happened_at);
+create index if not exists sales_raw_ym_idx on sales_raw(ym);
+create table if not exists lot_cost (
+  batch_id text, internal_sku text, unit_cost numeric, primary key (batch_id, internal_sku)
+);
+create table if not exists lot_balance (
+  internal_sku text, batch_id text, qty_remaining integer, primary key (internal_sku, batch_id)
+);
+create table if not exists month_summary (
+  ym text primary key, orders integer, units integer, cogs numeric, updated_at timestamptz
+)
+"""
+
+TABLES = ["batch", "batch_cost", "duty_pool", "product", "inbound_items", "sku_map", "kit_bom", "sales_raw"]
+
+
+def month_range(start: str, count: int) -> list[str]:
+    return [p.strftime("%Y-%m") for p in pd.period_range(start, periods=count, freq="M")]
+
+
+def generate(containers: int = 40, skus: int = 2000, kits: int = 200,
+             marketplaces=("amazon.com",), months=("2024-01",), orders_per_month: int = 50_000,
+             seed: int = 0) -> dict[str, pd.DataFrame]:
+    """
+    Frames for every input table. Containers arrive evenly from two months before the
+    first sales month to the middle of the last one; each carries 5–20% of the catalog.
+    Order popularity is Zipf-like, so a few SKUs drain many lots and the tail barely moves.
+    """
+    rng = np.random.default_rng(seed)
+    marketplaces, months = list(marketplaces), list(months)
+
+    internal = np.array([f"SKU-{i:06d}" for i in range(skus)])
+    category = rng.choice(CATEGORIES, skus)
+    cbm = rng.uniform(0.001, 0.05, skus).round(5)
+    base_fob = rng.lognormal(1.5, 0.6, skus).round(2)
+    product = pd.DataFrame({"internal_sku": internal, "category": category, "cbm_per_unit": cbm, "active": True})
+
+    first = pd.Period(months[0], "M") - 2
+    last = pd.Period(months[-1], "M")
+    span = (last.start_time - first.start_time).days + 15
+    arrived = first.start_time + pd.to_timedelta(np.linspace(0, span, containers).astype(int), unit="D")
+    batch_ids = np.array([f"CNT-{i:05d}" for i in range(containers)])
+    batch = pd.DataFrame({
+        "batch_id": batch_ids,
+        "arrived_at": arrived.date,
+        "dest_market": rng.choice(["US", "CA", "EU", "UK", "JP"], containers),
+        "note": "synthetic",
+    })
+
+    parts = []
+    for b in batch_ids:
+        idx = rng.choice(skus, max(1, int(skus * rng.uniform(0.05, 0.2))), replace=False)
+        parts.append(pd.DataFrame({
+            "batch_id": b,
+            "internal_sku": internal[idx],
+            "category": category[idx],
+            "qty_in": rng.integers(50, 1000, len(idx)),
+            "fob_unit": (base_fob[idx] * rng.uniform(0.9, 1.1, len(idx))).round(2),
+            "cbm_per_unit": cbm[idx],
+        }))
+    inbound = pd.concat(parts, ignore_index=True)
+
+    value = inbound["qty_in"] * inbound["fob_unit"]
+    per_batch = inbound.assign(cbm=inbound["qty_in"] * inbound["cbm_per_unit"], value=value).groupby("batch_id")
+    batch_cost = pd.DataFrame({
+        "batch_id": per_batch["cbm"].sum().index,
+        "freight_total": (per_batch["cbm"].sum() * rng.uniform(80, 160, containers)).round(2).values,
+        "clearance_total": rng.uniform(300, 1500, containers).round(2),
+    })
+    duty_pool = (
+        inbound.assign(value=value).groupby(["batch_id", "category"], as_index=False)["value"].sum()
+        .assign(duty_total=lambda d: (d["value"] * rng.uniform(0.02, 0.25, len(d))).round(2))
+        .drop(columns="value")
+    )
+
+    maps, boms = [], []
+    for mkt in marketplaces:
+        tag = mkt.split(".", 1)[1].upper().replace(".", "")
+        maps.append(pd.DataFrame({
+            "amazon_sku": np.char.add(f"{tag}-", internal),
+            "marketplace": mkt,
+            "internal_sku": internal,
+            "unit_multiplier": rng.choice([1, 1, 1, 1, 2, 3], skus),  # multipacks
+            "active": True,
+        }))
+        for k in range(kits):
+            comp = rng.choice(skus, rng.integers(2, 5), replace=False)
+            boms.append(pd.DataFrame({
+                "amazon_sku": f"{tag}-KIT-{k:05d}",
+                "marketplace": mkt,
+                "component_sku": internal[comp],
+                "component_qty": rng.integers(1, 3, len(comp)),
+            }))
+    sku_map = pd.concat(maps, ignore_index=True)
+    kit_bom = pd.concat(boms, ignore_index=True) if boms else pd.DataFrame(
+        columns=["amazon_sku", "marketplace", "component_sku", "component_qty"]
+    )
+
+    sellable = pd.concat([
+        sku_map[["amazon_sku", "marketplace"]],
+        kit_bom[["amazon_sku", "marketplace"]].drop_duplicates(),
+    ], ignore_index=True)
+    weight = 1.0 / np.arange(1, len(sellable) + 1) ** 1.1
+    weight = rng.permutation(weight / weight.sum())
+    sales = []
+    for ym in months:
+        p = pd.Period(ym, "M")
+        pick = rng.choice(len(sellable), orders_per_month, p=weight)
+        secs = rng.integers(0, p.days_in_month * 86400, orders_per_month)
+        sales.append(pd.DataFrame({
+            "ym": ym,
+            "date_time": (p.start_time + pd.to_timedelta(np.sort(secs), unit="s")).tz_localize("UTC"),
+            "marketplace": sellable["marketplace"].values[pick],
+            "order_id": [f"{ym.replace('-', '')[2:]}-{i:07d}-{seed:03d}" for i in range(orders_per_month)],
+            "amazon_sku": sellable["amazon_sku"].values[pick],
+            "qty": rng.choice([1, 1, 1, 2, 3], orders_per_month),
+        }))
+    sales_raw = pd.concat(sales, ignore_index=True)
+
+    return {
+        "batch": batch, "batch_cost": batch_cost, "duty_pool": duty_pool, "product": product,
+        "inbound_items": inbound, "sku_map": sku_map, "kit_bom": kit_bom, "sales_raw": sales_raw,
+    }
+
+
+def settlement_csv(sales: pd.DataFrame, fee_share: float = 0.05, seed: int = 0) -> bytes:
+    """
+    Sales rows as an Amazon settlement report (local time + zone abbreviation), with
+    `fee_share` extra fee/transfer lines that carry no SKU, as real reports do.
+    """
+    rng = np.random.default_rng(seed)
+    utc = pd.to_datetime(sales["date_time"], utc=True)
+    local = pd.Series(pd.NaT, index=sales.index, dtype="datetime64[ns]")
+    zone = pd.Series("UTC", index=sales.index)
+    for mkt, (std, dst) in MARKET_TZ.items():
+        m = (sales["marketplace"] == mkt).values
+        if not m.any():
+            continue
+        # Summer months use the daylight-saving abbreviation.
+        summer = utc[m].dt.month.between(4, 10).values
+        abbr = np.where(summer, dst[0], std[0])
+        offset = np.where(summer, dst[1], std[1])
+        local[m] = (utc[m].dt.tz_localize(None) + pd.to_timedelta(offset, unit="h")).values
+        zone[m] = abbr
+    rest = ~sales["marketplace"].isin(MARKET_TZ.keys()).values
+    local[rest] = utc[rest].dt.tz_localize(None)
+
+    orders = pd.DataFrame({
+        "date/time": local.dt.strftime("%b %-d, %Y %-I:%M:%S %p") + " " + zone,
+        "settlement id": "9000000001",
+        "type": "Order",
+        "order id": sales["order_id"].values,
+        "sku": sales["amazon_sku"].values,
+        "description": "Synthetic item",
+        "quantity": sales["qty"].values,
+        "marketplace": sales["marketplace"].values,
+        "fulfillment": "Amazon",
+        "product sales": (rng.random(len(sales)) * 60).round(2),
+        "total": (rng.random(len(sales)) * 45).round(2),
+    })
+    n_fee = int(len(sales) * fee_share)
+    if n_fee:
+        fees = orders.sample(n_fee, random_state=seed, replace=len(sales) < n_fee).assign(
+            type=rng.choice(FEE_TYPES, n_fee), **{"order id": "", "sku": "", "quantity": ""}
+        )
+        orders = pd.concat([orders, fees]).sort_values("date/time", kind="stable")
+    buf = io.StringIO()
+    orders.to_csv(buf, index=False)
+    return buf.getvalue().encode()
+
+
+def ensure_schema(conn):
+    with conn.cursor() as cur:
+        for stmt in BENCH_DDL.split(";"):
+            if stmt.strip():
+                cur.execute(stmt)
+
+
+def load(conn, data: dict[str, pd.DataFrame], tables=None, reset: bool = False):
+    """COPY the generated frames into their tables in one transaction (reset=True truncates first)."""
+    from db import copy_df
+
+    tables = [t for t in (tables or TABLES) if t in data]
+    ensure_schema(conn)
+    with conn.transaction(), conn.cursor() as cur:
+        if reset:
+            cur.execute("truncate " + ", ".join(TABLES + ["lot_cost", "lot_balance", "month_summary"]))
+        for t in tables:
+            copy_df(cur, t, data[t])
+    return {t: len(data[t]) for t in tables}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Write synthetic pipeline inputs as CSV files.")
+    ap.add_argument("--out", required=True)
+    ap.add_argument("--containers", type=int, default=40)
+    ap.add_argument("--skus", type=int, default=2000)
+    ap.add_argument("--kits", type=int, default=200)
+    ap.add_argument("--marketplaces", default="amazon.com")
+    ap.add_argument("--months", default="2024-01", help="comma list, or START:COUNT (e.g. 2024-01:12)")
+    ap.add_argument("--orders", type=int, default=50_000, help="orders per month")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    data = generate(args.containers, args.skus, args.kits, args.marketplaces.split(","),
+                    parse_months(args.months), args.orders, args.seed)
+    os.makedirs(args.out, exist_ok=True)
+    for name, df in data.items():
+        df.to_csv(os.path.join(args.out, f"{name}.csv"), index=False)
+        print(f"{name}: {len(df):,} rows")
+    for ym, month in data["sales_raw"].groupby("ym"):
+        with open(os.path.join(args.out, f"settlement_{ym}.csv"), "wb") as f:
+            f.write(settlement_csv(month, seed=args.seed))
+
+
+def parse_months(spec: str) -> list[str]:
+    if ":" in spec:
+        start, count = spec.split(":", 1)
+        return month_range(start, int(count))
+    return [m.strip() for m in spec.split(",") if m.strip()]
+
+
+if __name__ == "__main__":
+    main()
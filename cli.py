@@ -0,0 +1,188 @@
+# cli.py — headless entry point (cron, containers, shell)
+# -----------------------------------------------
+#   python cli.py import-sales FILE [FILE|ZIP ...] [--marketplace amazon.com] [--ym YYYY-MM]
+#   python cli.py run-month YYYY-MM [--through YYYY-MM] [--engine sql|python] [--workers N] [--full]
+#   python cli.py snapshot YYYY-MM
+#   python cli.py rebuild [--full]
+#   python cli.py reconcile-costs [--tol 0.0001]   # landed.reconcile: incremental vs rebuild_lot_costs()
+#   python cli.py last-runs [--limit N]
+#   python cli.py migrate                    # grid indexes (grids.GRID_INDEX_DDL), built CONCURRENTLY
+#   python cli.py worker                     # same as python worker.py
+#
+# Runs the same stages as the worker (worker.stages_for), in this process, under a
+# perf.run so they land in run_log. Never imports Streamlit; every command imports
+# only the modules it needs, so `--help` and `last-runs` start without pandas/NumPy
+# pipeline code. DB_DSN comes from .streamlit/secrets.toml or the environment (db.py).
+# `python -X importtime cli.py --help` or bench/coldstart.py shows the import cost.
+
+import argparse
+import sys
+import time
+
+
+def _log(msg: str):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def _run_stages(kind: str, ym: str | None = None, **params):
+    import perf
+    import worker
+    from db import connection
+
+    stages = worker.stages_for(kind, ym, **params)
+    t = time.perf_counter()
+
+    def on_stage(name, i, total, seconds):
+        _log(f"[{i + 1}/{total}] {name}  {seconds:.2f}s")
+
+    with perf.run(kind, ym), connection() as conn:
+        worker.run_stages(stages, conn, on_stage)
+    _log(f"{kind} {ym or ''} done in {time.perf_counter() - t:.2f}s")
+
+
+# ---------- Commands ----------
+def cmd_import_sales(args):
+    import loader
+    from db import connection
+
+    t = time.perf_counter()
+    failed = 0
+    if args.ym:
+        if len(args.files) == 1 and not args.files[0].lower().endswith(".zip"):
+            # Same path as the Sales Upload page: streamed into sales_raw for that month.
+            marketplace = args.marketplace or loader.infer_marketplace(args.files[0])
+            if marketplace and not args.marketplace:
+                _log(f"marketplace {marketplace} (from the file name)")
+            with open(args.files[0], "rb") as f:
+                n = loader.import_sales_stream(f, args.ym, marketplace)
+        else:
+            files = []
+            for path in args.files:
+                with open(path, "rb") as f:
+                    files.append((path, f.read()))
+
+            def on_file(r):
+                _log(f"{r['status']:<6} {r['file']}  {r['marketplace'] or '-'} ({r['marketplace_source'] or '-'})  "
+                     f"{r['rows']:,} rows  parse {r['parse_s']:.2f}s  load {r['load_s']:.2f}s  {r['error'] or ''}")
+
+            reports = loader.import_sales_files(files, args.ym, workers=args.workers, on_file=on_file,
+                                                marketplace=args.marketplace or None)
+            n = sum(r["rows"] for r in reports if r["status"] == "ok")
+            failed = sum(r["status"] == "failed" for r in reports)
+        import fifo
+        with connection() as conn:
+            fifo.mark_dirty_sales(conn, args.ym)
+    else:
+        if len(args.files) > 1 or args.files[0].lower().endswith(".zip"):
+            sys.exit("several files or a zip need --ym (the settlement import takes one CSV)")
+        with open(args.files[0], "rb") as f:
+            n = loader.load_sales_raw_from_csv(f.read(), args.marketplace)
+    _log(f"imported {n:,} rows from {', '.join(args.files)} in {time.perf_counter() - t:.2f}s")
+    if failed:
+        sys.exit(f"{failed} file(s) failed; the others were loaded (one transaction per file)")
+
+
+def cmd_run_month(args):
+    params = {"engine": args.engine, "full": args.full, "end_ym": args.through}
+    if args.engine == "python":
+        params["workers"] = args.workers
+    _run_stages("run_month", args.ym, **params)
+
+
+def cmd_snapshot(args):
+    _run_stages("snapshot", args.ym)
+
+
+def cmd_rebuild(args):
+    _run_stages("rebuild", full=args.full)
+
+
+def cmd_reconcile_costs(args):
+    import landed
+    from db import connection
+
+    with connection() as conn:
+        rec = landed.reconcile(conn, args.tol)
+    if not rec["mismatches"].empty:
+        print(rec["mismatches"].to_string(index=False))
+    _log(f"{rec['lots']:,} lots, {len(rec['mismatches']):,} mismatching"
+         + ("" if rec["ok"] else " — keep LANDED_INCREMENTAL off"))
+    if not rec["ok"]:
+        sys.exit(1)
+
+
+def cmd_last_runs(args):
+    import perf
+
+    df = perf.runs(args.limit)
+    print(df.to_string(index=False) if not df.empty else "no runs in run_log")
+
+
+def cmd_migrate(args):
+    import grids
+    from db import connection
+
+    with connection() as conn:  # autocommit: CONCURRENTLY cannot run in a transaction
+        for name, status in grids.migrate(conn):
+            _log(f"{status:<8} {name}")
+
+
+def cmd_worker(args):
+    import worker
+    worker.main()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(prog="cli.py", description="Amazon FIFO costing pipeline, without the UI.")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("import-sales", help="load an Amazon settlement / order CSV into sales_raw")
+    p.add_argument("files", nargs="+", metavar="FILE", help="CSV exports or zips of them (several need --ym)")
+    p.add_argument("--marketplace", default="",
+                   help="settlement import: overrides the marketplace column; with --ym: fills files without "
+                        "one (default: inferred from the file name)")
+    p.add_argument("--ym", help="YYYY-MM: import the files as that month (Sales Upload path) and mark it dirty")
+    p.add_argument("--workers", type=int, default=None, help="parse processes (SALES_PARSE_WORKERS)")
+    p.set_defaults(fn=cmd_import_sales)
+
+    p = sub.add_parser("run-month", help="map → costs → FIFO → summarize one month (or a range)")
+    p.add_argument("ym", metavar="YYYY-MM")
+    p.add_argument("--through", metavar="YYYY-MM", help="backfill every month from YYYY-MM through this one")
+    p.add_argument("--engine", choices=["sql", "python"], default="sql")
+    p.add_argument("--workers", type=int, default=None, help="SKU shards for the python engine (FIFO_WORKERS)")
+    p.add_argument("--full", action="store_true",
+                   help="python engine: always rebuild_lot_costs(), even with LANDED_INCREMENTAL=1")
+    p.set_defaults(fn=cmd_run_month)
+
+    p = sub.add_parser("snapshot", help="store the month-end lot snapshot of a month")
+    p.add_argument("ym", metavar="YYYY-MM")
+    p.set_defaults(fn=cmd_snapshot)
+
+    p = sub.add_parser("rebuild", help="rebuild costs and replay dirty SKUs (--full: everything)")
+    p.add_argument("--full", action="store_true")
+    p.set_defaults(fn=cmd_rebuild)
+
+    p = sub.add_parser("reconcile-costs",
+                       help="diff incremental lot costs against rebuild_lot_costs() (rolled back; exit 1 on mismatch)")
+    p.add_argument("--tol", type=float, default=1e-4, help="allowed unit cost difference")
+    p.set_defaults(fn=cmd_reconcile_costs)
+
+    p = sub.add_parser("last-runs", help="latest instrumented runs from run_log")
+    p.add_argument("--limit", type=int, default=20)
+    p.set_defaults(fn=cmd_last_runs)
+
+    p = sub.add_parser("migrate", help="build missing or invalid grid indexes (run on deploy, not by the app)")
+    p.set_defaults(fn=cmd_migrate)
+
+    p = sub.add_parser("worker", help="poll and run queued jobs")
+    p.set_defaults(fn=cmd_worker)
+    return ap
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
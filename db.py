@@ -1,37 +1,518 @@
 import os
-import psycopg2
-from psycopg2.extras import execute_values
-import streamlit as st
+import io
+import re
+import sys
+import time
+import tomllib
+import threading
+import functools
+import contextlib
+import weakref
+import urllib.parse as _url
+from collections import OrderedDict
+import psycopg
+from psycopg_pool import ConnectionPool
+import perf
 
-@st.cache_resource(show_spinner=False)
-def get_conn():
-    dsn = st.secrets.get("POSTGRES_DSN")
+# No Streamlit and no pandas at import time: the worker, cron and cli.py load this
+# module too. pandas is imported inside the functions that build DataFrames.
+#
+# Settings are read from st.secrets when running inside the Streamlit app, otherwise
+# from the same secrets.toml files (./.streamlit/, ~/.streamlit/), then the environment.
+#
+# Pool size / health settings (secrets or env):
+#   DB_POOL_MIN (default 1), DB_POOL_MAX (default 10), DB_POOL_TIMEOUT seconds to wait for a free connection (30)
+# Query cache (fetch_df):
+#   DB_CACHE_ENTRIES (default 256), DB_CACHE_MB (default 128), DB_CACHE_TTL seconds (default 60, 0 = no TTL)
+
+
+@functools.lru_cache(maxsize=1)
+def _toml_secrets() -> dict:
+    out = {}
+    for path in (os.path.expanduser("~/.streamlit/secrets.toml"), os.path.join(".streamlit", "secrets.toml")):
+        try:
+            with open(path, "rb") as f:
+                out.update(tomllib.load(f))  # project file wins, as in Streamlit
+        except (OSError, tomllib.TOMLDecodeError):
+            pass
+    return out
+
+
+def _secret(name, default=None):
+    st = sys.modules.get("streamlit")  # only when the app already imported it
+    try:
+        v = st.secrets.get(name) if st is not None else _toml_secrets().get(name)
+    except Exception:  # no secrets.toml
+        v = None
+    return v if v not in (None, "") else os.environ.get(name, default)
+
+
+def _normalize_dsn(dsn: str) -> str:
+    """
+    Make Supabase DSN safe for psycopg3:
+      - remove unsupported URI query params (e.g. prepare_threshold)
+      - ensure sslmode=require exists
+    Works for both URI and key/value DSN.
+    """
+    dsn = dsn.strip()
+
+    # Key/value style (host=... port=... dbname=...):
+    if "://" not in dsn and "host=" in dsn:
+        # ensure sslmode=require
+        if "sslmode=" not in dsn:
+            dsn += " sslmode=require"
+        # remove prepare_threshold if present
+        parts = dsn.split()
+        parts = [p for p in parts if not p.startswith("prepare_threshold=")]
+        return " ".join(parts)
+
+    # URI style
+    if "://" in dsn:
+        parsed = _url.urlsplit(dsn)
+        q = _url.parse_qs(parsed.query, keep_blank_values=True)
+
+        # drop unsupported params
+        q.pop("prepare_threshold", None)
+
+        # ensure sslmode=require
+        if "sslmode" not in q:
+            q["sslmode"] = ["require"]
+
+        new_query = _url.urlencode(q, doseq=True)
+        dsn = _url.urlunsplit((parsed.scheme, parsed.netloc, parsed.path, new_query, parsed.fragment))
+        return dsn
+
+    return dsn
+
+
+# ---------- Table-versioned query cache ----------
+# fetch_df results are cached under (sql, params, generation of every table the
+# query reads). Every write statement executed on a pooled connection bumps the
+# generation of the tables it writes — through a cursor hook, so raw cursors
+# (COPY, fifo.py) are covered too — and bumps them again when the connection is
+# returned to the pool, i.e. after its transaction committed. A procedure call
+# such as `select run_month(%s)` has unknown targets and bumps everything.
+# The TTL bounds staleness from writers in other processes (worker, cron).
+
+_ALL = "*"
+_WRITE_RE = re.compile(
+    r"\b(?:insert\s+into|update|delete\s+from|truncate(?:\s+table)?|copy|merge\s+into"
+    r"|(?:alter|drop)\s+table(?:\s+if\s+exists)?"
+    r"|create\s+(?:temp(?:orary)?\s+)?table(?:\s+if\s+not\s+exists)?"
+    r"|create\s+(?:unique\s+)?index(?:\s+concurrently)?(?:\s+if\s+not\s+exists)?\s+\w+\s+on)\s+([\w.]+)",
+    re.I,
+)
+_READ_RE = re.compile(r"\b(?:from|join)\s+([\w.]+)", re.I)
+_CALL_RE = re.compile(r"^\s*select\s+[\w.]+\s*\(", re.I)
+
+_lock = threading.Lock()
+_gen: dict[str, int] = {}
+_touched: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_cache: OrderedDict = OrderedDict()
+_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+
+def _write_tables(sql) -> set | None:
+    """Tables a statement writes ({_ALL} for procedure calls), or None for a plain read."""
+    if not isinstance(sql, str):
+        return {_ALL}
+    tables = {t.lower() for t in _WRITE_RE.findall(sql)} - {"set"}
+    if tables:
+        return tables
+    if _CALL_RE.match(sql) and not _READ_RE.search(sql):
+        return {_ALL}
+    return None
+
+
+def invalidate(*tables):
+    """Bump the generation of `tables` (no args: everything)."""
+    with _lock:
+        for t in (tables or (_ALL,)):
+            _gen[t] = _gen.get(t, 0) + 1
+
+
+def _note_write(conn, sql):
+    tables = _write_tables(sql)
+    if tables is None:
+        return
+    invalidate(*tables)
+    with _lock:
+        _touched.setdefault(conn, set()).update(tables)
+
+
+def _on_return(conn):
+    """Pool reset hook: the connection's writes are committed now — bump again."""
+    with _lock:
+        tables = _touched.pop(conn, set())
+    if tables:
+        invalidate(*tables)
+
+
+class _TrackingCursor(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        _note_write(self.connection, query)
+        return super().execute(query, params, **kwargs)
+
+    def executemany(self, query, params_seq, **kwargs):
+        _note_write(self.connection, query)
+        return super().executemany(query, params_seq, **kwargs)
+
+    def copy(self, statement, params=None, **kwargs):
+        _note_write(self.connection, statement)
+        return super().copy(statement, params, **kwargs)
+
+
+def _cache_key(sql, params):
+    tables = sorted({t.lower() for t in _READ_RE.findall(sql)})
+    with _lock:
+        gens = tuple(_gen.get(t, 0) for t in tables) + (_gen.get(_ALL, 0),)
+    return (sql, repr(params), gens)
+
+
+def _cache_get(key):
+    ttl = float(_secret("DB_CACHE_TTL", 60))
+    with _lock:
+        hit = _cache.get(key)
+        if hit is not None and (ttl <= 0 or time.monotonic() - hit[1] < ttl):
+            _cache.move_to_end(key)
+            _stats["hits"] += 1
+            return hit[0].copy()
+        _stats["misses"] += 1
+    return None
+
+
+def _cache_put(key, df):
+    size = int(df.memory_usage(deep=True).sum())
+    max_entries = int(_secret("DB_CACHE_ENTRIES", 256))
+    max_bytes = float(_secret("DB_CACHE_MB", 128)) * 1024 * 1024
+    if size > max_bytes:
+        return
+    with _lock:
+        old = _cache.pop(key, None)
+        if old is not None:
+            _stats["bytes"] -= old[2]
+        _cache[key] = (df.copy(), time.monotonic(), size)
+        _stats["bytes"] += size
+        while len(_cache) > max_entries or _stats["bytes"] > max_bytes:
+            _, (_, _, sz) = _cache.popitem(last=False)
+            _stats["bytes"] -= sz
+            _stats["evictions"] += 1
+
+
+def cache_stats() -> dict:
+    with _lock:
+        total = _stats["hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "entries": len(_cache),
+            "hit_rate": round(_stats["hits"] / total, 3) if total else 0.0,
+            "mb": round(_stats["bytes"] / 1024 / 1024, 2),
+        }
+
+
+def cache_clear():
+    with _lock:
+        _cache.clear()
+        _stats.update(hits=0, misses=0, evictions=0, bytes=0)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    One pool per process; every read/write checks a connection out for its own
+    duration, so concurrent sessions no longer queue behind a single connection.
+    Connections are health-checked on checkout and replaced if broken.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _open_pool()
+    return _pool
+
+
+def _open_pool() -> ConnectionPool:
+    dsn = _secret("DB_DSN") or _secret("POSTGRES_DSN")
     if not dsn:
-        raise RuntimeError("Missing POSTGRES_DSN in Streamlit secrets")
-    return psycopg2.connect(dsn)
+        raise RuntimeError(
+            "Missing DB_DSN. Paste your Supabase connection string into "
+            "Streamlit → Settings → Secrets as DB_DSN (or set the DB_DSN env var)."
+        )
+    return ConnectionPool(
+        _normalize_dsn(dsn),
+        min_size=int(_secret("DB_POOL_MIN", 1)),
+        max_size=int(_secret("DB_POOL_MAX", 10)),
+        timeout=float(_secret("DB_POOL_TIMEOUT", 30)),
+        # Critical: disable prepared statements in code to work with pooler
+        kwargs={"autocommit": True, "prepare_threshold": None, "cursor_factory": _TrackingCursor},
+        check=ConnectionPool.check_connection,
+        reset=_on_return,
+        name="amazon-fifo",
+    )
+
+
+@contextlib.contextmanager
+def connection(conn=None):
+    """Check out a pooled connection (or reuse `conn` when the caller already holds one)."""
+    if conn is not None:
+        yield conn
+        return
+    with get_pool().connection() as c:
+        yield c
 
-def fetch_df(sql, params=None):
+
+@contextlib.contextmanager
+def pipeline():
+    """
+    One connection, one transaction — for saves that issue several statements.
+    Not psycopg pipeline mode: merge() and delete_keys() COPY, which it refuses.
+    """
+    with get_pool().connection() as conn, conn.transaction():
+        yield conn
+
+
+def _retry_once(fn):
+    """Retry a read once on a dropped connection; the pool hands out a fresh one."""
+    try:
+        return fn()
+    except psycopg.OperationalError:
+        get_pool().check()
+        return fn()
+
+
+def fetch_df(sql, params=None, conn=None):
+    """
+    Query -> DataFrame. Without `conn` the result is served from the query cache
+    until a table it reads is written; with `conn` (inside a caller's transaction)
+    it always hits the database.
+    """
+    import pandas as pd
+
+    def run():
+        with perf.timed("fetch_df", sql) as t, connection(conn) as c, c.cursor() as cur:
+            cur.execute(sql, params or ())
+            cols = [d[0] for d in cur.description] if cur.description else []
+            rows = cur.fetchall() if cur.description else []
+            t["rows"] = len(rows)
+        return pd.DataFrame(rows, columns=cols)
+
+    if conn is not None:
+        return run()
+    key = _cache_key(sql, params)
+    df = _cache_get(key)
+    if df is None:
+        df = _retry_once(run)
+        _cache_put(key, df)
+    return df
+
+
+# ---------- Typed bulk read ----------
+# fetch_frame() streams `COPY (query) TO STDOUT` as CSV straight into pandas' C parser,
+# typed from the query's result description: no Python tuple per row. Low-cardinality
+# key columns come back categorical and integers are downcast; floats stay float64
+# (costs). Results share fetch_df's table-versioned cache.
+
+CATEGORY_COLS = ("internal_sku", "batch_id", "marketplace", "category")
+
+_INT_OIDS = {20, 21, 23}                 # int8, int2, int4
+_FLOAT_OIDS = {700, 701, 1700}           # float4, float8, numeric
+_BOOL_OIDS = {16}
+_DATE_OIDS = {1082, 1114}                # date, timestamp
+_TZ_OIDS = {1184}                        # timestamptz
+
+
+class _CopyStream(io.RawIOBase):
+    """File-like view of a COPY TO STDOUT, so read_csv pulls blocks as it parses."""
+
+    def __init__(self, copy):
+        self._copy, self._buf = copy, b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            block = self._copy.read()
+            if not block:
+                return 0
+            self._buf = bytes(block)
+        n = min(len(b), len(self._buf))
+        b[:n], self._buf = self._buf[:n], self._buf[n:]
+        return n
+
+
+def _downcast_int(s):
+    import numpy as np
+    import pandas as pd
+    if not s.isna().any():
+        return pd.to_numeric(s, downcast="integer")
+    lo, hi = s.min(), s.max()
+    for t in ("Int8", "Int16", "Int32"):
+        info = np.iinfo(t.lower())
+        if info.min <= lo and hi <= info.max:
+            return s.astype(t)
+    return s
+
+
+def fetch_frame(sql, params=None, conn=None, categories=CATEGORY_COLS, downcast=True):
+    """
+    Query -> typed DataFrame via COPY, for large reads. Text columns named in
+    `categories` become categorical; with `downcast` integer columns get the smallest
+    dtype that holds them (nullable Int* when there are NULLs). Cached like fetch_df.
+    """
     import pandas as pd
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute(sql, params or ())
-        cols = [d[0] for d in cur.description]
-        rows = cur.fetchall()
-    return pd.DataFrame(rows, columns=cols)
 
-def exec_sql(sql, params=None):
-    with get_conn() as conn, conn.cursor() as cur:
+    def run():
+        with perf.timed("fetch_frame", sql) as t, connection(conn) as c, c.cursor() as cur:
+            query = psycopg.ClientCursor(c).mogrify(sql, params) if params else sql
+            cur.execute(f"select * from ({query}) q limit 0")
+            desc = [(d.name, d.type_code) for d in cur.description]
+            cols = [n for n, _ in desc]
+            dtypes = {n: "Int64" if oid in _INT_OIDS else "float64" if oid in _FLOAT_OIDS else "str"
+                      for n, oid in desc if oid not in _DATE_OIDS | _TZ_OIDS | _BOOL_OIDS}
+            with cur.copy(f"copy ({query}) to stdout (format csv, null '\\N')") as cp:
+                df = pd.read_csv(_CopyStream(cp), header=None, names=cols, dtype=dtypes,
+                                 na_values=["\\N"], keep_default_na=False)
+            t["rows"] = len(df)
+        for name, oid in desc:
+            col = df[name]
+            if oid in _TZ_OIDS:
+                df[name] = pd.to_datetime(col, utc=True, format="ISO8601")
+            elif oid in _DATE_OIDS:
+                df[name] = pd.to_datetime(col, format="ISO8601")
+            elif oid in _BOOL_OIDS:
+                df[name] = col.map({"t": True, "f": False}).astype("boolean")
+            elif name in categories and col.dtype == object:
+                df[name] = col.astype("category")
+            elif downcast and oid in _INT_OIDS:
+                df[name] = _downcast_int(col)
+        return df
+
+    if conn is not None:
+        return run()
+    key = _cache_key(sql, params) + ("frame", tuple(categories), downcast)
+    df = _cache_get(key)
+    if df is None:
+        df = _retry_once(run)
+        _cache_put(key, df)
+    return df
+
+
+def exec_sql(sql, params=None, conn=None):
+    with perf.timed("exec_sql", sql) as t, connection(conn) as c, c.cursor() as cur:
         cur.execute(sql, params or ())
+        t["rows"] = cur.rowcount
+
 
-def bulk_upsert(table, cols, rows, conflict_cols):
+def exec_many(sql, rows, conn=None):
     if not rows:
-        return 0
-    col_list = ",".join(cols)
-    update_set = ",".join([f"{c}=EXCLUDED.{c}" for c in cols if c not in conflict_cols])
+        return
+    with perf.timed("exec_many", sql) as t, connection(conn) as c, c.cursor() as cur:
+        cur.executemany(sql, rows)
+        t["rows"] = cur.rowcount if cur.rowcount >= 0 else len(rows)
+
+
+def copy_df(cur, table, df):
+    """COPY a DataFrame into `table` (columns by name) as CSV; NaN/None -> NULL."""
+    if df.empty:
+        return
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    cols = ",".join(df.columns)
+    with cur.copy(f"copy {table} ({cols}) from stdin (format csv)") as cp:
+        cp.write(buf.getvalue())
+
+
+# ---------- Bulk merge ----------
+# Every upsert goes through merge(): COPY the rows into a temp stage created from the
+# target's own columns (so Postgres types each value on the way in), then a single
+# INSERT ... SELECT ... ON CONFLICT DO UPDATE. Rows that would not change are skipped
+# (no dead tuples); xmax = 0 on a returned row means it was inserted, not updated.
+
+def _copy_frame(df):
+    """Float columns holding only whole numbers (ints widened by NaN) -> nullable Int64, so COPY writes `3`, not `3.0`."""
+    out = df.copy()
+    for c in out.columns:
+        col = out[c]
+        if col.dtype.kind == "f" and col.notna().any() and (col.dropna() % 1 == 0).all():
+            out[c] = col.astype("Int64")
+    return out
+
+
+def merge(table, df, key_cols, update_cols=None, conn=None) -> dict:
+    """
+    Upsert DataFrame `df` into `table` on `key_cols` (a unique constraint). `update_cols`
+    are overwritten on conflict: default every non-key column of df, [] inserts only.
+    Duplicate keys in df keep the last row. Runs in the caller's transaction when there is one.
+    -> {"rows", "inserted", "updated", "unchanged", "seconds", "rows_per_s"}
+    """
+    t0 = time.perf_counter()
+    cols = list(df.columns)
+    update_cols = [c for c in (cols if update_cols is None else update_cols) if c not in key_cols]
+    df = df.drop_duplicates(key_cols, keep="last")
+    report = {"rows": len(df), "inserted": 0, "updated": 0, "unchanged": 0}
+    if df.empty:
+        return {**report, "seconds": 0.0, "rows_per_s": 0}
+
+    col_list = ", ".join(cols)
+    if update_cols:
+        action = (
+            "do update set " + ", ".join(f"{c} = excluded.{c}" for c in update_cols)
+            + f" where ({', '.join('t.' + c for c in update_cols)}) is distinct from"
+            + f" ({', '.join('excluded.' + c for c in update_cols)})"
+        )
+    else:
+        action = "do nothing"
     sql = f"""
-    insert into {table} ({col_list}) values %s
-    on conflict ({",".join(conflict_cols)}) do update
-    set {update_set};
+        with m as (
+            insert into {table} as t ({col_list})
+            select {col_list} from _merge_stage
+            on conflict ({", ".join(key_cols)}) {action}
+            returning (t.xmax = 0) as inserted
+        )
+        select count(*) filter (where inserted), count(*) filter (where not inserted) from m
     """
-    with get_conn() as conn, conn.cursor() as cur:
-        execute_values(cur, sql, rows)
-    return len(rows)
+    with perf.timed("merge", sql) as t, connection(conn) as c, c.transaction(), c.cursor() as cur:
+        cur.execute("drop table if exists _merge_stage")
+        cur.execute(f"create temp table _merge_stage on commit drop as select {col_list} from {table} limit 0")
+        copy_df(cur, "_merge_stage", _copy_frame(df))
+        cur.execute(sql)
+        report["inserted"], report["updated"] = cur.fetchone()
+        t["rows"] = len(df)
+    report["unchanged"] = report["rows"] - report["inserted"] - report["updated"]
+    seconds = time.perf_counter() - t0
+    return {**report, "seconds": round(seconds, 4), "rows_per_s": round(len(df) / seconds) if seconds > 0 else 0}
+
+
+def bulk_upsert(table, cols, rows, conflict_cols, conn=None) -> dict:
+    """merge() for row tuples in `cols` order."""
+    import pandas as pd
+    return merge(table, pd.DataFrame(list(rows), columns=cols), conflict_cols, conn=conn)
+
+
+def upsert(table, rows, on_conflict) -> dict:
+    """merge() for a list of dicts (all dicts share the first row's keys)."""
+    import pandas as pd
+    if not rows:
+        return merge(table, pd.DataFrame(columns=on_conflict), on_conflict)
+    return merge(table, pd.DataFrame(rows, columns=list(rows[0].keys())), on_conflict)
+
+
+def delete_keys(table, key_cols, keys, conn=None):
+    """Delete rows by key (tuples in key_cols order): COPY the keys to a stage, one DELETE ... USING."""
+    if not keys:
+        return 0
+    import pandas as pd
+    df = pd.DataFrame(list(keys), columns=key_cols).drop_duplicates()
+    cols = ", ".join(key_cols)
+    sql = f"delete from {table} t using _delete_stage s where " + " and ".join(f"t.{c} = s.{c}" for c in key_cols)
+    with perf.timed("delete_keys", sql) as t, connection(conn) as c, c.transaction(), c.cursor() as cur:
+        cur.execute("drop table if exists _delete_stage")
+        cur.execute(f"create temp table _delete_stage on commit drop as select {cols} from {table} limit 0")
+        copy_df(cur, "_delete_stage", _copy_frame(df))
+        cur.execute(sql)
+        t["rows"] = cur.rowcount
+    return t["rows"]
@@ -0,0 +1,986 @@
+# fifo.py — in-process FIFO allocation engine
+# -----------------------------------------------
+# Python alternative to the server-side `run_month` function:
+#   1) pull lot_balance (+ batch.arrived_at, lot cost) and the month's mapped demand in bulk
+#   2) consume lots per internal_sku in arrived_at order with NumPy cumsum/searchsorted
+#      (a lot is only offered from the month it arrives in: allocate_month)
+#   3) write allocations + updated balances + month_summary back in one transaction
+#
+# `reconcile()` runs both paths on the same starting state inside a rolled-back
+# transaction and reports the differences, so we can switch over safely.
+#
+# Unit cost per lot is read from `lot_cost` (written by rebuild_lot_costs),
+# falling back to inbound_items.fob_unit when a lot has no cost row yet.
+#
+# Amazon SKUs resolve to internal units through `sku_resolve`, a flat copy of
+# sku_map + kit_bom kept current by mapping_changed(); demand is one join against it.
+#
+# FIFO is independent per internal_sku, so large months can be split into SKU-hash
+# shards and allocated on a process pool (FIFO_WORKERS, FIFO_SHARD_MIN_ROWS).
+# run_range() / range_stages() backfill a span of months carrying lots in memory
+# (FIFO_RANGE_FLUSH_MONTHS).
+#
+# Every write of fifo_alloc also rewrites those months' consumption events in the
+# movement ledger (ledger.py), which answers point-in-time inventory queries, and
+# re-aggregates their cells of the sales / COGS rollup (rollup.py).
+
+import os
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import psycopg
+
+from db import connection, fetch_df, fetch_frame, copy_df
+import ledger
+import rollup
+import perf
+import snapshots
+
+ALLOC_DDL = """
+create table if not exists fifo_alloc (
+  ym           text        not null,
+  order_id     text        not null,
+  date_time    text,
+  marketplace  text,
+  amazon_sku   text        not null,
+  internal_sku text        not null,
+  batch_id     text,                 -- null = shortfall (no stock left for this demand)
+  qty          integer     not null,
+  unit_cost    numeric
+);
+create index if not exists fifo_alloc_ym_sku_idx on fifo_alloc(ym, internal_sku);
+"""
+
+# Incremental recompute: earliest affected date per SKU. Month-end lot states to
+# restart from are the delta-encoded snapshots in snapshots.py.
+DIRTY_DDL = """
+create table if not exists fifo_dirty (
+  internal_sku text primary key,
+  from_date    date        not null,
+  marked_at    timestamptz not null default now()
+);
+"""
+
+# Lots with no arrival date sort first in a replay window — use the epoch of the calendar.
+NO_DATE = "0001-01-01"
+
+ALLOC_COLS = [
+    "ym", "order_id", "date_time", "marketplace", "amazon_sku",
+    "internal_sku", "batch_id", "qty", "unit_cost",
+]
+
+LOTS_SQL = """
+    select lb.internal_sku,
+           lb.batch_id,
+           lb.qty_remaining,
+           b.arrived_at,
+           coalesce(lc.unit_cost, ii.fob_unit, 0) as unit_cost
+    from lot_balance lb
+    left join batch b          on b.batch_id = lb.batch_id
+    left join inbound_items ii on ii.batch_id = lb.batch_id and ii.internal_sku = lb.internal_sku
+    left join lot_cost lc      on lc.batch_id = lb.batch_id and lc.internal_sku = lb.internal_sku
+"""
+
+# (amazon_sku, marketplace) -> [(internal_sku, units_per_sale)], precomputed.
+RESOLVE_DDL = """
+create table if not exists sku_resolve (
+  amazon_sku     text    not null,
+  marketplace    text    not null,
+  internal_sku   text    not null,
+  units_per_sale integer not null,
+  source         text    not null,     -- kit | map
+  primary key (amazon_sku, marketplace, internal_sku)
+);
+create index if not exists sku_resolve_internal_idx on sku_resolve(internal_sku);
+"""
+
+# Kits explode through kit_bom; everything else maps 1:1 through sku_map.
+# %(all)s = true resolves every key, otherwise only the (%(skus_a)s, %(mkts)s) pairs.
+RESOLVE_SQL = """
+    with k as (
+        select * from unnest(%(skus_a)s::text[], %(mkts)s::text[]) as k(amazon_sku, marketplace)
+    )
+    select b.amazon_sku, b.marketplace, b.component_sku as internal_sku,
+           coalesce(b.component_qty, 1) as units_per_sale, 'kit' as source
+    from kit_bom b
+    where %(all)s or (b.amazon_sku, b.marketplace) in (select amazon_sku, marketplace from k)
+    union all
+    select m.amazon_sku, m.marketplace, m.internal_sku,
+           coalesce(m.unit_multiplier, 1), 'map'
+    from sku_map m
+    where coalesce(m.active, true)
+      and (%(all)s or (m.amazon_sku, m.marketplace) in (select amazon_sku, marketplace from k))
+      and not exists (
+        select 1 from kit_bom b
+        where b.amazon_sku = m.amazon_sku and b.marketplace = m.marketplace
+      )
+"""
+
+DEMAND_SQL = """
+    select s.ym, s.order_id, s.date_time, s.marketplace, s.amazon_sku,
+           r.internal_sku,
+           s.qty * r.units_per_sale as units
+    from sales_raw s
+    join sku_resolve r on r.amazon_sku = s.amazon_sku and r.marketplace = s.marketplace
+    where s.ym = any(%(yms)s) and s.qty > 0
+      and (%(skus)s::text[] is null or r.internal_sku = any(%(skus)s))
+"""
+
+UNMAPPED_SQL = """
+    select s.amazon_sku, s.marketplace, count(distinct s.order_id) as orders, sum(s.qty) as qty,
+           min(s.ym) as first_ym, max(s.ym) as last_ym
+    from sales_raw s
+    where (%(yms)s::text[] is null or s.ym = any(%(yms)s)) and s.qty > 0
+      and not exists (
+        select 1 from sku_resolve r
+        where r.amazon_sku = s.amazon_sku and r.marketplace = s.marketplace
+      )
+    group by s.amazon_sku, s.marketplace
+    order by qty desc
+"""
+
+
+# ---------- DB I/O ----------
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Create the engine's tables once per process (one statement per execute, pipeline-safe)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('sku_resolve') is null")
+        build_resolve = cur.fetchone()[0]
+        for stmt in (ALLOC_DDL + DIRTY_DDL + RESOLVE_DDL).split(";"):
+            if stmt.strip():
+                cur.execute(stmt)
+    _schema_ready = True
+    if build_resolve:
+        refresh_resolution(conn)
+
+
+def load_lots(conn) -> pd.DataFrame:
+    df = fetch_frame(LOTS_SQL, conn=conn)
+    if df.empty:
+        df = pd.DataFrame(columns=["internal_sku", "batch_id", "qty_remaining", "arrived_at", "unit_cost"])
+    df["qty_remaining"] = pd.to_numeric(df["qty_remaining"], errors="coerce").fillna(0).astype("int64")
+    df["unit_cost"] = pd.to_numeric(df["unit_cost"], errors="coerce").fillna(0.0).astype(float)
+    return df
+
+
+def refresh_resolution(conn, keys=None) -> int:
+    """
+    Rebuild sku_resolve for the (amazon_sku, marketplace) `keys`, or all of it when
+    keys is None. Returns the number of resolution rows written.
+    """
+    keys = None if keys is None else sorted({(str(a), str(m)) for a, m in keys})
+    if keys == []:
+        return 0
+    ensure_schema(conn)
+    params = {
+        "all": keys is None,
+        "skus_a": [k[0] for k in keys or []],
+        "mkts": [k[1] for k in keys or []],
+    }
+    with conn.transaction(), conn.cursor() as cur:
+        if keys is None:
+            cur.execute("truncate sku_resolve")
+        else:
+            cur.execute("""
+                delete from sku_resolve r
+                using unnest(%(skus_a)s::text[], %(mkts)s::text[]) as k(amazon_sku, marketplace)
+                where r.amazon_sku = k.amazon_sku and r.marketplace = k.marketplace
+            """, params)
+        cur.execute(f"""
+            insert into sku_resolve(amazon_sku, marketplace, internal_sku, units_per_sale, source)
+            {RESOLVE_SQL}
+        """, params)
+        return cur.rowcount
+
+
+def mapping_changed(conn, keys):
+    """
+    sku_map / kit_bom rows (amazon_sku, marketplace) were written or deleted: mark the
+    SKUs they used to resolve to dirty, re-resolve the keys, then mark the new targets.
+    """
+    keys = [(str(a), str(m)) for a, m in keys]
+    if not keys:
+        return
+    ensure_schema(conn)
+    mark_dirty_mapping(conn, keys)  # old targets
+    refresh_resolution(conn, keys)
+    mark_dirty_mapping(conn, keys)  # new targets
+
+
+def unmapped(conn=None, yms: str | list[str] | None = None) -> pd.DataFrame:
+    """Sold (amazon_sku, marketplace) pairs with no resolution; they are left out of demand."""
+    yms = [yms] if isinstance(yms, str) else (list(yms) if yms is not None else None)
+    with connection(conn) as c:
+        ensure_schema(c)  # the pages call this before anything has created sku_resolve
+    return fetch_df(UNMAPPED_SQL, {"yms": yms}, conn=conn)
+
+
+def load_demand(conn, yms: str | list[str], skus: list[str] | None = None) -> pd.DataFrame:
+    ensure_schema(conn)
+    yms = [yms] if isinstance(yms, str) else list(yms)
+    df = fetch_frame(DEMAND_SQL, {"yms": yms, "skus": list(skus) if skus is not None else None}, conn=conn)
+    if df.empty:
+        df = pd.DataFrame(columns=["ym", "order_id", "date_time", "marketplace", "amazon_sku", "internal_sku", "units"])
+    df["units"] = pd.to_numeric(df["units"], errors="coerce").fillna(0).astype("int64")
+    return df
+
+
+def _restore_prior_run(conn, lots: pd.DataFrame, yms: str | list[str]) -> pd.DataFrame:
+    """
+    Re-running months the engine already processed: give back what those runs
+    consumed so the first of them starts again from its opening balance.
+    """
+    yms = [yms] if isinstance(yms, str) else list(yms)
+    prior = fetch_df("""
+        select internal_sku, batch_id, sum(qty) as qty
+        from fifo_alloc
+        where ym = any(%s) and batch_id is not null
+        group by internal_sku, batch_id
+    """, (yms,), conn=conn)
+    if prior.empty:
+        return lots
+    prior["qty"] = pd.to_numeric(prior["qty"]).astype("int64")
+    lots = lots.merge(prior, on=["internal_sku", "batch_id"], how="left")
+    lots["qty_remaining"] = lots["qty_remaining"] + lots.pop("qty").fillna(0).astype("int64")
+    return lots
+
+
+# ---------- Core allocation (pure, vectorized) ----------
+def _group_cumsum(values: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """Cumulative sum restarting at every new code (codes must be sorted)."""
+    cs = np.cumsum(values)
+    first = np.searchsorted(codes, codes, side="left")
+    return cs - (cs - values)[first]
+
+
+def allocate(lots: pd.DataFrame, demand: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    FIFO-consume `lots` (internal_sku, batch_id, qty_remaining, arrived_at, unit_cost)
+    with `demand` (order_id, date_time, marketplace, amazon_sku, internal_sku, units).
+
+    Every SKU gets its own block on one global number line; inside the block lots
+    and demand lines are laid out as cumulative intervals. Each overlap between a
+    demand interval and a lot interval is one allocation, found with searchsorted
+    over the union of interval boundaries — no per-row Python loop.
+
+    Returns (alloc, lots_after); lots_after carries a `consumed` column.
+    Demand beyond available stock is returned as allocation rows with
+    batch_id = None (shortfall).
+    """
+    alloc_cols = ["order_id", "date_time", "marketplace", "amazon_sku", "internal_sku", "batch_id", "qty", "unit_cost"]
+    if demand.empty:
+        lots = lots.sort_values(["internal_sku", "arrived_at", "batch_id"], na_position="last", kind="stable")
+        return pd.DataFrame(columns=alloc_cols), lots.reset_index(drop=True).assign(consumed=0)
+
+    # Integer SKU codes (hash-based) — sorting/searching on codes, not strings.
+    skus = np.sort(pd.unique(np.concatenate([
+        lots["internal_sku"].astype(str).to_numpy(), demand["internal_sku"].astype(str).to_numpy()
+    ])))
+    lots = lots.assign(_code=pd.Categorical(lots["internal_sku"].astype(str), categories=skus).codes)
+    lots = lots.sort_values(["_code", "arrived_at", "batch_id"], na_position="last", kind="stable").reset_index(drop=True)
+    demand = demand.assign(
+        _code=pd.Categorical(demand["internal_sku"].astype(str), categories=skus).codes,
+        _ts=pd.to_datetime(demand["date_time"], errors="coerce", format="mixed"),
+    )
+    demand = demand.sort_values(["_code", "_ts", "order_id"], na_position="last", kind="stable").reset_index(drop=True)
+    lot_code = lots.pop("_code").to_numpy(dtype=np.int64)
+    dem_code = demand.pop("_code").to_numpy(dtype=np.int64)
+    demand = demand.drop(columns="_ts")
+
+    lot_qty = np.clip(lots["qty_remaining"].to_numpy(dtype=np.int64), 0, None)
+    dem_qty = np.clip(demand["units"].to_numpy(dtype=np.int64), 0, None)
+
+    supply = np.zeros(len(skus), dtype=np.int64)
+    need = np.zeros(len(skus), dtype=np.int64)
+    np.add.at(supply, lot_code, lot_qty)
+    np.add.at(need, dem_code, dem_qty)
+    span = np.maximum(supply, need)
+    base = np.concatenate([[0], np.cumsum(span)[:-1]]).astype(np.int64)
+
+    lot_end = base[lot_code] + _group_cumsum(lot_qty, lot_code)
+    lot_start = lot_end - lot_qty
+    dem_end = base[dem_code] + _group_cumsum(dem_qty, dem_code)
+    dem_start = dem_end - dem_qty
+
+    points = np.unique(np.concatenate([lot_start, lot_end, dem_start, dem_end]))
+    seg_a, seg_b = points[:-1], points[1:]
+
+    li = np.searchsorted(lot_end, seg_a, side="right")
+    di = np.searchsorted(dem_end, seg_a, side="right")
+    in_dem = di < len(dem_end)
+    in_dem[in_dem] &= dem_start[di[in_dem]] <= seg_a[in_dem]
+    in_lot = li < len(lot_end)
+    in_lot[in_lot] &= lot_start[li[in_lot]] <= seg_a[in_lot]
+
+    keep = in_dem
+    seg_qty = (seg_b - seg_a)[keep]
+    seg_dem = di[keep]
+    seg_lot = np.where(in_lot[keep], li[keep], len(lots))  # len(lots) = shortfall, sorts last
+
+    # Consecutive segments of the same (demand, lot) pair collapse into one row.
+    pairs = pd.DataFrame({"d": seg_dem, "l": seg_lot, "qty": seg_qty})
+    pairs = pairs.groupby(["d", "l"], sort=True, as_index=False)["qty"].sum()
+
+    d = pairs["d"].to_numpy()
+    l = pairs["l"].to_numpy()
+    has_lot = l < len(lots)
+    alloc = demand.iloc[d][["order_id", "date_time", "marketplace", "amazon_sku", "internal_sku"]].reset_index(drop=True)
+    batch_id = np.full(len(pairs), None, dtype=object)
+    batch_id[has_lot] = lots["batch_id"].to_numpy(dtype=object)[l[has_lot]]
+    unit_cost = np.full(len(pairs), np.nan)
+    unit_cost[has_lot] = lots["unit_cost"].to_numpy(dtype=float)[l[has_lot]]
+    alloc["batch_id"] = batch_id
+    alloc["qty"] = pairs["qty"].to_numpy(dtype=np.int64)
+    alloc["unit_cost"] = unit_cost
+
+    consumed = np.zeros(len(lots), dtype=np.int64)
+    np.add.at(consumed, l[has_lot], pairs["qty"].to_numpy(dtype=np.int64)[has_lot])
+    lots_after = lots.copy()
+    lots_after["qty_remaining"] = lots["qty_remaining"].to_numpy(dtype=np.int64) - consumed
+    lots_after["consumed"] = consumed
+    return alloc[alloc_cols], lots_after
+
+
+# ---------- Sharded allocation (process pool) ----------
+def _shard_of(skus: pd.Series, n: int) -> np.ndarray:
+    """Stable SKU -> shard assignment (crc32, identical across processes and runs)."""
+    codes, uniq = pd.factorize(skus.astype(str))
+    shard = np.array([zlib.crc32(u.encode()) % n for u in uniq], dtype=np.int64)
+    return shard[codes] if len(codes) else np.zeros(0, dtype=np.int64)
+
+
+def _allocate_shard(args):
+    return allocate(*args)
+
+
+def default_workers() -> int:
+    return max(1, int(os.environ.get("FIFO_WORKERS", 1)))
+
+
+def allocate_sharded(lots: pd.DataFrame, demand: pd.DataFrame, workers: int | None = None):
+    """
+    allocate() split by SKU hash over a process pool. SKUs never span shards, so
+    results are merged by a stable sort on internal_sku and come out identical to
+    the single-process run. Months smaller than FIFO_SHARD_MIN_ROWS demand lines
+    stay in-process (spawning workers costs more than it saves).
+    """
+    workers = workers or default_workers()
+    if workers <= 1 or len(demand) < int(os.environ.get("FIFO_SHARD_MIN_ROWS", 200_000)):
+        return allocate(lots, demand)
+
+    lot_shard = _shard_of(lots["internal_sku"], workers)
+    dem_shard = _shard_of(demand["internal_sku"], workers)
+    tasks = [(lots[lot_shard == i], demand[dem_shard == i]) for i in range(workers)]
+    # spawn: the parent holds DB pool threads, which must not be forked
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as ex:
+        parts = list(ex.map(_allocate_shard, tasks))
+
+    alloc = pd.concat([p[0] for p in parts], ignore_index=True)
+    lots_after = pd.concat([p[1] for p in parts], ignore_index=True)
+    alloc = alloc.sort_values("internal_sku", kind="stable").reset_index(drop=True)
+    lots_after = lots_after.sort_values("internal_sku", kind="stable").reset_index(drop=True)
+    return alloc, lots_after
+
+
+def _split_arrivals(lots: pd.DataFrame, ym: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """(lots received by the end of `ym`, lots arriving after it); undated lots count as received."""
+    end = (pd.Period(ym, "M") + 1).to_timestamp()
+    arrived = pd.to_datetime(lots["arrived_at"], errors="coerce")
+    if arrived.dt.tz is not None:
+        arrived = arrived.dt.tz_localize(None)
+    later = (arrived >= end).to_numpy()
+    return lots[~later], lots[later]
+
+
+def allocate_month(lots: pd.DataFrame, demand: pd.DataFrame, ym: str, workers: int | None = None):
+    """
+    allocate_sharded() for month `ym`, offering only the lots that had arrived by its end.
+    Lots arriving later come back untouched (consumed = 0) in lots_after, so a replay can
+    carry the whole lot state from month to month and each lot joins in its arrival month.
+    """
+    on_hand, later = _split_arrivals(lots, ym)
+    alloc, lots_after = allocate_sharded(on_hand, demand, workers)
+    if later.empty:
+        return alloc, lots_after
+    return alloc, pd.concat([lots_after, later.assign(consumed=0)], ignore_index=True)
+
+
+def summarize(alloc: pd.DataFrame) -> dict:
+    """month_summary figures for one month's allocations."""
+    cogs = (alloc["qty"] * alloc["unit_cost"].fillna(0)).sum() if not alloc.empty else 0.0
+    return {
+        "orders": int(alloc["order_id"].nunique()) if not alloc.empty else 0,
+        "units": int(alloc["qty"].sum()) if not alloc.empty else 0,
+        "cogs": round(float(cogs), 4),
+        "shortfall_units": int(alloc.loc[alloc["batch_id"].isna(), "qty"].sum()) if not alloc.empty else 0,
+    }
+
+
+# ---------- Month run ----------
+def _sql_run_months(conn, yms: str | list[str]) -> list[str]:
+    """
+    Months whose demand lot_balance already consumed without fifo_alloc rows to give it
+    back: month_summary has units but fifo_alloc has none, or the SQL engine ran it last.
+    """
+    yms = [yms] if isinstance(yms, str) else list(yms)
+    rollup.ensure_schema(conn)
+    return fetch_df("""
+        select m.ym from month_summary m
+        where m.ym = any(%s)
+          and (exists (select 1 from rollup_uncovered u where u.ym = m.ym)
+               or (coalesce(m.units, 0) > 0 and not exists (select 1 from fifo_alloc a where a.ym = m.ym)))
+        order by m.ym
+    """, (yms,), conn=conn)["ym"].tolist()
+
+
+def plan_month(conn, ym: str, workers: int | None = None) -> dict:
+    """
+    Compute the month in memory without writing anything. Refuses a month last run by
+    the SQL engine: its consumption cannot be given back (run_month restates it with run_range).
+    """
+    if _sql_run_months(conn, ym):
+        raise ValueError(f"{ym} was last run by the SQL engine; restate it with run_range({ym!r}, {ym!r})")
+    lots = _restore_prior_run(conn, load_lots(conn), ym)
+    demand = load_demand(conn, ym).drop(columns="ym")
+    with perf.stage("fifo.allocate"):
+        alloc, lots_after = allocate_month(lots, demand, ym, workers)
+    alloc.insert(0, "ym", ym)
+    # Lots touched either by this run or by the prior run being replaced.
+    prior = fetch_df(
+        "select distinct internal_sku, batch_id from fifo_alloc where ym = %s and batch_id is not null",
+        (ym,), conn=conn,
+    )
+    touched = lots_after[lots_after["consumed"] > 0]
+    if not prior.empty:
+        touched = pd.concat([touched, lots_after.merge(prior, on=["internal_sku", "batch_id"])]).drop_duplicates(
+            ["internal_sku", "batch_id"]
+        )
+    return {
+        "ym": ym,
+        "alloc": alloc,
+        "balances": touched[["internal_sku", "batch_id", "qty_remaining"]],
+        "lots_after": lots_after,
+        "summary": summarize(alloc),
+        "unmapped": unmapped(conn, ym),
+    }
+
+
+def _write_balances(cur, balances: pd.DataFrame, prune_skus: list[str] | None = None):
+    """
+    Set lot_balance.qty_remaining for the given lots (inserting lots not there yet).
+    `prune_skus`: `balances` holds every lot of these SKUs — delete their other rows
+    (lots whose inbound item or batch was deleted).
+    """
+    cur.execute("""
+        create temp table _fifo_bal on commit drop as
+        select internal_sku, batch_id, qty_remaining from lot_balance limit 0
+    """)
+    copy_df(cur, "_fifo_bal", balances[["internal_sku", "batch_id", "qty_remaining"]])
+    cur.execute("""
+        update lot_balance lb
+        set qty_remaining = t.qty_remaining
+        from _fifo_bal t
+        where lb.internal_sku = t.internal_sku
+          and lb.batch_id = t.batch_id
+          and lb.qty_remaining is distinct from t.qty_remaining
+    """)
+    cur.execute("""
+        insert into lot_balance(internal_sku, batch_id, qty_remaining)
+        select t.internal_sku, t.batch_id, t.qty_remaining
+        from _fifo_bal t
+        where not exists (
+          select 1 from lot_balance lb
+          where lb.internal_sku = t.internal_sku and lb.batch_id = t.batch_id
+        )
+    """)
+    if prune_skus:
+        cur.execute("""
+            delete from lot_balance lb
+            where lb.internal_sku = any(%s)
+              and not exists (
+                select 1 from _fifo_bal t
+                where t.internal_sku = lb.internal_sku and t.batch_id = lb.batch_id
+              )
+        """, (prune_skus,))
+
+
+def write_month(conn, plan: dict):
+    """Persist a plan: allocations, changed balances and month_summary in one transaction."""
+    ym = plan["ym"]
+    s = plan["summary"]
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute("delete from fifo_alloc where ym = %s", (ym,))
+        copy_df(cur, "fifo_alloc", plan["alloc"][ALLOC_COLS])
+
+        _write_balances(cur, plan["balances"])
+
+        cur.execute("""
+            insert into month_summary(ym, orders, units, cogs, updated_at)
+            values (%s, %s, %s, %s, now())
+            on conflict(ym) do update set
+              orders = excluded.orders,
+              units = excluded.units,
+              cogs = excluded.cogs,
+              updated_at = excluded.updated_at
+        """, (ym, s["orders"], s["units"], s["cogs"]))
+
+
+def run_month(conn, ym: str, workers: int | None = None) -> dict:
+    """
+    Python replacement for `select run_month(ym)` (FIFO + summarize; costs are rebuilt
+    by the caller). workers > 1 allocates SKU shards on a process pool.
+    """
+    ensure_schema(conn)
+    if _sql_run_months(conn, ym):
+        # Opens from the checkpoint before ym instead of lot_balance, and marks later months dirty.
+        (summary,) = run_range(conn, ym, ym, workers)
+        return {**summary, "unmapped_skus": len(unmapped(conn, ym))}
+    with perf.stage("fifo.plan"):
+        plan = plan_month(conn, ym, workers)
+    with perf.stage("fifo.write"):
+        write_month(conn, plan)
+    with perf.stage("fifo.ledger"):
+        ledger.refresh_fifo(conn, [ym], alloc=plan["alloc"])
+    with perf.stage("fifo.rollup"):
+        rollup.refresh(conn, [ym])
+    return {**plan["summary"], "unmapped_skus": len(plan["unmapped"])}
+
+
+# ---------- Range backfill ----------
+# Restating many months: the opening lots are loaded once and FIFO state stays in
+# memory from month to month. Every FIFO_RANGE_FLUSH_MONTHS months (default 3) the
+# allocations, month_summary rows, month-end checkpoints and current lot balances
+# are written in one transaction, so a failed backfill keeps what it flushed.
+
+def month_span(start_ym: str, end_ym: str) -> list[str]:
+    return [p.strftime("%Y-%m") for p in pd.period_range(start_ym, end_ym, freq="M")]
+
+
+def _range_opening(conn, months: list[str], workers: int | None = None) -> tuple[pd.DataFrame, str]:
+    """
+    Opening lots of months[0]: its previous checkpoint, else history start. With an older
+    checkpoint (or none), the processed months between it and months[0] are replayed in
+    memory — lot_balance already holds later months' consumption and months the SQL engine
+    ran leave no fifo_alloc to give back, so it is never a starting point.
+    """
+    prev = (pd.Period(months[0], "M") - 1).strftime("%Y-%m")
+    checkpoint_ym = snapshots.latest_before(conn, months[0])
+    if checkpoint_ym == prev:
+        return _opening_lots(conn, None, prev), f"checkpoint {prev}"
+    gap = fetch_df("""
+        select ym from month_summary
+        where ym < %s and (%s::text is null or ym > %s)
+        order by ym
+    """, (months[0], checkpoint_ym, checkpoint_ym), conn=conn)["ym"].tolist()
+    lots = _opening_lots(conn, None, checkpoint_ym)
+    source = f"checkpoint {checkpoint_ym}" if checkpoint_ym else "history start"
+    if not gap:
+        return lots, source
+    demand = load_demand(conn, gap)
+    for ym in gap:
+        with perf.stage("fifo.replay"):
+            _, lots = allocate_month(lots, demand[demand["ym"] == ym].drop(columns="ym"), ym, workers)
+        lots = lots.drop(columns="consumed")
+    return lots, f"{source}, replayed {gap[0]}..{gap[-1]}"
+
+
+def _write_summaries(cur, summaries: pd.DataFrame):
+    cur.execute("""
+        create temp table _fifo_sum on commit drop as
+        select ym, orders, units, cogs from month_summary limit 0
+    """)
+    copy_df(cur, "_fifo_sum", summaries[["ym", "orders", "units", "cogs"]])
+    cur.execute("""
+        insert into month_summary(ym, orders, units, cogs, updated_at)
+        select ym, orders, units, cogs, now() from _fifo_sum
+        on conflict(ym) do update set
+          orders = excluded.orders,
+          units = excluded.units,
+          cogs = excluded.cogs,
+          updated_at = excluded.updated_at
+    """)
+
+
+def _run_chunk(conn, state: dict, part: list[str], workers: int | None) -> list[dict]:
+    demand = load_demand(conn, part)
+    lots = state["lots"]
+    allocs, summaries, checkpoints = [], [], []
+    for ym in part:
+        with perf.stage("fifo.allocate"):
+            alloc, lots = allocate_month(lots, demand[demand["ym"] == ym].drop(columns="ym"), ym, workers)
+        lots = lots.drop(columns="consumed")
+        alloc.insert(0, "ym", ym)
+        allocs.append(alloc)
+        summaries.append({"ym": ym, **summarize(alloc)})
+        checkpoints.append((ym, lots[["internal_sku", "batch_id", "qty_remaining"]]))
+    state["lots"] = lots
+    pending = state["months"][state["months"].index(part[0]):]
+
+    alloc = pd.concat(allocs, ignore_index=True)[ALLOC_COLS]
+    with perf.stage("fifo.write"), conn.transaction(), conn.cursor() as cur:
+        # Every month not flushed yet was replayed from scratch: drop its old allocations too,
+        # so the database never holds allocations that the written balances already gave back.
+        cur.execute("delete from fifo_alloc where ym = any(%s)", (pending,))
+        copy_df(cur, "fifo_alloc", alloc)
+        _write_balances(cur, lots)
+        snapshots.write(conn, checkpoints)
+        _write_summaries(cur, pd.DataFrame(summaries))
+    with perf.stage("fifo.ledger"):
+        ledger.refresh_fifo(conn, pending, alloc=alloc)
+    with perf.stage("fifo.rollup"):
+        rollup.refresh(conn, pending)
+    if part[-1] == state["months"][-1]:
+        # Months after the range were allocated from the old history: replay them from our last checkpoint.
+        later = fetch_df("select 1 from month_summary where ym > %s limit 1", (part[-1],), conn=conn)
+        if not later.empty:
+            nxt = (pd.Period(part[-1], "M") + 1).strftime("%Y-%m-01")
+            mark_dirty(conn, lots["internal_sku"].unique().tolist(), nxt)
+    return summaries
+
+
+def range_stages(start_ym: str, end_ym: str, workers: int | None = None, flush_every: int | None = None):
+    """
+    Backfill start_ym..end_ym as (name, fn(conn)) stages that share the in-memory FIFO
+    state: one stage loads the opening lots, then one stage per flush_every months.
+    """
+    months = month_span(start_ym, end_ym)
+    if not months:
+        raise ValueError(f"Empty month range {start_ym}..{end_ym}")
+    flush_every = max(1, flush_every or int(os.environ.get("FIFO_RANGE_FLUSH_MONTHS", 3)))
+    state = {"months": months}
+
+    def open_range(conn):
+        ensure_schema(conn)
+        state["lots"], state["opening"] = _range_opening(conn, months, workers)
+        return {"lots": len(state["lots"]), "opening": state["opening"]}
+
+    def chunk(part):
+        return lambda conn: _run_chunk(conn, state, part, workers)
+
+    parts = [months[i:i + flush_every] for i in range(0, len(months), flush_every)]
+    return [("fifo.open", open_range)] + [
+        (f"fifo {p[0]}" if len(p) == 1 else f"fifo {p[0]}..{p[-1]}", chunk(p)) for p in parts
+    ]
+
+
+def run_range(conn, start_ym: str, end_ym: str, workers: int | None = None, flush_every: int | None = None):
+    """Backfill start_ym..end_ym in one call; returns the month summaries."""
+    summaries = []
+    for name, fn in range_stages(start_ym, end_ym, workers, flush_every):
+        with perf.stage(name):
+            out = fn(conn)
+        if isinstance(out, list):
+            summaries.extend(out)
+    return summaries
+
+
+# ---------- Incremental recompute ----------
+# Every write that can change FIFO history records (internal_sku, earliest date)
+# in fifo_dirty. recompute_dirty() replays only those SKUs, starting from the
+# last month-end snapshot strictly before the earliest dirty month, instead of
+# rebuild_lot_balance() replaying the whole catalog from day one.
+
+def mark_dirty(conn, skus, from_date):
+    """Record that `skus` must be replayed from `from_date` (keeps the earliest date)."""
+    skus = sorted({str(s) for s in skus if s is not None and str(s) != ""})
+    if not skus:
+        return
+    ensure_schema(conn)
+    with conn.cursor() as cur:
+        cur.execute("""
+            insert into fifo_dirty(internal_sku, from_date)
+            select unnest(%s::text[]), coalesce(%s::date, %s::date)
+            on conflict(internal_sku) do update set
+              from_date = least(fifo_dirty.from_date, excluded.from_date),
+              marked_at = now()
+        """, (skus, from_date, NO_DATE))
+
+
+def mark_dirty_inbound(conn, keys):
+    """Inbound rows (batch_id, internal_sku) changed: replay from the batch's arrival."""
+    keys = [(str(b), str(s)) for b, s in keys]
+    if not keys:
+        return
+    ensure_schema(conn)
+    with conn.cursor() as cur:
+        cur.execute("""
+            insert into fifo_dirty(internal_sku, from_date)
+            select k.internal_sku, min(coalesce(b.arrived_at, %s::date))
+            from unnest(%s::text[], %s::text[]) as k(batch_id, internal_sku)
+            left join batch b on b.batch_id = k.batch_id
+            group by k.internal_sku
+            on conflict(internal_sku) do update set
+              from_date = least(fifo_dirty.from_date, excluded.from_date),
+              marked_at = now()
+        """, (NO_DATE, [k[0] for k in keys], [k[1] for k in keys]))
+
+
+def mark_dirty_batches(conn, batch_ids):
+    """Batch header changed (e.g. arrived_at moved): all SKUs in those batches."""
+    batch_ids = [str(b) for b in batch_ids]
+    if not batch_ids:
+        return
+    ensure_schema(conn)
+    with conn.cursor() as cur:
+        cur.execute("""
+            insert into fifo_dirty(internal_sku, from_date)
+            select ii.internal_sku, min(coalesce(b.arrived_at, %s::date))
+            from inbound_items ii
+            left join batch b on b.batch_id = ii.batch_id
+            where ii.batch_id = any(%s)
+            group by ii.internal_sku
+            on conflict(internal_sku) do update set
+              from_date = least(fifo_dirty.from_date, excluded.from_date),
+              marked_at = now()
+        """, (NO_DATE, batch_ids))
+
+
+def mark_dirty_sales_rows(conn, rows):
+    """
+    Sales rows (amazon_sku, marketplace, date) written outside a month import: the internal
+    SKUs they resolve to in sku_resolve, from each key's earliest date.
+    """
+    rows = [(str(a), str(m), str(d)) for a, m, d in rows]
+    if not rows:
+        return
+    ensure_schema(conn)
+    with conn.cursor() as cur:
+        cur.execute("""
+            insert into fifo_dirty(internal_sku, from_date)
+            select r.internal_sku, min(k.from_date)
+            from unnest(%s::text[], %s::text[], %s::date[]) as k(amazon_sku, marketplace, from_date)
+            join sku_resolve r on r.amazon_sku = k.amazon_sku and r.marketplace = k.marketplace
+            group by r.internal_sku
+            on conflict(internal_sku) do update set
+              from_date = least(fifo_dirty.from_date, excluded.from_date),
+              marked_at = now()
+        """, ([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]))
+
+
+def mark_dirty_sales(conn, ym: str):
+    """A sales month was (re)imported: every internal SKU it maps to, from the 1st of that month."""
+    skus = load_demand(conn, ym)["internal_sku"].unique().tolist()
+    mark_dirty(conn, skus, f"{ym}-01")
+
+
+def mark_dirty_mapping(conn, keys):
+    """
+    The internal SKUs the (amazon_sku, marketplace) keys currently resolve to in
+    sku_resolve, from the first month with sales for them (see mapping_changed).
+    """
+    keys = [(str(a), str(m)) for a, m in keys]
+    if not keys:
+        return
+    ensure_schema(conn)
+    with conn.cursor() as cur:
+        cur.execute("""
+            with k as (
+                select * from unnest(%s::text[], %s::text[]) as k(amazon_sku, marketplace)
+            ), first_sale as (
+                select s.amazon_sku, s.marketplace, min(s.ym) as ym
+                from sales_raw s join k using (amazon_sku, marketplace)
+                group by s.amazon_sku, s.marketplace
+            ), targets as (
+                select r.internal_sku, f.ym
+                from sku_resolve r join first_sale f using (amazon_sku, marketplace)
+            )
+            insert into fifo_dirty(internal_sku, from_date)
+            select internal_sku, min(to_date(ym, 'YYYY-MM'))
+            from targets
+            group by internal_sku
+            on conflict(internal_sku) do update set
+              from_date = least(fifo_dirty.from_date, excluded.from_date),
+              marked_at = now()
+        """, ([k[0] for k in keys], [k[1] for k in keys]))
+
+
+def checkpoint_month(conn, ym: str) -> dict:
+    """Save the current lot_balance as the month-end checkpoint (snapshot) for `ym`."""
+    ensure_schema(conn)
+    return snapshots.snapshot_month(conn, ym)
+
+
+def _opening_lots(conn, skus: list[str] | None, checkpoint_ym: str | None) -> pd.DataFrame:
+    """Lots for `skus` (None: all) as of the checkpoint; lots received after it start at qty_in."""
+    df = fetch_df("""
+        select ii.internal_sku,
+               ii.batch_id,
+               coalesce(ii.qty_in, 0) as qty_in,
+               b.arrived_at,
+               coalesce(lc.unit_cost, ii.fob_unit, 0) as unit_cost
+        from inbound_items ii
+        left join batch b          on b.batch_id = ii.batch_id
+        left join lot_cost lc      on lc.batch_id = ii.batch_id and lc.internal_sku = ii.internal_sku
+        where %s::text[] is null or ii.internal_sku = any(%s)
+    """, (skus, skus), conn=conn)
+    if df.empty:
+        df = pd.DataFrame(columns=["internal_sku", "batch_id", "qty_in", "arrived_at", "unit_cost"])
+    cp = snapshots.read(conn, checkpoint_ym, skus) if checkpoint_ym else pd.DataFrame(columns=snapshots.COLS)
+    df = df.astype({"internal_sku": str, "batch_id": str}).merge(
+        cp.astype({"internal_sku": str, "batch_id": str}), on=["internal_sku", "batch_id"], how="left"
+    )
+    df["qty_remaining"] = df["qty_remaining"].fillna(df.pop("qty_in"))
+    df = df[["internal_sku", "batch_id", "qty_remaining", "arrived_at", "unit_cost"]]
+    df["qty_remaining"] = pd.to_numeric(df["qty_remaining"], errors="coerce").fillna(0).astype("int64")
+    df["unit_cost"] = pd.to_numeric(df["unit_cost"], errors="coerce").fillna(0.0).astype(float)
+    return df
+
+
+# The dirty SKUs' allocations per (month, order), before and after a replay.
+_ORDER_TOTALS_SQL = """
+    select ym, order_id, sum(qty) as units, sum(qty * coalesce(unit_cost, 0)) as cogs
+    from fifo_alloc
+    where ym = any(%(yms)s) and internal_sku = any(%(skus)s)
+    group by ym, order_id
+"""
+
+# Add the replay's change to month_summary. An order counts once per month, so it only
+# moves `orders` when it gained or lost its last line and no other SKU's line holds it.
+_SUMMARY_DELTA_SQL = f"""
+    with new as ({_ORDER_TOTALS_SQL}),
+    other as (
+        select distinct ym, order_id from fifo_alloc
+        where ym = any(%(yms)s) and internal_sku <> all(%(skus)s)
+    ),
+    d as (
+        select coalesce(n.ym, o.ym) as ym,
+               sum(case when x.order_id is not null then 0
+                        else (n.order_id is not null)::int - (o.order_id is not null)::int end) as orders,
+               sum(coalesce(n.units, 0) - coalesce(o.units, 0)) as units,
+               sum(coalesce(n.cogs, 0) - coalesce(o.cogs, 0)) as cogs
+        from new n
+        full join _fifo_old o on o.ym = n.ym and o.order_id = n.order_id
+        left join other x on x.ym = coalesce(n.ym, o.ym) and x.order_id = coalesce(n.order_id, o.order_id)
+        group by 1
+    )
+    update month_summary m set
+      orders = coalesce(m.orders, 0) + d.orders,
+      units = coalesce(m.units, 0) + d.units,
+      cogs = round(coalesce(m.cogs, 0) + d.cogs, 4),
+      updated_at = now()
+    from d
+    where m.ym = d.ym
+"""
+
+
+def recompute_dirty(conn) -> dict:
+    """
+    Replay FIFO for the dirty SKUs only, from the nearest checkpoint before the
+    earliest dirty month through the last processed month, then rewrite their
+    allocations, lot balances, later checkpoints and the affected month_summary rows.
+
+    month_summary changes by the dirty SKUs' delta (new allocations minus the ones
+    they replace), never by re-aggregating fifo_alloc. Months with no fifo_alloc rows, or
+    last run by the SQL engine (rollup.mark_uncovered), are still replayed to carry the lots forward,
+    but their allocations and month_summary are left alone and returned as `skipped`
+    (run those months again to restate them).
+    """
+    ensure_schema(conn)
+    dirty = fetch_df("select internal_sku, from_date, marked_at from fifo_dirty", conn=conn)
+    if dirty.empty:
+        return {"skus": 0, "months": [], "skipped": [], "checkpoint": None}
+
+    skus = sorted(dirty["internal_sku"].astype(str).unique().tolist())
+    start_ym = pd.to_datetime(dirty["from_date"]).min().strftime("%Y-%m")
+    checkpoint_ym = snapshots.latest_before(conn, start_ym)
+    months = fetch_df("""
+        select ym from month_summary where %s::text is null or ym > %s order by ym
+    """, (checkpoint_ym, checkpoint_ym), conn=conn)["ym"].tolist()
+    cp_months = set(snapshots.months(conn)["ym"])
+    rollup.ensure_schema(conn)
+    covered = set(fetch_df("""
+        select distinct a.ym from fifo_alloc a
+        where a.ym = any(%s) and not exists (select 1 from rollup_uncovered u where u.ym = a.ym)
+    """, (months,), conn=conn)["ym"])
+    written = [m for m in months if m in covered]
+
+    lots = _opening_lots(conn, skus, checkpoint_ym)
+    demand = load_demand(conn, months, skus)
+    allocs, checkpoints = [], []
+    for ym in months:
+        alloc, lots = allocate_month(lots, demand[demand["ym"] == ym].drop(columns="ym"), ym, workers=1)
+        lots = lots.drop(columns="consumed")
+        alloc.insert(0, "ym", ym)
+        if ym in covered:
+            allocs.append(alloc)
+        if ym in cp_months:
+            checkpoints.append((ym, lots[["internal_sku", "batch_id", "qty_remaining"]]))
+
+    alloc = pd.concat(allocs, ignore_index=True) if allocs else pd.DataFrame(columns=ALLOC_COLS)
+    with conn.transaction(), conn.cursor() as cur:
+        if written:
+            params = {"yms": written, "skus": skus}
+            cur.execute(f"create temp table _fifo_old on commit drop as {_ORDER_TOTALS_SQL}", params)
+            cur.execute("delete from fifo_alloc where ym = any(%(yms)s) and internal_sku = any(%(skus)s)", params)
+            copy_df(cur, "fifo_alloc", alloc[ALLOC_COLS])
+            cur.execute(_SUMMARY_DELTA_SQL, params)
+        _write_balances(cur, lots, prune_skus=skus)
+        if checkpoints:
+            snapshots.write(conn, checkpoints, skus=skus)
+        # Only clear marks we replayed; anything marked meanwhile stays dirty.
+        cur.execute("""
+            delete from fifo_dirty d
+            using unnest(%s::text[], %s::timestamptz[]) as r(internal_sku, marked_at)
+            where d.internal_sku = r.internal_sku and d.marked_at = r.marked_at
+        """, (dirty["internal_sku"].astype(str).tolist(), dirty["marked_at"].tolist()))
+    ledger.refresh_fifo(conn, written, skus, alloc=alloc)
+    rollup.refresh(conn, written, skus)
+
+    return {
+        "skus": len(skus), "months": written, "skipped": [m for m in months if m not in covered],
+        "checkpoint": checkpoint_ym,
+    }
+
+
+# ---------- Reconciliation ----------
+def reconcile(conn, ym: str, cogs_tol: float = 0.01) -> dict:
+    """
+    Run the engine and the SQL `run_month` from the same starting state and diff
+    the outcome. Everything happens inside one transaction that is rolled back,
+    so production data is untouched.
+
+    Returns {"ok", "summary": DataFrame, "balances": DataFrame of mismatching lots}.
+    """
+    ensure_schema(conn)
+    with conn.transaction() as tx:
+        with conn.cursor() as cur:
+            cur.execute("select rebuild_lot_costs()")  # both paths price lots identically
+        plan = plan_month(conn, ym)
+        with conn.cursor() as cur:
+            cur.execute("select run_month(%s)", (ym,))
+        sql_bal = fetch_df("select internal_sku, batch_id, qty_remaining from lot_balance", conn=conn)
+        sql_sum = fetch_df("select orders, units, cogs from month_summary where ym = %s", (ym,), conn=conn)
+        raise psycopg.Rollback(tx)
+
+    py_bal = plan["lots_after"][["internal_sku", "batch_id", "qty_remaining"]]
+    bal = py_bal.merge(sql_bal, on=["internal_sku", "batch_id"], how="outer", suffixes=("_py", "_sql"))
+    bal["qty_remaining_sql"] = pd.to_numeric(bal["qty_remaining_sql"], errors="coerce")
+    bal_diff = bal[bal["qty_remaining_py"].fillna(-1) != bal["qty_remaining_sql"].fillna(-1)]
+
+    py = plan["summary"]
+    sql = sql_sum.iloc[0].to_dict() if not sql_sum.empty else {"orders": None, "units": None, "cogs": None}
+    summary = pd.DataFrame({
+        "metric": ["orders", "units", "cogs"],
+        "python": [py["orders"], py["units"], py["cogs"]],
+        "sql": [sql["orders"], sql["units"], sql["cogs"]],
+    })
+    summary["sql"] = pd.to_numeric(summary["sql"], errors="coerce")
+    summary["diff"] = summary["python"] - summary["sql"]
+    summary_ok = bool((summary["diff"].abs().fillna(np.inf) <= [0, 0, cogs_tol]).all())
+
+    return {
+        "ok": summary_ok and bal_diff.empty,
+        "summary": summary,
+        "balances": bal_diff.reset_index(drop=True),
+        "shortfall_units": py["shortfall_units"],
+    }
@@ -0,0 +1,163 @@
+# grids.py — server-side paging for the large grids
+# -----------------------------------------------
+# Each grid is a select over one table with a unique key. page() pushes the filters
+# and the sort down into SQL and reads one page by keyset — the rows after the last
+# row of the previous page on (sort column, key columns) — never OFFSET, so every
+# page costs the same and only `limit` rows leave the database.
+#
+# Filters: "prefix" (LIKE 'value%', escaped), "eq" (= value), "flag" (condition on/off).
+# Sort columns are NOT NULL (or coalesced in the grid's select): a row comparison
+# never matches NULL, so a nullable sort column would drop rows between pages.
+#
+# GRID_INDEX_DDL holds the indexes those filters and sorts need. They are a migration
+# (`python cli.py migrate` -> migrate()), never built on the read path: CREATE INDEX
+# CONCURRENTLY waits for every open transaction on the table.
+
+import re
+
+from db import fetch_df
+
+GRIDS = {
+    "lot_balance": {
+        "sql": "select internal_sku, batch_id, coalesce(qty_remaining, 0) as qty_remaining from lot_balance",
+        "key": ["internal_sku", "batch_id"],
+        "sorts": ["internal_sku", "batch_id", "qty_remaining"],
+        "filters": {
+            "sku": ("internal_sku like %s", "prefix"),
+            "batch": ("batch_id = %s", "eq"),
+            "nonzero": ("qty_remaining <> 0", "flag"),
+        },
+    },
+    "sku_map": {
+        "sql": "select amazon_sku, marketplace, internal_sku, unit_multiplier, active from sku_map",
+        "key": ["amazon_sku", "marketplace"],
+        "sorts": ["amazon_sku", "marketplace"],
+        "filters": {
+            "sku": ("amazon_sku like %s", "prefix"),
+            "marketplace": ("marketplace = %s", "eq"),
+            "internal_sku": ("internal_sku like %s", "prefix"),
+        },
+    },
+    "kit_bom": {
+        "sql": "select amazon_sku, marketplace, component_sku, component_qty from kit_bom",
+        "key": ["amazon_sku", "marketplace", "component_sku"],
+        "sorts": ["amazon_sku", "component_sku"],
+        "filters": {
+            "sku": ("amazon_sku like %s", "prefix"),
+            "marketplace": ("marketplace = %s", "eq"),
+            "component_sku": ("component_sku like %s", "prefix"),
+        },
+    },
+    "product": {
+        "sql": "select internal_sku, category, cbm_per_unit, active from product",
+        "key": ["internal_sku"],
+        "sorts": ["internal_sku"],
+        "filters": {
+            "sku": ("internal_sku like %s", "prefix"),
+            "category": ("category = %s", "eq"),
+        },
+    },
+    "inbound_items": {
+        "sql": "select batch_id, internal_sku, category, qty_in, fob_unit, cbm_per_unit from inbound_items",
+        "key": ["batch_id", "internal_sku"],
+        "sorts": ["batch_id", "internal_sku"],
+        "filters": {
+            "sku": ("internal_sku like %s", "prefix"),
+            "batch": ("batch_id = %s", "eq"),
+            "category": ("category = %s", "eq"),
+        },
+    },
+}
+
+# Primary keys already cover key-ordered pages and leading-column prefixes under the C
+# collation; text_pattern_ops makes LIKE 'x%' indexable under any collation.
+GRID_INDEX_DDL = """
+create index concurrently if not exists lot_balance_sku_pattern_idx on lot_balance(internal_sku text_pattern_ops);
+create index concurrently if not exists lot_balance_batch_idx on lot_balance(batch_id, internal_sku);
+create index concurrently if not exists lot_balance_nonzero_idx on lot_balance(internal_sku, batch_id)
+  where coalesce(qty_remaining, 0) <> 0;  -- matches the grid's coalesced filter
+create index concurrently if not exists sku_map_sku_pattern_idx on sku_map(amazon_sku text_pattern_ops);
+create index concurrently if not exists sku_map_marketplace_idx on sku_map(marketplace, amazon_sku);
+create index concurrently if not exists sku_map_internal_pattern_idx on sku_map(internal_sku text_pattern_ops);
+create index concurrently if not exists kit_bom_sku_pattern_idx on kit_bom(amazon_sku text_pattern_ops);
+create index concurrently if not exists kit_bom_marketplace_idx on kit_bom(marketplace, amazon_sku);
+create index concurrently if not exists kit_bom_component_pattern_idx on kit_bom(component_sku text_pattern_ops);
+create index concurrently if not exists product_sku_pattern_idx on product(internal_sku text_pattern_ops);
+create index concurrently if not exists product_category_idx on product(category, internal_sku);
+create index concurrently if not exists inbound_items_sku_pattern_idx on inbound_items(internal_sku text_pattern_ops);
+create index concurrently if not exists inbound_items_category_idx on inbound_items(category, batch_id, internal_sku)
+"""
+
+DEFAULT_LIMIT = 200
+
+
+def migrate(conn) -> list[tuple[str, str]]:
+    """
+    Build the grid indexes CONCURRENTLY on `conn`, which must be in autocommit (pooled
+    connections are). An INVALID index left by a failed build is dropped and built again;
+    `if not exists` alone would skip it forever. Returns (index, "built" | "rebuilt" | "ok").
+    """
+    stmts = [s for s in GRID_INDEX_DDL.split(";") if s.strip()]
+    names = [re.search(r"if not exists (\w+) on", s).group(1) for s in stmts]
+    with conn.cursor() as cur:
+        cur.execute("""
+            select c.relname, i.indisvalid
+            from pg_class c join pg_index i on i.indexrelid = c.oid
+            where c.relname = any(%s)
+        """, (names,))
+        existing = dict(cur.fetchall())
+        out = []
+        for name, stmt in zip(names, stmts):
+            if existing.get(name) is False:
+                cur.execute(f"drop index concurrently if exists {name}")
+            cur.execute(stmt)
+            out.append((name, "ok" if existing.get(name) else "rebuilt" if name in existing else "built"))
+    return out
+
+
+def like_prefix(value: str) -> str:
+    """LIKE pattern matching values that start with `value` (wildcards escaped)."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _plain(v):
+    """NumPy scalar -> Python scalar, so the cursor can be passed back as query parameters."""
+    return v.item() if hasattr(v, "item") else v
+
+
+def page(grid: str, filters: dict | None = None, sort: str | None = None, desc: bool = False,
+         after: tuple | None = None, limit: int = DEFAULT_LIMIT, conn=None):
+    """
+    One page of `grid` -> (DataFrame, cursor of the next page or None on the last page).
+    `after` is the cursor returned for the previous page (None: first page).
+    """
+    spec = GRIDS[grid]
+    if sort is not None and sort not in spec["sorts"]:
+        raise ValueError(f"{grid}: cannot sort by {sort!r}")
+    order = list(dict.fromkeys(([sort] if sort else []) + spec["key"]))
+
+    where, params = [], []
+    for name, value in (filters or {}).items():
+        if value in (None, "", False):
+            continue
+        cond, kind = spec["filters"][name]
+        where.append(cond)
+        if kind == "prefix":
+            params.append(like_prefix(str(value)))
+        elif kind == "eq":
+            params.append(value)
+    if after is not None:
+        where.append(f"({', '.join(order)}) {'<' if desc else '>'} ({', '.join(['%s'] * len(order))})")
+        params.extend(after)
+
+    direction = " desc" if desc else ""
+    sql = (
+        f"select * from ({spec['sql']}) g"
+        + (" where " + " and ".join(where) if where else "")
+        + f" order by {', '.join(c + direction for c in order)} limit {int(limit) + 1}"
+    )
+    df = fetch_df(sql, tuple(params), conn=conn)
+    if len(df) <= limit:
+        return df.reset_index(drop=True), None
+    df = df.iloc[:limit].reset_index(drop=True)
+    return df, tuple(_plain(v) for v in df.iloc[-1][order])
@@ -0,0 +1,246 @@
+# landed.py — incremental landed cost per lot
+# -----------------------------------------------
+# A lot's unit cost depends only on its own batch:
+#   unit_cost = fob_unit
+#             + (freight_total + clearance_total) × the lot's share of the batch CBM / qty_in
+#             + duty_total of its category pool × the lot's share of that category's FOB value / qty_in
+#
+# Saves in Inbound & Costs mark the batches they touch in `cost_dirty`; reprice_dirty()
+# recomputes lot_cost for those batches only (vectorized over all their lots) and pushes
+# the cost change into the fifo_alloc rows that consumed the repriced lots and into
+# those months' month_summary.cogs and sales_rollup cells. `select rebuild_lot_costs()`
+# stays the full rebuild.
+#
+# The formula above is a re-implementation of rebuild_lot_costs(). reconcile() diffs the
+# two over every batch in a rolled-back transaction; until it reports ok, the worker keeps
+# the full rebuild as its cost stage. LANDED_INCREMENTAL=1 switches it to reprice_dirty().
+
+import os
+
+import numpy as np
+import pandas as pd
+import psycopg
+
+from db import fetch_df, copy_df
+import fifo
+import rollup
+
+DIRTY_DDL = """
+create table if not exists cost_dirty (
+  batch_id  text primary key,
+  marked_at timestamptz not null default now()
+);
+"""
+
+LOT_COLS = ["batch_id", "internal_sku", "unit_cost"]
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    global _schema_ready
+    if _schema_ready:
+        return
+    with conn.cursor() as cur:
+        for stmt in DIRTY_DDL.split(";"):
+            if stmt.strip():
+                cur.execute(stmt)
+    _schema_ready = True
+
+
+def incremental_enabled() -> bool:
+    """LANDED_INCREMENTAL=1: the cost stage reprices dirty batches instead of rebuild_lot_costs()."""
+    return os.environ.get("LANDED_INCREMENTAL", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def mark_batches(conn, batch_ids):
+    """Batches whose inbound items, freight/clearance or duty pools changed."""
+    batch_ids = sorted({str(b) for b in batch_ids if b is not None and str(b) != ""})
+    if not batch_ids:
+        return
+    ensure_schema(conn)
+    with conn.cursor() as cur:
+        cur.execute("""
+            insert into cost_dirty(batch_id)
+            select unnest(%s::text[])
+            on conflict(batch_id) do update set marked_at = now()
+        """, (batch_ids,))
+
+
+# ---------- Allocation (pure, vectorized) ----------
+def _share(part: pd.Series, total: pd.Series, fallback: pd.Series, fallback_total: pd.Series) -> pd.Series:
+    """part / total, or fallback / fallback_total where total is 0 (e.g. CBM not filled in)."""
+    primary = part / total.where(total > 0)
+    backup = fallback / fallback_total.where(fallback_total > 0)
+    return primary.fillna(backup).fillna(0.0)
+
+
+def compute_lot_costs(items: pd.DataFrame, batch_cost: pd.DataFrame, duty: pd.DataFrame) -> pd.DataFrame:
+    """
+    items: batch_id, internal_sku, category, qty_in, fob_unit, cbm_per_unit
+    batch_cost: batch_id, freight_total, clearance_total
+    duty: batch_id, category, duty_total
+    -> batch_id, internal_sku, unit_cost, freight_unit (freight + clearance), duty_unit
+    """
+    df = items.copy()
+    df["category"] = df["category"].fillna("")
+    for c in ("qty_in", "fob_unit", "cbm_per_unit"):
+        df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0).astype(float)
+    qty = df["qty_in"]
+    cbm = qty * df["cbm_per_unit"]
+    value = qty * df["fob_unit"]
+
+    by_batch = df["batch_id"]
+    by_cat = [df["batch_id"], df["category"]]
+    cbm_share = _share(cbm, cbm.groupby(by_batch).transform("sum"), qty, qty.groupby(by_batch).transform("sum"))
+    cat_share = _share(value, value.groupby(by_cat).transform("sum"), qty, qty.groupby(by_cat).transform("sum"))
+
+    bc = batch_cost.set_index("batch_id")
+    pool_by_batch = (
+        pd.to_numeric(bc["freight_total"], errors="coerce").fillna(0)
+        + pd.to_numeric(bc["clearance_total"], errors="coerce").fillna(0)
+    )
+    pool = df["batch_id"].map(pool_by_batch).fillna(0.0).astype(float)
+    duty = duty.assign(category=duty["category"].fillna(""))
+    duty_total = df.merge(duty, on=["batch_id", "category"], how="left")["duty_total"]
+    duty_total = pd.to_numeric(duty_total, errors="coerce").fillna(0.0).to_numpy()
+
+    per_unit = np.where(qty > 0, 1.0 / qty.where(qty > 0, 1.0), 0.0)
+    df["freight_unit"] = pool * cbm_share * per_unit
+    df["duty_unit"] = duty_total * cat_share.to_numpy() * per_unit
+    df["unit_cost"] = (df["fob_unit"] + df["freight_unit"] + df["duty_unit"]).round(6)
+    return df[LOT_COLS + ["freight_unit", "duty_unit"]]
+
+
+# ---------- Repricing ----------
+def load_inputs(conn, batch_ids):
+    """inbound_items, batch_cost and duty_pool rows of `batch_ids` (empty frames keep their columns)."""
+    args = (batch_ids,)
+    items = fetch_df("""
+        select batch_id, internal_sku, category, qty_in, fob_unit, cbm_per_unit
+        from inbound_items where batch_id = any(%s)
+    """, args, conn=conn)
+    batch_cost = fetch_df(
+        "select batch_id, freight_total, clearance_total from batch_cost where batch_id = any(%s)",
+        args, conn=conn,
+    )
+    duty = fetch_df("select batch_id, category, duty_total from duty_pool where batch_id = any(%s)", args, conn=conn)
+    if items.empty:
+        items = pd.DataFrame(columns=["batch_id", "internal_sku", "category", "qty_in", "fob_unit", "cbm_per_unit"])
+    if batch_cost.empty:
+        batch_cost = pd.DataFrame(columns=["batch_id", "freight_total", "clearance_total"])
+    if duty.empty:
+        duty = pd.DataFrame(columns=["batch_id", "category", "duty_total"])
+    return items, batch_cost, duty
+
+
+def reprice(conn, batch_ids, dirty_before=None) -> dict:
+    """
+    Recompute lot_cost for `batch_ids` and propagate the changes to fifo_alloc,
+    month_summary and sales_rollup, in one transaction. Clears their cost_dirty marks (only those set
+    before `dirty_before`, when given). Returns counts and the total COGS delta.
+    """
+    batch_ids = sorted({str(b) for b in batch_ids})
+    if not batch_ids:
+        return {"batches": 0, "lots": 0, "changed_lots": 0, "alloc_rows": 0, "cogs_delta": 0.0}
+    ensure_schema(conn)
+    fifo.ensure_schema(conn)
+    rollup.ensure_schema(conn)
+    items, batch_cost, duty = load_inputs(conn, batch_ids)
+    lots = compute_lot_costs(items, batch_cost, duty)[LOT_COLS]
+
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute("""
+            create temp table _lot_cost_new on commit drop as
+            select batch_id, internal_sku, unit_cost from lot_cost limit 0
+        """)
+        copy_df(cur, "_lot_cost_new", lots)
+        # Lots whose cost moved (removed lots have no new cost and are left to FIFO's dirty replay).
+        cur.execute("""
+            create temp table _lot_cost_delta on commit drop as
+            select n.batch_id, n.internal_sku, n.unit_cost
+            from _lot_cost_new n
+            left join lot_cost o on o.batch_id = n.batch_id and o.internal_sku = n.internal_sku
+            where o.unit_cost is distinct from n.unit_cost
+        """)
+        changed = cur.rowcount
+        cur.execute("delete from lot_cost where batch_id = any(%s)", (batch_ids,))
+        cur.execute("""
+            insert into lot_cost(batch_id, internal_sku, unit_cost)
+            select batch_id, internal_sku, unit_cost from _lot_cost_new
+        """)
+        cur.execute("""
+            create temp table _cogs_delta on commit drop as
+            select a.ym, sum(a.qty * (d.unit_cost - coalesce(a.unit_cost, 0))) as delta
+            from fifo_alloc a
+            join _lot_cost_delta d on d.batch_id = a.batch_id and d.internal_sku = a.internal_sku
+            group by a.ym
+        """)
+        rollup.apply_cost_delta(cur, "_lot_cost_delta")
+        cur.execute("""
+            update fifo_alloc a set unit_cost = d.unit_cost
+            from _lot_cost_delta d
+            where d.batch_id = a.batch_id and d.internal_sku = a.internal_sku
+              and a.unit_cost is distinct from d.unit_cost
+        """)
+        alloc_rows = cur.rowcount
+        cur.execute("""
+            update month_summary m set cogs = coalesce(m.cogs, 0) + c.delta, updated_at = now()
+            from _cogs_delta c
+            where m.ym = c.ym and c.delta <> 0
+        """)
+        cur.execute("select coalesce(sum(delta), 0) from _cogs_delta")
+        delta = float(cur.fetchone()[0])
+        cur.execute("""
+            delete from cost_dirty
+            where batch_id = any(%s) and (%s::timestamptz is null or marked_at <= %s)
+        """, (batch_ids, dirty_before, dirty_before))
+    return {
+        "batches": len(batch_ids), "lots": len(lots), "changed_lots": changed,
+        "alloc_rows": alloc_rows, "cogs_delta": round(delta, 4),
+    }
+
+
+def reprice_dirty(conn) -> dict:
+    """Reprice the batches marked in cost_dirty (the incremental replacement for rebuild_lot_costs)."""
+    ensure_schema(conn)
+    dirty = fetch_df("select batch_id, marked_at from cost_dirty", conn=conn)
+    if dirty.empty:
+        return reprice(conn, [])
+    # Marks added while we run stay for the next pass.
+    return reprice(conn, dirty["batch_id"].tolist(), dirty_before=dirty["marked_at"].max())
+
+
+# ---------- Reconciliation ----------
+def reconcile(conn, tol: float = 1e-4) -> dict:
+    """
+    Compare compute_lot_costs() with `select rebuild_lot_costs()` over every batch. The SQL
+    rebuild runs inside a transaction that is rolled back, so lot_cost is untouched.
+
+    Returns {"ok", "lots", "mismatches": DataFrame of lots whose unit cost differs by more
+    than `tol` or that only one side priced}.
+    """
+    ensure_schema(conn)
+    with conn.transaction() as tx:
+        with conn.cursor() as cur:
+            cur.execute("select rebuild_lot_costs()")
+        sql = fetch_df("select batch_id, internal_sku, unit_cost from lot_cost", conn=conn)
+        raise psycopg.Rollback(tx)
+
+    batch_ids = fetch_df("select distinct batch_id from inbound_items", conn=conn)["batch_id"].astype(str).tolist()
+    py = compute_lot_costs(*load_inputs(conn, batch_ids))[LOT_COLS]
+    if sql.empty:
+        sql = pd.DataFrame(columns=LOT_COLS)
+    keys = ["batch_id", "internal_sku"]
+    both = py.astype({k: str for k in keys}).merge(
+        sql.astype({k: str for k in keys}), on=keys, how="outer", suffixes=("_py", "_sql")
+    )
+    for c in ("unit_cost_py", "unit_cost_sql"):
+        both[c] = pd.to_numeric(both[c], errors="coerce")
+    both["diff"] = both["unit_cost_py"] - both["unit_cost_sql"]
+    bad = both["diff"].isna() | (both["diff"].abs() > tol)
+    return {
+        "ok": not bad.any(),
+        "lots": len(both),
+        "mismatches": both[bad].sort_values(keys).reset_index(drop=True),
+    }
@@ -0,0 +1,239 @@
+# ledger.py — lot movement ledger and point-in-time inventory
+# -----------------------------------------------
+# lot_movement holds one signed row per stock event, indexed by
+# (internal_sku, batch_id, happened_at):
+#   kind 'in'   +qty_in at the batch's arrival date      (refresh_inbound, on inbound / batch saves)
+#   kind 'fifo' −qty consumed at the order's date/time  (refresh_fifo, whenever fifo_alloc is written)
+# Month-start checkpoints (ledger_checkpoint + ledger_position, non-zero positions only)
+# are rebuilt from the first month a change touches, so inventory_as_of(date) reads one
+# checkpoint plus at most a month of events.
+#
+# Only allocations of the Python engine (fifo_alloc) are in the ledger.
+
+import pandas as pd
+
+from db import connection, fetch_df, copy_df
+from loader import parse_datetimes
+
+NO_DATE = "0001-01-01"
+
+LEDGER_DDL = """
+create table if not exists lot_movement (
+  internal_sku text        not null,
+  batch_id     text        not null,
+  happened_at  timestamptz not null,
+  qty          integer     not null,        -- + inbound, − consumption
+  kind         text        not null,        -- in | fifo
+  ym           text                         -- fifo: allocation month
+);
+create index if not exists lot_movement_key_idx on lot_movement(internal_sku, batch_id, happened_at);
+create index if not exists lot_movement_time_idx on lot_movement(happened_at);
+create index if not exists lot_movement_ym_idx on lot_movement(kind, ym);
+create table if not exists ledger_checkpoint (
+  as_of     timestamptz primary key,        -- position of everything before this instant
+  positions integer     not null
+);
+create table if not exists ledger_position (
+  as_of        timestamptz not null,
+  internal_sku text        not null,
+  batch_id     text        not null,
+  qty          integer     not null,
+  primary key (as_of, internal_sku, batch_id)
+)
+"""
+
+_schema_ready = False
+
+
+def ensure_schema(conn) -> bool:
+    """Create the ledger; the first time, fill it from inbound_items and fifo_alloc (returns True then)."""
+    global _schema_ready
+    if _schema_ready:
+        return False
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('lot_movement') is null, to_regclass('fifo_alloc') is not null")
+        created, have_alloc = cur.fetchone()
+        for stmt in LEDGER_DDL.split(";"):
+            if stmt.strip():
+                cur.execute(stmt)
+    _schema_ready = True
+    if created:
+        _fill(conn, have_alloc)
+    return created
+
+
+def rebuild(conn):
+    """Rewrite every event from inbound_items and fifo_alloc, and all checkpoints."""
+    if not ensure_schema(conn):
+        _fill(conn)
+
+
+def _fill(conn, with_alloc: bool = True):
+    refresh_inbound(conn)
+    if with_alloc:
+        refresh_fifo(conn, fetch_df("select distinct ym from fifo_alloc", conn=conn)["ym"].tolist())
+
+
+# ---------- Events ----------
+def refresh_inbound(conn, batch_ids=None):
+    """Rewrite the inbound events of `batch_ids` (None: all batches) from inbound_items + batch."""
+    ensure_schema(conn)
+    batch_ids = None if batch_ids is None else sorted({str(b) for b in batch_ids if b is not None})
+    if batch_ids == []:
+        return
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute(
+            "select min(happened_at) from lot_movement where kind = 'in' and (%s::text[] is null or batch_id = any(%s))",
+            (batch_ids, batch_ids),
+        )
+        old_min = cur.fetchone()[0]
+        cur.execute(
+            "delete from lot_movement where kind = 'in' and (%s::text[] is null or batch_id = any(%s))",
+            (batch_ids, batch_ids),
+        )
+        cur.execute("""
+            insert into lot_movement(internal_sku, batch_id, happened_at, qty, kind)
+            select ii.internal_sku, ii.batch_id, coalesce(b.arrived_at::timestamptz, %s::timestamptz), ii.qty_in, 'in'
+            from inbound_items ii
+            left join batch b on b.batch_id = ii.batch_id
+            where coalesce(ii.qty_in, 0) <> 0 and (%s::text[] is null or ii.batch_id = any(%s))
+            returning happened_at
+        """, (NO_DATE, batch_ids, batch_ids))
+        times = [r[0] for r in cur.fetchall()]
+        _invalidate(cur, min([t for t in times + [old_min] if t is not None], default=None))
+    build_checkpoints(conn)
+
+
+def refresh_fifo(conn, yms, skus=None, alloc: pd.DataFrame | None = None):
+    """
+    Rewrite the consumption events of months `yms` (optionally only `skus`). `alloc` is
+    what was just written to fifo_alloc for them; without it, fifo_alloc is read back.
+    """
+    ensure_schema(conn)
+    yms = sorted(set(yms))
+    if not yms:
+        return
+    params = (yms, skus, skus)
+    if alloc is None:
+        alloc = fetch_df("""
+            select ym, internal_sku, batch_id, date_time, qty
+            from fifo_alloc
+            where ym = any(%s) and (%s::text[] is null or internal_sku = any(%s))
+        """, params, conn=conn)
+    alloc = alloc[alloc["batch_id"].notna()]
+    if not alloc.empty:
+        keys = ["internal_sku", "batch_id", "ym", "date_time"]
+        alloc = alloc.groupby(keys, as_index=False, observed=True, dropna=False)["qty"].sum()
+        happened = _event_times(alloc["date_time"])
+        month_start = pd.to_datetime(alloc["ym"] + "-01").dt.tz_localize("UTC")
+        alloc["happened_at"] = happened.fillna(month_start)
+        alloc["qty"] = -pd.to_numeric(alloc["qty"]).astype("int64")
+        alloc["kind"] = "fifo"
+        keys = ["internal_sku", "batch_id", "happened_at", "kind", "ym"]
+        alloc = alloc.groupby(keys, as_index=False, observed=True)["qty"].sum()
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute("""
+            delete from lot_movement
+            where kind = 'fifo' and ym = any(%s) and (%s::text[] is null or internal_sku = any(%s))
+        """, params)
+        copy_df(cur, "lot_movement", alloc[["internal_sku", "batch_id", "happened_at", "qty", "kind", "ym"]]
+                if not alloc.empty else alloc)
+        # Sales can be dated a little outside their upload month; invalidate from the earliest of both.
+        start = pd.Timestamp(yms[0] + "-01", tz="UTC")
+        if not alloc.empty:
+            start = min(start, alloc["happened_at"].min())
+        _invalidate(cur, start - pd.Timedelta(days=31))
+    build_checkpoints(conn)
+
+
+def _event_times(s: pd.Series) -> pd.Series:
+    """Order date/time as UTC: timestamps and ISO text directly, settlement-report text via the loader's parser."""
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return pd.to_datetime(s, utc=True)
+    out = pd.to_datetime(s, utc=True, errors="coerce", format="ISO8601")
+    rest = out.isna() & s.notna()
+    if rest.any():
+        out[rest] = parse_datetimes(s[rest].astype(str))
+    return out
+
+
+# ---------- Checkpoints ----------
+def _invalidate(cur, since):
+    """Drop checkpoints that include events at or after `since`."""
+    if since is None:
+        return
+    cur.execute("delete from ledger_position where as_of > %s", (since,))
+    cur.execute("delete from ledger_checkpoint where as_of > %s", (since,))
+
+
+def build_checkpoints(conn) -> int:
+    """Add the missing month-start checkpoints up to the last event; returns how many were built."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            select (select max(as_of) from ledger_checkpoint),
+                   date_trunc('month', min(happened_at)) + interval '1 month',
+                   date_trunc('month', max(happened_at))
+            from lot_movement
+            where happened_at > '1900-01-01'
+        """)
+        last, first, upto = cur.fetchone()
+    if upto is None:
+        return 0
+    bounds = pd.date_range(
+        (pd.Timestamp(last) + pd.offsets.MonthBegin(1)) if last is not None else pd.Timestamp(first),
+        pd.Timestamp(upto), freq="MS",
+    )
+    prev = last
+    with conn.transaction(), conn.cursor() as cur:
+        for b in bounds:
+            cur.execute("""
+                insert into ledger_position(as_of, internal_sku, batch_id, qty)
+                select %(b)s, internal_sku, batch_id, sum(qty)
+                from (
+                    select internal_sku, batch_id, qty from ledger_position where as_of = %(prev)s
+                    union all
+                    select internal_sku, batch_id, qty from lot_movement
+                    where happened_at < %(b)s and (%(prev)s::timestamptz is null or happened_at >= %(prev)s)
+                ) x
+                group by internal_sku, batch_id
+                having sum(qty) <> 0
+            """, {"b": b.to_pydatetime(), "prev": prev})
+            cur.execute("insert into ledger_checkpoint(as_of, positions) values (%s, %s)", (b.to_pydatetime(), cur.rowcount))
+            prev = b.to_pydatetime()
+    return len(bounds)
+
+
+# ---------- Query ----------
+def inventory_as_of(date, skus: list[str] | None = None, conn=None) -> pd.DataFrame:
+    """
+    On-hand qty per lot at the end of `date` (internal_sku, batch_id, qty_on_hand):
+    nearest month-start checkpoint plus that month's events, lots at zero left out.
+    """
+    end = pd.Timestamp(date).normalize() + pd.Timedelta(days=1)
+    if end.tzinfo is None:
+        end = end.tz_localize("UTC")
+    end = end.to_pydatetime()
+    with connection(conn) as c:
+        ensure_schema(c)  # the "As of" picker can come before any ledger write
+    df = fetch_df("""
+        with cp as (
+            select max(as_of) as as_of from ledger_checkpoint where as_of <= %(end)s
+        )
+        select internal_sku, batch_id, sum(qty)::int as qty_on_hand
+        from (
+            select p.internal_sku, p.batch_id, p.qty
+            from ledger_position p, cp
+            where p.as_of = cp.as_of and (%(skus)s::text[] is null or p.internal_sku = any(%(skus)s))
+            union all
+            select m.internal_sku, m.batch_id, m.qty
+            from lot_movement m, cp
+            where m.happened_at < %(end)s and (cp.as_of is null or m.happened_at >= cp.as_of)
+              and (%(skus)s::text[] is null or m.internal_sku = any(%(skus)s))
+        ) x
+        group by internal_sku, batch_id
+        having sum(qty) <> 0
+        order by internal_sku, batch_id
+    """, {"end": end, "skus": list(skus) if skus is not None else None}, conn=conn)
+    if df.empty:
+        df = pd.DataFrame(columns=["internal_sku", "batch_id", "qty_on_hand"])
+    return df
@@ -1,45 +1,372 @@
 # loader.py —— 统一导入：Amazon 月报 / 入库 / 成本池 / 税金池 / 映射 / 组合柜
 import io
+import os
+import re
+import time
+import zipfile
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import pandas as pd
 from datetime import datetime
 from dateutil import parser
-from db import upsert
+from pandas.tseries.api import guess_datetime_format
+from db import upsert, merge, connection, copy_df
 
 # 4.1 Amazon 月报 CSV -> sales_raw
-def load_sales_raw_from_csv(file_bytes: bytes, marketplace: str):
-    df = pd.read_csv(io.BytesIO(file_bytes))
+SALES_MUST = ["date/time", "type", "order id", "sku", "quantity", "marketplace"]  # 如站点列名不同，这里统一成 marketplace 传参覆盖
+
+# 结算报表时间形如 "Jan 1, 2024 12:03:04 AM PST"：时区缩写 -> UTC 偏移（小时）
+TZ_OFFSETS = {
+    "UTC": 0, "GMT": 0, "PST": -8, "PDT": -7, "MST": -7, "MDT": -6, "CST": -6, "CDT": -5,
+    "EST": -5, "EDT": -4, "BST": 1, "CET": 1, "CEST": 2, "MEZ": 1, "MESZ": 2,
+    "JST": 9, "AEST": 10, "AEDT": 11,
+}
+
+# 各站点报表常见时间格式（按顺序试样本）；推断不出再交给 pandas 猜
+KNOWN_FORMATS = [
+    "%b %d, %Y %I:%M:%S %p",   # US: Jan 1, 2024 12:03:04 AM
+    "%d %b %Y %H:%M:%S",       # UK: 1 Jan 2024 00:03:04
+    "%d.%m.%Y %H:%M:%S",       # DE: 01.01.2024 00:03:04
+    "%d/%m/%Y %H:%M:%S",       # FR/IT/ES
+    "%Y/%m/%d %H:%M:%S",       # JP
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S",
+]
+
+# 格式缓存：样本“形状”(数字替换成 0) -> strftime 格式；同一种报表只推断一次
+_FMT_CACHE: dict[str, str | None] = {}
+
+
+def _guess_format(sample: str) -> str | None:
+    shape = re.sub(r"\d", "0", sample)
+    if shape not in _FMT_CACHE:
+        fmt = None
+        for f in KNOWN_FORMATS:
+            try:
+                datetime.strptime(sample, f)
+                fmt = f
+                break
+            except ValueError:
+                pass
+        _FMT_CACHE[shape] = fmt or guess_datetime_format(sample)
+    return _FMT_CACHE[shape]
+
+
+def parse_datetimes(s: pd.Series) -> pd.Series:
+    """
+    列式解析 date/time -> UTC datetime64。
+    去掉时区缩写后，每种形状按缓存格式一次性 to_datetime；少数不符合格式的值按“唯一值”走 dateutil 兜底。
+    没有时区缩写的值按 UTC 处理。
+    """
+    s = s.astype(str).str.strip()
+    parts = s.str.rsplit(" ", n=1, expand=True)
+    if parts.shape[1] == 2:
+        has_tz = parts[1].isin(TZ_OFFSETS.keys())
+        body = s.where(~has_tz, parts[0])
+        offset = parts[1].where(has_tz).map(TZ_OFFSETS).fillna(0)
+    else:
+        body, offset = s, pd.Series(0, index=s.index)
+
+    # 每种“形状”取一个样本推断格式：混着多个站点格式的列，各自按自己的格式解析
+    shape = body.str.replace(r"\d", "0", regex=True)
+    dt = pd.Series(pd.NaT, index=body.index, dtype="datetime64[ns]")
+    for sample, sh in zip(body[~shape.duplicated()], shape[~shape.duplicated()]):
+        fmt = _guess_format(sample) if sample else None
+        if fmt:
+            m = shape == sh
+            dt[m] = pd.to_datetime(body[m], format=fmt, errors="coerce")
+
+    bad = dt.isna() & body.ne("") & body.ne("nan")
+    if bad.any():
+        def parse_one(x):
+            try: return parser.parse(x, ignoretz=True)
+            except (ValueError, OverflowError): return None
+        uniq = pd.Series(body[bad].unique())
+        fixed = dict(zip(uniq, pd.to_datetime(uniq.map(parse_one), errors="coerce")))
+        dt = dt.where(~bad, body[bad].map(fixed))
+
+    dt = pd.to_datetime(dt) - pd.to_timedelta(offset, unit="h")
+    return dt.dt.tz_localize("UTC")
+
+
+def parse_sales_csv(file_bytes: bytes, marketplace: str) -> pd.DataFrame:
+    """
+    结算报表 -> sales_raw 行（DataFrame）。先按 type=Order 过滤，再解析时间/数量，
+    payload 按整列批量序列化成 JSON 字符串。
+    """
+    df = pd.read_csv(io.BytesIO(file_bytes), dtype=str, keep_default_na=False)
     # 兼容字段名（以你截图为准，可自行补充更多别名）
     col = {c.lower(): c for c in df.columns}
-    must = ["date/time","type","order id","sku","quantity","marketplace"]  # 如站点列名不同，这里统一成 marketplace 传参覆盖
-    for m in must:
+    for m in SALES_MUST:
         if m not in col:
             raise ValueError(f"Missing column: {m}")
 
-    def parse_dt(s):
-        try: return parser.parse(str(s))
-        except: return None
+    # 先过滤：退款/费用/转账行不再解析
+    df = df[df[col["type"]].isin(["Order", "order"])]
+    qty = pd.to_numeric(df[col["quantity"]], errors="coerce").fillna(0).astype("int64")
+    df, qty = df[qty > 0], qty[qty > 0]
+
+    happened_at = parse_datetimes(df[col["date/time"]])
+    ok = happened_at.notna()
+    df, qty, happened_at = df[ok], qty[ok], happened_at[ok]
+
+    payload = df.to_json(orient="records", lines=True, force_ascii=False).splitlines() if len(df) else []
+    out = pd.DataFrame({
+        "happened_at": happened_at,
+        "type": df[col["type"]],
+        "order_id": df[col["order id"]],
+        "amazon_sku": df[col["sku"]],
+        "quantity": qty,
+        "marketplace": marketplace if marketplace else df[col["marketplace"]],
+        "payload": payload,
+    }, index=df.index)
+    # 同一冲突键只保留最后一行（与逐行 upsert 的结果一致）
+    return out.drop_duplicates(["order_id", "amazon_sku", "happened_at"], keep="last").reset_index(drop=True)
+
+
+def load_sales_raw_from_csv(file_bytes: bytes, marketplace: str):
+    df = parse_sales_csv(file_bytes, marketplace)
+    if not df.empty:
+        merge("sales_raw", df, ["order_id","amazon_sku","happened_at"])
+        _sales_changed(df)
+    return len(df)
+
+def _sales_changed(df: pd.DataFrame):
+    # 这些 (amazon_sku, marketplace) 解析到的内部 SKU 从最早的订单日期起标脏（fifo_dirty）
+    import fifo
+    first = df.groupby(["amazon_sku", "marketplace"], as_index=False)["happened_at"].min()
+    first["happened_at"] = pd.to_datetime(first["happened_at"]).dt.strftime("%Y-%m-%d")
+    with connection() as conn:
+        fifo.mark_dirty_sales_rows(conn, first.itertuples(index=False, name=None))
+
+# 4.1b 页面上传（流式）：逐块 COPY 到临时表再并入 sales_raw
+SALES_COLS = ["ym", "date_time", "marketplace", "order_id", "amazon_sku", "qty"]
+SALES_CHUNK_ROWS = 50_000
+
+
+def normalize_sales_chunk(raw: pd.DataFrame, ym: str, marketplace: str | None = None) -> pd.DataFrame:
+    """
+    Map one chunk of an Amazon export onto sales_raw columns (column aliases via pick).
+    marketplace fills files without a marketplace column (default amazon.com).
+    """
+    raw.columns = raw.columns.str.strip().str.lower()
+
+    def pick(*names, default=None):
+        for n in names:
+            if n in raw.columns:
+                return raw[n]
+        return default
+
+    qty = pick("quantity", "quantity-purchased", "qty")
+    df = pd.DataFrame({
+        "ym": ym,
+        "date_time": pick("date/time", "date_time", "purchase-date"),
+        "marketplace": pick("marketplace", "marketplace-domain", default=marketplace or "amazon.com"),
+        "order_id": pick("order id", "order-id", "order_id"),
+        "amazon_sku": pick("sku", "seller-sku", "asin", "amazon_sku"),
+        "qty": 0 if qty is None else pd.to_numeric(qty, errors="coerce").fillna(0).astype(int),
+    }, index=raw.index)
+    return df.dropna(subset=["date_time", "order_id", "amazon_sku"])[SALES_COLS]
+
 
-    rows = []
-    for _, r in df.iterrows():
-        happened_at = parse_dt(r[col["date/time"]])
-        if happened_at is None: 
+_SALES_STAGE_SQL = """
+    create temp table _sales_stage on commit drop as
+    select ym, date_time, marketplace, order_id, amazon_sku, qty from sales_raw limit 0
+"""
+_SALES_INSERT_SQL = """
+    insert into sales_raw(ym, date_time, marketplace, order_id, amazon_sku, qty)
+    select ym, date_time, marketplace, order_id, amazon_sku, qty from _sales_stage
+"""
+
+
+def import_sales_stream(file, ym: str, marketplace: str | None = None, on_progress=None) -> int:
+    """
+    Stream a CSV into sales_raw with bounded memory: read SALES_CHUNK_ROWS at a time,
+    COPY each chunk into a temp staging table, then merge into sales_raw with one
+    INSERT ... SELECT. All in one transaction, so a failed import leaves nothing behind.
+    marketplace fills a file without a marketplace column, as in import_sales_files
+    (callers pass infer_marketplace(file name)).
+    """
+    total = getattr(file, "size", None)
+    for encoding in ("utf-8", "latin-1"):  # EU exports are often cp1252
+        file.seek(0)
+        n = 0
+        try:
+            with connection() as conn, conn.transaction(), conn.cursor() as cur:
+                cur.execute(_SALES_STAGE_SQL)
+                for chunk in pd.read_csv(file, chunksize=SALES_CHUNK_ROWS, dtype=str, encoding=encoding):
+                    df = normalize_sales_chunk(chunk, ym, marketplace)
+                    copy_df(cur, "_sales_stage", df)
+                    n += len(df)
+                    if on_progress and total:
+                        on_progress(min(file.tell() / total, 1.0), n)
+                cur.execute(_SALES_INSERT_SQL)
+            return n
+        except UnicodeDecodeError:
             continue
-        rows.append({
-            "happened_at": happened_at.isoformat(),
-            "type": str(r[col["type"]]),
-            "order_id": str(r[col["order id"]]),
-            "amazon_sku": str(r[col["sku"]]),
-            "quantity": int(pd.to_numeric(r[col["quantity"]], errors="coerce") or 0),
-            "marketplace": marketplace or str(r.get(col.get("marketplace",""), marketplace) or marketplace),
-            "payload": {k:str(r[k]) for k in df.columns}
-        })
-
-    # 仅保留 type=Order & quantity>0 的行，其它行也可以先入库保留
-    rows = [x for x in rows if x["type"] in ("Order","order") and x["quantity"]>0]
-    if rows:
-        upsert("sales_raw", rows, on_conflict=["order_id","amazon_sku","happened_at"])
+    raise ValueError("Could not decode the CSV as UTF-8 or Latin-1.")
+
+
+# 4.1c 多文件 / zip：每个站点一份报表，进程池解析，多个连接并发入库
+# 文件名里的站点：amazon.de_2024-01.csv / sales_UK_2024-01.csv / orders-jp.csv
+MARKETPLACE_CODES = {
+    "us": "amazon.com", "ca": "amazon.ca", "mx": "amazon.com.mx", "br": "amazon.com.br",
+    "uk": "amazon.co.uk", "gb": "amazon.co.uk", "de": "amazon.de", "fr": "amazon.fr", "it": "amazon.it",
+    "es": "amazon.es", "nl": "amazon.nl", "se": "amazon.se", "pl": "amazon.pl", "be": "amazon.com.be",
+    "jp": "amazon.co.jp", "au": "amazon.com.au", "sg": "amazon.sg", "ae": "amazon.ae", "in": "amazon.in",
+}
+# 同时是常见英文单词的代码（settlement_in_2024.csv）只认大写：sales_IT_2024-01.csv
+WORD_CODES = {"us", "it", "es", "be", "in"}
+
+
+def infer_marketplace(name: str) -> str | None:
+    """
+    Marketplace from a file name: an amazon.* domain, else one country code between
+    delimiters (us / it / es / be / in only in capitals); None if neither, or if the
+    name holds codes of different marketplaces.
+    """
+    base = os.path.basename(name)
+    m = re.search(r"(?<![a-z0-9])amazon\.(?:com\.|co\.)?[a-z]{2,3}(?![a-z])", base.lower())
+    if m:
+        return m.group(0)
+    found = {
+        MARKETPLACE_CODES[token.lower()]
+        for token in re.split(r"[^A-Za-z]+", os.path.splitext(base)[0])
+        if token.lower() in MARKETPLACE_CODES and (token.lower() not in WORD_CODES or token.isupper())
+    }
+    return found.pop() if len(found) == 1 else None
+
+
+def expand_sales_files(files) -> list[tuple[str, bytes]]:
+    """(name, bytes) per CSV; zip archives are opened and every CSV inside becomes its own file."""
+    out = []
+    for name, data in files:
+        if name.lower().endswith(".zip"):
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                for info in zf.infolist():
+                    inner = info.filename
+                    if info.is_dir() or inner.startswith("__MACOSX/") or not inner.lower().endswith(".csv"):
+                        continue
+                    out.append((f"{name}/{inner}", zf.read(info)))
+        else:
+            out.append((name, data))
+    return out
+
+
+def parse_sales_file(name: str, data: bytes, ym: str, marketplace: str | None = None) -> dict:
+    """
+    One export -> sales_raw rows (normalize_sales_chunk over the whole file). Runs in a
+    worker process; never raises, the error goes into the result instead.
+    marketplace (else infer_marketplace(name)) fills a file without a marketplace column.
+    """
+    t = time.perf_counter()
+    inferred = marketplace or infer_marketplace(name)
+    source = "given" if marketplace else ("file name" if inferred else "default")
+    res = {"file": name, "marketplace": inferred, "marketplace_source": source, "rows": 0, "df": None,
+           "error": None}
+    try:
+        for encoding in ("utf-8", "latin-1"):  # EU exports are often cp1252
+            try:
+                raw = pd.read_csv(io.BytesIO(data), dtype=str, encoding=encoding)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            raise ValueError("Could not decode the CSV as UTF-8 or Latin-1.")
+        has_column = {"marketplace", "marketplace-domain"} & set(raw.columns.str.strip().str.lower())
+        df = normalize_sales_chunk(raw, ym, inferred)
+        if df.empty and len(raw):
+            raise ValueError(f"no sales rows recognised; columns: {', '.join(raw.columns[:8])}")
+        if has_column:
+            res["marketplace"] = ", ".join(sorted(df["marketplace"].dropna().unique())) or inferred
+            res["marketplace_source"] = "column"
+        else:
+            res["marketplace"] = inferred or "amazon.com"
+        res["df"], res["rows"] = df, len(df)
+    except Exception as e:
+        res["error"] = f"{type(e).__name__}: {e}"
+    res["parse_s"] = time.perf_counter() - t
+    return res
+
+
+def _parse_sales_file(args):
+    return parse_sales_file(*args)
+
+
+def _load_sales_frame(df: pd.DataFrame):
+    # 每个文件一个连接、一个事务：一个文件失败不影响其他文件
+    with connection() as conn, conn.transaction(), conn.cursor() as cur:
+        cur.execute(_SALES_STAGE_SQL)
+        copy_df(cur, "_sales_stage", df)
+        cur.execute(_SALES_INSERT_SQL)
+
+
+def import_sales_files(files, ym: str, workers: int | None = None, on_file=None,
+                       marketplace: str | None = None) -> list[dict]:
+    """
+    Import several Amazon exports (or zips of them) for one month.
+    files: iterable of (name, bytes). Each CSV is parsed on a process pool
+    (SALES_PARSE_WORKERS, default one per file up to the CPU count) and, as soon as it
+    is parsed, loaded on its own pooled connection (SALES_LOAD_WORKERS concurrent, default 4).
+    Marketplace: the file's marketplace column, else `marketplace`, else infer_marketplace(file name).
+    Returns one report per file: file, marketplace, marketplace_source (column / given /
+    file name / default), rows, parse_s, load_s, status, error;
+    on_file(report) is called in the caller's thread as each file finishes.
+    """
+    files = expand_sales_files(files)
+    if not files:
+        return []
+    workers = workers or int(os.environ.get("SALES_PARSE_WORKERS", 0)) or min(len(files), os.cpu_count() or 1)
+    load_workers = max(1, int(os.environ.get("SALES_LOAD_WORKERS", 4)))
+    tasks = [(name, data, ym, marketplace) for name, data in files]
+
+    def load(res):
+        df = res.pop("df", None)
+        res["load_s"] = 0.0
+        if res["error"] is None and res["rows"]:
+            t = time.perf_counter()
+            try:
+                _load_sales_frame(df)
+            except Exception as e:
+                res["error"] = f"{type(e).__name__}: {e}"
+            res["load_s"] = time.perf_counter() - t
+        res["status"] = "failed" if res["error"] else "ok"
+        return res
+
+    if workers <= 1 or len(files) == 1:
+        parse_pool = ThreadPoolExecutor(max_workers=1)  # still overlaps parsing with loading
+    else:
+        # spawn: the parent holds DB pool threads, which must not be forked
+        parse_pool = ProcessPoolExecutor(max_workers=min(workers, len(files)),
+                                         mp_context=multiprocessing.get_context("spawn"))
+    reports = [None] * len(files)
+    with parse_pool, ThreadPoolExecutor(max_workers=min(load_workers, len(files))) as load_pool:
+        parsing = {parse_pool.submit(_parse_sales_file, task): i for i, task in enumerate(tasks)}
+        loading = {}
+        pending = set(parsing)
+        # A file starts loading as soon as it is parsed; reports (and on_file) in completion order.
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f in parsing:
+                    i = parsing[f]
+                    try:
+                        res = f.result()
+                    except Exception as e:  # worker process died
+                        res = {"file": files[i][0], "marketplace": None, "marketplace_source": None, "rows": 0,
+                               "parse_s": 0.0, "error": f"{type(e).__name__}: {e}"}
+                    nxt = load_pool.submit(load, res)
+                    loading[nxt] = i
+                    pending.add(nxt)
+                else:
+                    reports[loading[f]] = res = f.result()
+                    if on_file:
+                        on_file(res)
+    return reports
+
 
 # 4.2 基础维表导入
+# upsert_* 都走 db.merge（COPY 到临时表 + 一条 INSERT ... ON CONFLICT），返回 {rows, inserted, updated, unchanged, seconds, rows_per_s}
 def upsert_products(rows: list[dict]):         # {internal_sku, category, weight_kg_per_unit, cbm_per_unit}
     return upsert("product", rows, on_conflict=["internal_sku"])
 
@@ -47,23 +374,69 @@ def upsert_category(rows: list[dict]):         # {category, duty_rate_default}
     return upsert("category", rows, on_conflict=["category"])
 
 def upsert_sku_map(rows: list[dict]):          # {amazon_sku, marketplace, internal_sku, unit_multiplier, active}
-    return upsert("sku_map", rows, on_conflict=["amazon_sku","marketplace"])
+    n = upsert("sku_map", rows, on_conflict=["amazon_sku","marketplace"])
+    _mapping_changed(rows)
+    return n
 
 def upsert_kit_bom(rows: list[dict]):          # {amazon_sku, marketplace, component_sku, component_qty}
-    return upsert("kit_bom", rows, on_conflict=["amazon_sku","marketplace","component_sku"])
+    n = upsert("kit_bom", rows, on_conflict=["amazon_sku","marketplace","component_sku"])
+    _mapping_changed(rows)
+    return n
+
+def _mapping_changed(rows: list[dict]):
+    # 只重算这些 (amazon_sku, marketplace) 的 sku_resolve，并把新旧目标 SKU 标脏
+    import fifo
+    with connection() as conn:
+        fifo.mapping_changed(conn, {(r["amazon_sku"], r["marketplace"]) for r in rows})
 
 # 4.3 入库 & 成本池
 def upsert_batch(rows: list[dict]):            # {batch_id, container_no, arrived_at, dest_market, note}
     for r in rows:
         if isinstance(r.get("arrived_at"), (pd.Timestamp, datetime)):
             r["arrived_at"] = r["arrived_at"].date().isoformat()
-    return upsert("batch", rows, on_conflict=["batch_id"])
+    _batches_dirty(rows)  # 旧到货日期
+    n = upsert("batch", rows, on_conflict=["batch_id"])
+    _batches_dirty(rows)  # 新到货日期
+    _lots_changed(rows)
+    return n
 
 def upsert_inbound_items(rows: list[dict]):    # {batch_id, internal_sku, category, qty_in, fob_unit, cbm_per_unit, weight_kg_per_unit, duty_override_unit}
-    return upsert("inbound_items", rows, on_conflict=["batch_id","internal_sku"])
+    n = upsert("inbound_items", rows, on_conflict=["batch_id","internal_sku"])
+    _costs_changed(rows)
+    _lots_changed(rows)
+    _inbound_dirty(rows)
+    return n
 
 def upsert_batch_cost_pool(rows: list[dict]):  # {batch_id, freight_total, clearance_total}
-    return upsert("batch_cost_pool", rows, on_conflict=["batch_id"])
+    n = upsert("batch_cost_pool", rows, on_conflict=["batch_id"])
+    _costs_changed(rows)
+    return n
 
 def upsert_batch_duty_pool(rows: list[dict]):  # {batch_id, category, duty_total}
-    return upsert("batch_duty_pool", rows, on_conflict=["batch_id","category"])
+    n = upsert("batch_duty_pool", rows, on_conflict=["batch_id","category"])
+    _costs_changed(rows)
+    return n
+
+def _costs_changed(rows: list[dict]):
+    # 这些柜子的到岸成本下次 rebuild 时重算（landed.reprice_dirty）
+    import landed
+    with connection() as conn:
+        landed.mark_batches(conn, {r["batch_id"] for r in rows})
+
+def _batches_dirty(rows: list[dict]):
+    # 这些柜子里的内部 SKU 从到货日期起标脏（fifo_dirty），下次 recompute_dirty 只重放它们
+    import fifo
+    with connection() as conn:
+        fifo.mark_dirty_batches(conn, {r["batch_id"] for r in rows})
+
+def _inbound_dirty(rows: list[dict]):
+    # 这些 (batch_id, internal_sku) 的内部 SKU 从柜子到货日期起标脏
+    import fifo
+    with connection() as conn:
+        fifo.mark_dirty_inbound(conn, {(r["batch_id"], r["internal_sku"]) for r in rows})
+
+def _lots_changed(rows: list[dict]):
+    # 到货日期 / 入库数量变了：重写这些柜子在库存流水（ledger）里的入库记录
+    import ledger
+    with connection() as conn:
+        ledger.refresh_inbound(conn, {r["batch_id"] for r in rows})
@@ -0,0 +1,267 @@
+# perf.py
+# -----------------------------------------------
+# Stage / query instrumentation for pipeline runs:
+#   - perf.run(kind, ym) wraps a job, perf.stage(name) each of its stages
+#   - db.fetch_df / fetch_frame / exec_sql / exec_many / merge / delete_keys and worker.run_sql report every call through perf.timed()
+#   - when the run ends, one row per stage and one per (stage, call type) go to `run_log`
+#     (seconds, calls, rows touched, slowest statement)
+#   - perf.add_hook(fn) receives every event as it happens (print, metrics, ad-hoc profiling)
+#
+# Env: PERF_LOG (default 1; 0 turns recording and run_log writes off),
+#      PERF_PROFILE (comma-separated stage names or "*": run those stages under cProfile and
+#      keep the top functions in run_log.detail).
+
+import os
+import io
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+import contextlib
+from datetime import datetime, timezone
+
+RUN_LOG_DDL = """
+create table if not exists run_log (
+  id          bigserial primary key,
+  run_id      text             not null,
+  kind        text,
+  ym          text,
+  stage       text             not null,
+  op          text             not null,      -- run | stage | fetch_df | fetch_frame | exec_sql | exec_many | merge | delete_keys | run_sql
+  calls       integer          not null default 1,
+  seconds     double precision not null,
+  max_seconds double precision,
+  rows        bigint,
+  detail      text,                           -- slowest statement, cProfile top functions or error
+  started_at  timestamptz      not null,
+  created_at  timestamptz      not null default now()
+);
+create index if not exists run_log_started_idx on run_log(started_at desc);
+create index if not exists run_log_stage_idx on run_log(op, ym, stage)
+"""
+
+_local = threading.local()
+_hooks: list = []
+_schema_ready = False
+
+
+def enabled() -> bool:
+    return os.environ.get("PERF_LOG", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def add_hook(fn):
+    """fn(event: dict) is called for every stage and query; usable as a decorator."""
+    _hooks.append(fn)
+    return fn
+
+
+def remove_hook(fn):
+    if fn in _hooks:
+        _hooks.remove(fn)
+
+
+def _current():
+    return getattr(_local, "run", None)
+
+
+def _short(sql, limit=500):
+    if not isinstance(sql, str):
+        return None
+    sql = " ".join(sql.split())
+    return sql if len(sql) <= limit else sql[:limit] + " …"
+
+
+def record(op: str, seconds: float, rows=None, sql=None):
+    """Account one call to the innermost running stage (and notify hooks)."""
+    run = _current()
+    if _hooks:
+        event = {"op": op, "seconds": seconds, "rows": rows, "sql": sql,
+                 "stage": run["stack"][-1] if run and run["stack"] else None}
+        for h in list(_hooks):
+            h(event)
+    if run is None:
+        return
+    stage = run["stack"][-1] if run["stack"] else "-"
+    agg = run["ops"].setdefault((stage, op), {"calls": 0, "seconds": 0.0, "max": 0.0, "rows": 0, "detail": None})
+    agg["calls"] += 1
+    agg["seconds"] += seconds
+    if rows is not None and rows >= 0:
+        agg["rows"] += rows
+        for name in run["stack"]:
+            run["stage_rows"][name] = run["stage_rows"].get(name, 0) + rows
+    if seconds >= agg["max"]:
+        agg["max"] = seconds
+        agg["detail"] = _short(sql)
+
+
+@contextlib.contextmanager
+def timed(op: str, sql=None):
+    """
+    Time a database call: `with perf.timed("exec_many", sql) as t: ...; t["rows"] = n`.
+    Free when nothing listens (no run in this thread and no hooks).
+    """
+    box = {"rows": None}
+    if _current() is None and not _hooks:
+        yield box
+        return
+    t = time.perf_counter()
+    try:
+        yield box
+    finally:
+        record(op, time.perf_counter() - t, box["rows"], sql)
+
+
+def _profiled(name) -> bool:
+    wanted = {s.strip() for s in os.environ.get("PERF_PROFILE", "").split(",") if s.strip()}
+    return "*" in wanted or name in wanted
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Time a pipeline stage; queries issued inside it are attributed to it."""
+    run = _current()
+    if run is None and not _hooks:
+        yield
+        return
+    prof = cProfile.Profile() if run is not None and _profiled(name) else None
+    if run is not None:
+        run["stack"].append(name)
+    started = datetime.now(timezone.utc)
+    t = time.perf_counter()
+    error = None
+    try:
+        if prof:
+            prof.enable()
+        yield
+    except BaseException as e:
+        error = f"failed: {type(e).__name__}: {e}"
+        raise
+    finally:
+        if prof:
+            prof.disable()
+        seconds = time.perf_counter() - t
+        if run is not None:
+            run["stack"].pop()
+            detail = error
+            if prof:
+                out = io.StringIO()
+                pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(15)
+                detail = (error + "\n" if error else "") + out.getvalue()
+            run["stages"].append({
+                "stage": name, "seconds": seconds, "rows": run["stage_rows"].pop(name, 0),
+                "detail": detail, "started_at": started,
+            })
+        for h in list(_hooks):
+            h({"op": "stage", "stage": name, "seconds": seconds, "rows": None, "sql": None})
+
+
+@contextlib.contextmanager
+def run(kind: str, ym: str | None = None, run_id=None):
+    """
+    Collect stage and query timings for one pipeline run and write them to run_log
+    when it ends (also when it fails). Nested runs fold into the outer one.
+    """
+    if not enabled() or _current() is not None:
+        yield None
+        return
+    state = {
+        "run_id": str(run_id or uuid.uuid4().hex[:12]), "kind": kind, "ym": ym,
+        "started_at": datetime.now(timezone.utc), "stack": [], "stages": [], "ops": {}, "stage_rows": {},
+    }
+    _local.run = state
+    t = time.perf_counter()
+    error = None
+    try:
+        yield state
+    except BaseException as e:
+        error = f"failed: {type(e).__name__}: {e}"
+        raise
+    finally:
+        _local.run = None
+        state["seconds"] = time.perf_counter() - t
+        state["error"] = error
+        try:
+            _flush(state)
+        except Exception as e:  # instrumentation must never fail the job
+            print(f"perf: could not write run_log: {e}")
+
+
+def ensure_schema(conn):
+    global _schema_ready
+    if _schema_ready:
+        return
+    with conn.cursor() as cur:
+        for stmt in RUN_LOG_DDL.split(";"):
+            if stmt.strip():
+                cur.execute(stmt)
+    _schema_ready = True
+
+
+def _flush(state):
+    import pandas as pd
+    from db import connection, copy_df
+
+    common = {"run_id": state["run_id"], "kind": state["kind"], "ym": state["ym"]}
+    rows = [{
+        **common, "stage": state["kind"], "op": "run", "calls": 1, "seconds": state["seconds"],
+        "max_seconds": state["seconds"], "rows": sum(s["rows"] for s in state["stages"]),
+        "detail": state["error"], "started_at": state["started_at"],
+    }]
+    for s in state["stages"]:
+        rows.append({**common, "stage": s["stage"], "op": "stage", "calls": 1, "seconds": s["seconds"],
+                     "max_seconds": s["seconds"], "rows": s["rows"], "detail": s["detail"],
+                     "started_at": s["started_at"]})
+    for (stage_name, op), a in state["ops"].items():
+        rows.append({**common, "stage": stage_name, "op": op, "calls": a["calls"], "seconds": a["seconds"],
+                     "max_seconds": a["max"], "rows": a["rows"], "detail": a["detail"],
+                     "started_at": state["started_at"]})
+    cols = ["run_id", "kind", "ym", "stage", "op", "calls", "seconds", "max_seconds", "rows", "detail", "started_at"]
+    df = pd.DataFrame(rows, columns=cols)
+    df["rows"] = df["rows"].astype("Int64")
+    with connection() as conn:
+        ensure_schema(conn)
+        with conn.transaction(), conn.cursor() as cur:
+            copy_df(cur, "run_log", df)
+
+
+# ---------- Readers ----------
+def stage_history(limit_runs: int = 200):
+    """Stage rows of the latest runs: run_id, kind, ym, stage, seconds, rows, started_at."""
+    from db import connection, fetch_df
+
+    with connection() as conn:
+        ensure_schema(conn)
+    return fetch_df("""
+        select s.run_id, s.kind, s.ym, s.stage, s.seconds, s.rows, s.started_at
+        from run_log s
+        join (
+          select run_id from run_log where op = 'run' order by started_at desc limit %s
+        ) r on r.run_id = s.run_id
+        where s.op = 'stage'
+        order by s.started_at
+    """, (limit_runs,))
+
+
+def query_breakdown(run_id: str):
+    """Per-stage database call totals of one run, slowest first."""
+    from db import fetch_df
+
+    return fetch_df("""
+        select stage, op, calls, seconds, max_seconds, rows, detail
+        from run_log where run_id = %s and op not in ('run', 'stage')
+        order by seconds desc
+    """, (run_id,))
+
+
+def runs(limit: int = 20):
+    """Latest runs: run_id, kind, ym, started_at, seconds, rows, detail (error)."""
+    from db import connection, fetch_df
+
+    with connection() as conn:
+        ensure_schema(conn)
+    return fetch_df("""
+        select run_id, kind, ym, started_at, seconds, rows, detail
+        from run_log where op = 'run'
+        order by started_at desc limit %s
+    """, (limit,))
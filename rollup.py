@@ -0,0 +1,195 @@
+# rollup.py — month × SKU × marketplace × batch sales / COGS rollup
+# -----------------------------------------------
+# sales_rollup holds fifo_alloc pre-aggregated at (ym, internal_sku, marketplace, batch_id)
+# grain, with the lot's category alongside, so breakdowns by month, SKU, marketplace,
+# category or batch read a few thousand rows instead of scanning the allocations:
+#   - refresh(conn, yms, skus) re-aggregates just those months (and SKUs) from fifo_alloc;
+#     the FIFO engine calls it wherever it writes fifo_alloc (run_month, range backfill,
+#     recompute_dirty)
+#   - the SQL engine (`select run_month(...)` / `summarize_month(...)`) never writes
+#     fifo_alloc: the worker marks those months in rollup_uncovered instead of touching
+#     their cells, and uncovered() lists them so the breakdown can say so; re-running a
+#     month with the Python engine clears the mark
+#   - landed.reprice adds its COGS delta to the cells of the repriced lots in place
+#   - drill(dims, filters) is the Summary tab's breakdown, served from the rollup only
+#
+# batch_id '' is shortfall (demand with no stock left). `orders` counts distinct orders
+# per cell: an order spanning several cells counts once in each, so summed orders are an
+# upper bound (month_summary.orders stays exact).
+
+import grids
+from db import connection, fetch_df
+
+ROLLUP_DDL = """
+create table if not exists sales_rollup (
+  ym           text    not null,
+  internal_sku text    not null,
+  marketplace  text    not null default '',
+  batch_id     text    not null default '',   -- '' = shortfall
+  category     text,                          -- the lot's category (inbound_items)
+  orders       integer not null,
+  lines        integer not null,
+  units        bigint  not null,
+  cogs         numeric not null,
+  updated_at   timestamptz not null default now(),
+  primary key (ym, internal_sku, marketplace, batch_id)
+);
+create index if not exists sales_rollup_marketplace_idx on sales_rollup(marketplace, ym);
+create index if not exists sales_rollup_sku_idx on sales_rollup(internal_sku text_pattern_ops, ym);
+create index if not exists sales_rollup_category_idx on sales_rollup(category, ym);
+create table if not exists rollup_uncovered (
+  ym        text primary key,
+  source    text        not null,               -- who last wrote the month, e.g. 'sql engine'
+  marked_at timestamptz not null default now()
+)
+"""
+
+DIMS = ["ym", "marketplace", "category", "internal_sku", "batch_id"]
+
+# Drill-down filters, in grids.py's form: (condition, "eq" | "prefix").
+FILTERS = {
+    "from_ym": ("ym >= %s", "eq"),
+    "to_ym": ("ym <= %s", "eq"),
+    "marketplace": ("marketplace = %s", "eq"),
+    "category": ("category = %s", "eq"),
+    "sku": ("internal_sku like %s", "prefix"),
+    "batch": ("batch_id = %s", "eq"),
+}
+
+_schema_ready = False
+
+
+def ensure_schema(conn) -> bool:
+    """Create sales_rollup; the first time, fill it from every month in fifo_alloc (returns True then)."""
+    global _schema_ready
+    if _schema_ready:
+        return False
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('sales_rollup') is null, to_regclass('fifo_alloc') is not null")
+        created, have_alloc = cur.fetchone()
+        for stmt in ROLLUP_DDL.split(";"):
+            if stmt.strip():
+                cur.execute(stmt)
+    _schema_ready = True
+    if created and have_alloc:
+        rebuild(conn)
+    return created
+
+
+def rebuild(conn):
+    """Re-aggregate every month of fifo_alloc."""
+    ensure_schema(conn)
+    refresh(conn, fetch_df("select distinct ym from fifo_alloc", conn=conn)["ym"].tolist())
+
+
+def refresh(conn, yms, skus=None):
+    """
+    Rewrite the rollup cells of months `yms` (optionally only `skus`) from fifo_alloc.
+    A whole-month refresh also clears the months' rollup_uncovered marks.
+    """
+    ensure_schema(conn)
+    yms = sorted(set(yms))
+    if not yms:
+        return
+    skus = None if skus is None else sorted({str(s) for s in skus})
+    params = (yms, skus, skus)
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute("""
+            delete from sales_rollup
+            where ym = any(%s) and (%s::text[] is null or internal_sku = any(%s))
+        """, params)
+        cur.execute("""
+            insert into sales_rollup(ym, internal_sku, marketplace, batch_id, category, orders, lines, units, cogs)
+            select a.ym, a.internal_sku, coalesce(a.marketplace, ''), coalesce(a.batch_id, ''), ii.category,
+                   count(distinct a.order_id), count(*), sum(a.qty), round(sum(a.qty * coalesce(a.unit_cost, 0)), 4)
+            from fifo_alloc a
+            left join inbound_items ii on ii.batch_id = a.batch_id and ii.internal_sku = a.internal_sku
+            where a.ym = any(%s) and (%s::text[] is null or a.internal_sku = any(%s))
+            group by a.ym, a.internal_sku, coalesce(a.marketplace, ''), coalesce(a.batch_id, ''), ii.category
+        """, params)
+        if skus is None:
+            cur.execute("delete from rollup_uncovered where ym = any(%s)", (yms,))
+
+
+def mark_uncovered(conn, yms, source: str = "sql engine"):
+    """Months just (re)run by a path that does not write fifo_alloc: their cells are left as they were."""
+    ensure_schema(conn)
+    yms = sorted(set(yms))
+    if not yms:
+        return
+    with conn.cursor() as cur:
+        cur.execute("""
+            insert into rollup_uncovered(ym, source)
+            select unnest(%s::text[]), %s
+            on conflict(ym) do update set source = excluded.source, marked_at = now()
+        """, (yms, source))
+
+
+def uncovered(yms=None, conn=None):
+    """
+    month_summary months the rollup does not reflect (ym, reason): marked by mark_uncovered,
+    or with no cells at all (run before the rollup existed, or by the SQL engine).
+    """
+    with connection(conn) as c:
+        ensure_schema(c)
+    yms = None if yms is None else sorted(set(yms))
+    return fetch_df("""
+        select m.ym, coalesce(u.source, 'no allocations') as reason
+        from month_summary m
+        left join rollup_uncovered u on u.ym = m.ym
+        where (u.ym is not null or not exists (select 1 from sales_rollup r where r.ym = m.ym))
+          and (%s::text[] is null or m.ym = any(%s))
+        order by m.ym
+    """, (yms, yms), conn=conn)
+
+
+def apply_cost_delta(cur, delta_table: str):
+    """
+    Add the COGS change of repriced lots to their cells. `delta_table` has batch_id,
+    internal_sku, unit_cost (new) and must be read before fifo_alloc takes the new costs.
+    """
+    cur.execute(f"""
+        update sales_rollup r
+        set cogs = round(r.cogs + c.delta, 4), updated_at = now()
+        from (
+          select a.ym, a.internal_sku, coalesce(a.marketplace, '') as marketplace, a.batch_id,
+                 sum(a.qty * (d.unit_cost - coalesce(a.unit_cost, 0))) as delta
+          from fifo_alloc a
+          join {delta_table} d on d.batch_id = a.batch_id and d.internal_sku = a.internal_sku
+          group by 1, 2, 3, 4
+        ) c
+        where r.ym = c.ym and r.internal_sku = c.internal_sku and r.marketplace = c.marketplace
+          and r.batch_id = c.batch_id and c.delta <> 0
+    """)
+
+
+# ---------- Drill-down ----------
+def drill(dims, filters: dict | None = None, limit: int = 500, conn=None):
+    """
+    Units, COGS, lines and orders grouped by `dims` (a subset of DIMS; none: one total row),
+    largest COGS first. Filters: see FILTERS; empty values are ignored.
+    """
+    with connection(conn) as c:
+        ensure_schema(c)
+    dims = [d for d in DIMS if d in set(dims)]
+    unknown = set(filters or {}) - set(FILTERS)
+    if unknown:
+        raise ValueError(f"Unknown rollup filter(s): {', '.join(sorted(unknown))}")
+    where, params = [], []
+    for name, value in (filters or {}).items():
+        if value in (None, ""):
+            continue
+        cond, kind = FILTERS[name]
+        where.append(cond)
+        params.append(grids.like_prefix(str(value)) if kind == "prefix" else value)
+    select = ", ".join(dims + [""]) if dims else ""
+    sql = (
+        f"select {select}sum(units) as units, round(sum(cogs), 2) as cogs, "
+        "round(sum(cogs) / nullif(sum(units), 0), 4) as unit_cogs, "
+        "sum(lines) as lines, sum(orders) as orders_max "
+        "from sales_rollup"
+        + (" where " + " and ".join(where) if where else "")
+        + (f" group by {', '.join(dims)}" if dims else "")
+        + f" order by cogs desc nulls last limit {int(limit)}"
+    )
+    return fetch_df(sql, tuple(params), conn=conn)
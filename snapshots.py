@@ -0,0 +1,251 @@
+# snapshots.py — month-end lot balances stored as deltas
+# -----------------------------------------------
+# A month's snapshot keeps only the (internal_sku, batch_id) balances that differ from
+# the previous snapshot month (a lot that disappeared is stored as 0). The first snapshot,
+# and the first one SNAPSHOT_KEYFRAME_MONTHS months (default 12) or more after the previous
+# keyframe, store the full balance instead, so rebuilding a month reads one keyframe plus
+# at most that many months of deltas — history cost stays flat as months accumulate.
+#
+#   write(conn, [(ym, lots), ...], skus=None)  store month-end states (skus: only those SKUs' rows)
+#   read(conn, ym, skus=None, columns=None)     rebuild a month's lots
+#   months(conn), latest_before(conn, ym)       which months have snapshots
+#   export_parquet(conn, ym) / read_parquet(ym) optional per-month Parquet files (pyarrow),
+#                                               under SNAPSHOT_EXPORT_DIR (default ./snapshots)
+#
+# Rewriting a month re-encodes the deltas after it (up to the next unchanged month),
+# so months can be written in any order.
+
+import os
+
+import pandas as pd
+
+from db import fetch_df, copy_df
+
+SNAPSHOT_DDL = """
+create table if not exists lot_snapshot_month (
+  ym         text primary key,
+  keyframe   boolean     not null,
+  delta_rows integer     not null,
+  lots       integer     not null,          -- lots in the full month-end state
+  created_at timestamptz not null default now()
+);
+create table if not exists lot_snapshot (
+  ym            text    not null,
+  internal_sku  text    not null,
+  batch_id      text    not null,
+  qty_remaining integer not null,
+  primary key (internal_sku, batch_id, ym)
+);
+create index if not exists lot_snapshot_ym_idx on lot_snapshot(ym)
+"""
+
+COLS = ["internal_sku", "batch_id", "qty_remaining"]
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Create the snapshot tables; the first time, convert existing lot_checkpoint months."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('lot_snapshot_month') is null, to_regclass('lot_checkpoint') is not null")
+        created, legacy = cur.fetchone()
+        for stmt in SNAPSHOT_DDL.split(";"):
+            if stmt.strip():
+                cur.execute(stmt)
+    _schema_ready = True
+    if created and legacy:
+        _migrate_checkpoints(conn)
+
+
+def _migrate_checkpoints(conn):
+    cps = fetch_df("select ym, internal_sku, batch_id, qty_remaining from lot_checkpoint order by ym", conn=conn)
+    if not cps.empty:
+        write(conn, [(ym, g[COLS]) for ym, g in cps.groupby("ym", sort=True)])
+
+
+def _keyframe_every() -> int:
+    return max(1, int(os.environ.get("SNAPSHOT_KEYFRAME_MONTHS", 12)))
+
+
+def _ordinal(ym: str) -> int:
+    y, m = ym.split("-")[:2]
+    return int(y) * 12 + int(m) - 1
+
+
+def _is_keyframe(ym: str, last_keyframe: str | None, every: int) -> bool:
+    """A new snapshot month is a keyframe when it is `every` months or more after the last one."""
+    return last_keyframe is None or _ordinal(ym) - _ordinal(last_keyframe) >= every
+
+
+def _state(df: pd.DataFrame | None) -> pd.Series:
+    """lots -> qty_remaining Series indexed by (internal_sku, batch_id)."""
+    if df is None or df.empty:
+        return pd.Series(dtype="int64", index=pd.MultiIndex.from_tuples([], names=COLS[:2]), name="qty_remaining")
+    s = df[COLS].astype({"internal_sku": str, "batch_id": str}).set_index(COLS[:2])["qty_remaining"]
+    return pd.to_numeric(s, errors="coerce").fillna(0).astype("int64")
+
+
+def _delta(base: pd.Series, new: pd.Series) -> pd.Series:
+    """Rows of `new` that differ from `base`; lots only in `base` come back as 0."""
+    old, cur = base.align(new, join="outer")
+    cur = cur.fillna(0).astype("int64")
+    changed = old.isna() | (old.fillna(0).astype("int64") != cur)
+    return cur[changed]
+
+
+# ---------- Catalog ----------
+def months(conn=None) -> pd.DataFrame:
+    """Snapshot months: ym, keyframe, delta_rows, lots, created_at."""
+    return fetch_df("select ym, keyframe, delta_rows, lots, created_at from lot_snapshot_month order by ym", conn=conn)
+
+
+def latest_before(conn, ym: str) -> str | None:
+    """Latest snapshot month strictly before `ym` (None if there is none)."""
+    ensure_schema(conn)
+    return fetch_df("select max(ym) as ym from lot_snapshot_month where ym < %s", (ym,), conn=conn)["ym"].iloc[0]
+
+
+# ---------- Reader ----------
+def read(conn, ym: str, skus: list[str] | None = None, columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    Month-end lots of `ym` (internal_sku, batch_id, qty_remaining), rebuilt from the
+    nearest keyframe at or before it. `columns` limits what is returned and fetched.
+    Empty if `ym` itself has no snapshot.
+    """
+    ensure_schema(conn)
+    columns = [c for c in (columns or COLS) if c in COLS]
+    keys = ["internal_sku", "batch_id"]
+    df = fetch_df(f"""
+        with kf as (
+            select max(ym) as ym from lot_snapshot_month where keyframe and ym <= %(ym)s
+        )
+        select distinct on (s.internal_sku, s.batch_id) {", ".join("s." + c for c in dict.fromkeys(keys + columns))}
+        from lot_snapshot s, kf
+        where exists (select 1 from lot_snapshot_month where ym = %(ym)s)
+          and s.ym <= %(ym)s and (kf.ym is null or s.ym >= kf.ym)
+          and (%(skus)s::text[] is null or s.internal_sku = any(%(skus)s))
+        order by s.internal_sku, s.batch_id, s.ym desc
+    """, {"ym": ym, "skus": list(skus) if skus is not None else None}, conn=conn)
+    if df.empty:
+        df = pd.DataFrame(columns=list(dict.fromkeys(keys + columns)))
+    if "qty_remaining" in df:
+        df["qty_remaining"] = pd.to_numeric(df["qty_remaining"]).astype("int64")
+    return df[columns].reset_index(drop=True)
+
+
+# ---------- Writer ----------
+def write(conn, states, skus: list[str] | None = None) -> dict:
+    """
+    Store month-end states [(ym, lots DataFrame)]. With `skus`, the frames hold only
+    those SKUs and only their rows are replaced; other SKUs keep their history.
+    Runs in the caller's transaction when there is one.
+    """
+    ensure_schema(conn)
+    new = {ym: _state(df) for ym, df in sorted(states, key=lambda s: s[0])}
+    if not new:
+        return {"months": 0, "delta_rows": 0}
+    first, last = min(new), max(new)
+    meta = fetch_df("select ym, keyframe from lot_snapshot_month order by ym", conn=conn)
+    keyframe = dict(zip(meta["ym"], meta["keyframe"].astype(bool)))
+    existing = list(meta["ym"])
+    if skus is not None and set(new) - set(existing):
+        raise ValueError(f"Partial snapshot write for months without a snapshot: {sorted(set(new) - set(existing))}")
+
+    # Months after `first` that are not rewritten but whose delta is relative to one that is:
+    # re-encode them from their current (old) state, read before anything changes.
+    after = [m for m in existing if m > first and m not in new]
+    follow = [m for m in after if m < last] + [m for m in after if m > last][:1]
+    old = {m: _state(read(conn, m, skus)) for m in follow}
+    prev = max((m for m in existing if m < first), default=None)
+    base = _state(read(conn, prev, skus)) if prev else _state(None)
+    last_kf = max((m for m in existing if m < first and keyframe[m]), default=None)
+
+    every = _keyframe_every()
+    rows, meta_rows = [], []
+    for ym, state in sorted({**new, **old}.items()):
+        if ym not in keyframe:
+            keyframe[ym] = _is_keyframe(ym, last_kf, every)
+        if keyframe[ym]:
+            last_kf = ym
+        enc = state if keyframe[ym] else _delta(base, state)
+        rows.append(enc.rename("qty_remaining").reset_index().assign(ym=ym))
+        meta_rows.append((ym, keyframe[ym], len(state)))
+        base, prev = state, ym
+
+    out = pd.concat(rows, ignore_index=True)[["ym"] + COLS]
+    yms = [m for m, _, _ in meta_rows]
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute(
+            "delete from lot_snapshot where ym = any(%s) and (%s::text[] is null or internal_sku = any(%s))",
+            (yms, skus, skus),
+        )
+        copy_df(cur, "lot_snapshot", out)
+        for ym, kf, n in meta_rows:
+            cur.execute("""
+                insert into lot_snapshot_month(ym, keyframe, delta_rows, lots)
+                values (%s, %s, 0, %s)
+                on conflict(ym) do nothing
+            """, (ym, kf, n))
+        # Row counts reflect the table, whichever SKUs were rewritten.
+        cur.execute("""
+            update lot_snapshot_month m set
+              delta_rows = (select count(*) from lot_snapshot s where s.ym = m.ym),
+              lots = case when %s::text[] is null then x.lots else m.lots end,
+              created_at = now()
+            from unnest(%s::text[], %s::int[]) as x(ym, lots)
+            where m.ym = x.ym
+        """, (skus, yms, [n for _, _, n in meta_rows]))
+    return {"months": len(yms), "delta_rows": len(out)}
+
+
+def snapshot_month(conn, ym: str) -> dict:
+    """Store the current lot_balance as the month-end snapshot of `ym` (+ Parquet if SNAPSHOT_EXPORT_DIR is set)."""
+    lots = fetch_df("select internal_sku, batch_id, coalesce(qty_remaining, 0) as qty_remaining from lot_balance",
+                    conn=conn)
+    out = write(conn, [(ym, lots)])
+    if os.environ.get("SNAPSHOT_EXPORT_DIR"):
+        out["parquet"] = export_parquet(conn, ym)
+    return out
+
+
+# ---------- Parquet export (optional: pyarrow) ----------
+def _export_dir(directory=None) -> str:
+    return directory or os.environ.get("SNAPSHOT_EXPORT_DIR") or "snapshots"
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Parquet export needs pyarrow: pip install pyarrow") from e
+    return pa, pq
+
+
+def export_parquet(conn, ym: str, directory: str | None = None) -> str:
+    """Write `ym`'s full month-end lots to <dir>/ym=<ym>/lots.parquet (sorted by SKU for row-group pruning)."""
+    pa, pq = _pyarrow()
+    df = read(conn, ym).sort_values(["internal_sku", "batch_id"], kind="stable")
+    path = os.path.join(_export_dir(directory), f"ym={ym}")
+    os.makedirs(path, exist_ok=True)
+    table = pa.Table.from_pandas(
+        df.astype({"internal_sku": "category", "batch_id": "category", "qty_remaining": "int32"}),
+        preserve_index=False,
+    )
+    file = os.path.join(path, "lots.parquet")
+    pq.write_table(table, file, compression="zstd", row_group_size=64_000)
+    return file
+
+
+def read_parquet(ym: str, skus: list[str] | None = None, columns: list[str] | None = None,
+                 directory: str | None = None) -> pd.DataFrame:
+    """An exported month, reading only `columns` and the row groups that can hold `skus`."""
+    _, pq = _pyarrow()
+    file = os.path.join(_export_dir(directory), f"ym={ym}", "lots.parquet")
+    columns = [c for c in (columns or COLS) if c in COLS]
+    filters = [("internal_sku", "in", list(skus))] if skus is not None else None
+    df = pq.read_table(file, columns=columns, filters=filters).to_pandas()
+    return df.astype({c: str for c in ("internal_sku", "batch_id") if c in df})
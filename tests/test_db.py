@@ -0,0 +1,116 @@
+import contextlib
+import os
+import uuid
+
+import pandas as pd
+import psycopg
+import pytest
+
+import db
+
+
+# ---------- A save through pipeline(), without a server ----------
+class _Copy:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, data):
+        self.conn.copied.append(data)
+
+
+class _Cursor:
+    """Enough of a psycopg cursor for merge() / delete_keys(); COPY fails in pipeline mode like psycopg's."""
+
+    def __init__(self, conn):
+        self.conn, self.rowcount = conn, 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append(sql)
+        self.rowcount = 1
+
+    def copy(self, statement):
+        if self.conn._pipeline is not None:
+            raise psycopg.NotSupportedError("COPY cannot be used in pipeline mode")
+        return _Copy(self.conn)
+
+    def fetchone(self):
+        return (1, 0)
+
+
+class _Conn:
+    def __init__(self):
+        self._pipeline, self.executed, self.copied = None, [], []
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        self._pipeline = object()
+        try:
+            yield
+        finally:
+            self._pipeline = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        yield
+
+    def cursor(self):
+        return _Cursor(self)
+
+
+class _Pool:
+    def __init__(self):
+        self.conn = _Conn()
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self.conn
+
+
+def test_save_through_pipeline_can_copy(monkeypatch):
+    pool = _Pool()
+    monkeypatch.setattr(db, "get_pool", lambda: pool)
+    with db.pipeline() as conn:
+        assert conn._pipeline is None
+        db.delete_keys("duty_pool", ["batch_id", "category"], [("B1", "toys")], conn=conn)
+        out = db.merge("duty_pool", pd.DataFrame({"batch_id": ["B2"], "category": ["toys"], "duty_total": [5.0]}),
+                       ["batch_id", "category"], conn=conn)
+    assert out["inserted"] == 1 and out["rows"] == 1
+    assert len(pool.conn.copied) == 2
+
+
+# ---------- Same save against a real database (TEST_DB_DSN) ----------
+@pytest.fixture
+def real_db(monkeypatch):
+    dsn = os.environ.get("TEST_DB_DSN")
+    if not dsn:
+        pytest.skip("TEST_DB_DSN not set")
+    monkeypatch.setenv("DB_DSN", dsn)
+    monkeypatch.setattr(db, "_pool", None)
+    monkeypatch.setattr(db, "_toml_secrets", lambda: {})
+    table = f"_test_merge_{uuid.uuid4().hex[:8]}"
+    db.exec_sql(f"create table {table} (k text primary key, v integer)")
+    yield table
+    db.exec_sql(f"drop table if exists {table}")
+    db.get_pool().close()
+
+
+def test_save_through_pipeline_real_db(real_db):
+    db.exec_sql(f"insert into {real_db} values ('a', 1), ('b', 2)")
+    with db.pipeline() as conn:
+        assert db.delete_keys(real_db, ["k"], [("a",)], conn=conn) == 1
+        out = db.merge(real_db, pd.DataFrame({"k": ["b", "c"], "v": [20, 3]}), ["k"], conn=conn)
+    assert (out["inserted"], out["updated"]) == (1, 1)
+    rows = db.fetch_df(f"select k, v from {real_db} order by k")
+    assert rows.values.tolist() == [["b", 20], ["c", 3]]
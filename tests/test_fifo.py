@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+import pandas.testing as tm
+import pytest
+
+import fifo
+
+LOT_COLS = ["internal_sku", "batch_id", "qty_remaining", "arrived_at", "unit_cost"]
+DEMAND_COLS = ["order_id", "date_time", "marketplace", "amazon_sku", "internal_sku", "units"]
+
+
+def lots_frame(rows):
+    df = pd.DataFrame(rows, columns=LOT_COLS)
+    df["arrived_at"] = pd.to_datetime(df["arrived_at"])
+    return df.astype({"qty_remaining": "int64", "unit_cost": float})
+
+
+def demand_frame(rows):
+    """rows: (order_id, date_time, internal_sku, units)"""
+    return pd.DataFrame(
+        [(o, t, "amazon.com", f"AMZ-{s}", s, u) for o, t, s, u in rows], columns=DEMAND_COLS
+    ).astype({"units": "int64"})
+
+
+def lines(alloc):
+    return [(r.order_id, r.internal_sku, r.batch_id, r.qty, None if pd.isna(r.unit_cost) else r.unit_cost)
+            for r in alloc.itertuples()]
+
+
+def balances(lots_after):
+    return {(r.internal_sku, r.batch_id): (r.qty_remaining, r.consumed) for r in lots_after.itertuples()}
+
+
+def test_group_cumsum_restarts_per_code():
+    values = np.array([1, 2, 3, 4, 5, 6])
+    codes = np.array([0, 0, 1, 1, 1, 3])
+    assert fifo._group_cumsum(values, codes).tolist() == [1, 3, 3, 7, 12, 6]
+
+
+def test_multi_lot_consumption_in_arrival_order():
+    lots = lots_frame([
+        ("A", "B2", 10, "2024-02-01", 2.0),   # listed first, arrived later
+        ("A", "B1", 5, "2024-01-01", 1.0),
+    ])
+    demand = demand_frame([("o2", "2024-03-02 10:00", "A", 6), ("o1", "2024-03-01 09:00", "A", 7)])
+    alloc, after = fifo.allocate(lots, demand)
+    assert lines(alloc) == [
+        ("o1", "A", "B1", 5, 1.0),
+        ("o1", "A", "B2", 2, 2.0),
+        ("o2", "A", "B2", 6, 2.0),
+    ]
+    assert balances(after) == {("A", "B1"): (0, 5), ("A", "B2"): (2, 8)}
+
+
+def test_shortfall_beyond_stock():
+    lots = lots_frame([("A", "B1", 5, "2024-01-01", 1.0), ("A", "B2", 3, "2024-02-01", 2.0)])
+    demand = demand_frame([("o1", "2024-03-01", "A", 4), ("o2", "2024-03-02", "A", 6)])
+    alloc, after = fifo.allocate(lots, demand)
+    assert lines(alloc) == [
+        ("o1", "A", "B1", 4, 1.0),
+        ("o2", "A", "B1", 1, 1.0),
+        ("o2", "A", "B2", 3, 2.0),
+        ("o2", "A", None, 2, None),
+    ]
+    assert balances(after) == {("A", "B1"): (0, 5), ("A", "B2"): (0, 3)}
+    assert fifo.summarize(alloc) == {"orders": 2, "units": 10, "cogs": 11.0, "shortfall_units": 2}
+
+
+def test_zero_and_negative_lots_are_skipped():
+    lots = lots_frame([
+        ("A", "B0", 0, "2024-01-01", 9.0),
+        ("A", "BN", -3, "2024-01-02", 9.0),
+        ("A", "B1", 4, "2024-01-03", 1.0),
+    ])
+    demand = demand_frame([("o1", "2024-03-01", "A", 5)])
+    alloc, after = fifo.allocate(lots, demand)
+    assert lines(alloc) == [("o1", "A", "B1", 4, 1.0), ("o1", "A", None, 1, None)]
+    # A negative lot is left as it was, not "refilled" by the clip.
+    assert balances(after) == {("A", "B0"): (0, 0), ("A", "BN"): (-3, 0), ("A", "B1"): (0, 4)}
+
+
+def test_sku_without_lots_is_all_shortfall():
+    lots = lots_frame([("A", "B1", 5, "2024-01-01", 1.0)])
+    demand = demand_frame([("o1", "2024-03-01", "Z", 3), ("o2", "2024-03-01", "A", 2)])
+    alloc, after = fifo.allocate(lots, demand)
+    assert lines(alloc) == [("o2", "A", "B1", 2, 1.0), ("o1", "Z", None, 3, None)]
+    assert balances(after) == {("A", "B1"): (3, 2)}
+
+
+def test_no_demand_leaves_lots_untouched():
+    lots = lots_frame([("A", "B1", 5, "2024-01-01", 1.0)])
+    alloc, after = fifo.allocate(lots, demand_frame([]))
+    assert alloc.empty
+    assert balances(after) == {("A", "B1"): (5, 0)}
+
+
+def test_allocate_month_holds_back_later_arrivals():
+    lots = lots_frame([
+        ("A", "B1", 5, "2024-01-10", 1.0),
+        ("A", "B2", 10, "2024-06-01", 2.0),
+        ("A", "B0", 1, None, 0.5),  # undated: always on hand, consumed last
+    ])
+    demand = demand_frame([("o1", "2024-01-20", "A", 8)])
+    alloc, after = fifo.allocate_month(lots, demand, "2024-01")
+    assert lines(alloc) == [("o1", "A", "B1", 5, 1.0), ("o1", "A", "B0", 1, 0.5), ("o1", "A", None, 2, None)]
+    assert balances(after) == {("A", "B0"): (0, 1), ("A", "B1"): (0, 5), ("A", "B2"): (10, 0)}
+    alloc, _ = fifo.allocate_month(lots, demand, "2024-06")
+    assert lines(alloc) == [("o1", "A", "B1", 5, 1.0), ("o1", "A", "B2", 3, 2.0)]
+
+
+def _random_month(seed=7, skus=300, lines_per_sku=20):
+    rng = np.random.default_rng(seed)
+    names = [f"SKU{i:04d}" for i in range(skus)]
+    lot_rows = []
+    for s in names:
+        for j in range(rng.integers(0, 4)):
+            lot_rows.append((s, f"{s}-L{j}", int(rng.integers(-2, 40)),
+                             pd.Timestamp("2024-01-01") + pd.Timedelta(days=int(rng.integers(0, 60))),
+                             float(rng.uniform(1, 5))))
+    dem_rows = []
+    for s in names:
+        for k in range(rng.integers(0, lines_per_sku)):
+            dem_rows.append((f"o{s}-{k}", f"2024-03-{rng.integers(1, 29):02d} 12:00", s, int(rng.integers(0, 6))))
+    return lots_frame(lot_rows), demand_frame(dem_rows)
+
+
+def test_allocate_sharded_matches_allocate(monkeypatch):
+    lots, demand = _random_month()
+    monkeypatch.setenv("FIFO_SHARD_MIN_ROWS", "0")
+    expect_alloc, expect_lots = fifo.allocate(lots, demand)
+    alloc, after = fifo.allocate_sharded(lots, demand, workers=2)
+    tm.assert_frame_equal(alloc, expect_alloc)
+    tm.assert_frame_equal(after, expect_lots)
+    # Every unit of demand is allocated or reported short, and FIFO never takes a lot below zero.
+    assert alloc["qty"].sum() == demand["units"].sum()
+    assert (after.loc[after["consumed"] > 0, "qty_remaining"] >= 0).all()
+
+
+def test_range_opening_replays_months_since_the_last_checkpoint(monkeypatch):
+    # Checkpoint 2024-01; 2024-02 was processed (e.g. by the SQL engine) but has no checkpoint.
+    monkeypatch.setattr(fifo.snapshots, "latest_before", lambda conn, ym: "2024-01")
+    monkeypatch.setattr(fifo, "fetch_df", lambda sql, params=None, conn=None: pd.DataFrame({"ym": ["2024-02"]}))
+    monkeypatch.setattr(fifo, "_opening_lots", lambda conn, skus, cp: lots_frame([("S", "B1", 5, "2023-12-01", 1.0)]))
+    demand = demand_frame([("o1", "2024-02-03", "S", 2)]).assign(ym="2024-02")
+    monkeypatch.setattr(fifo, "load_demand", lambda conn, yms, skus=None: demand)
+
+    lots, opening = fifo._range_opening(None, ["2024-03", "2024-04"])
+    assert opening == "checkpoint 2024-01, replayed 2024-02..2024-02"
+    assert lots["qty_remaining"].tolist() == [3]
+    assert "consumed" not in lots
+
+
+def test_month_last_run_by_sql_engine_is_restated_as_a_range(monkeypatch):
+    monkeypatch.setattr(fifo, "ensure_schema", lambda conn: None)
+    monkeypatch.setattr(fifo.rollup, "ensure_schema", lambda conn: None)
+    monkeypatch.setattr(fifo, "fetch_df", lambda sql, params=None, conn=None: pd.DataFrame({"ym": ["2024-02"]}))
+    monkeypatch.setattr(fifo, "unmapped", lambda conn, ym: pd.DataFrame())
+    ranges = []
+
+    def run_range(conn, start, end, workers=None):
+        ranges.append((start, end))
+        return [{"ym": start, "orders": 1, "units": 2, "cogs": 3.0, "shortfall_units": 0}]
+
+    monkeypatch.setattr(fifo, "run_range", run_range)
+    with pytest.raises(ValueError, match="SQL engine"):
+        fifo.plan_month(None, "2024-02")
+    assert fifo.run_month(None, "2024-02")["units"] == 2
+    assert ranges == [("2024-02", "2024-02")]
+
+
+def test_unmapped_creates_the_schema_first(monkeypatch):
+    calls = []
+    monkeypatch.setattr(fifo, "ensure_schema", lambda conn: calls.append("schema"))
+    monkeypatch.setattr(fifo, "fetch_df", lambda sql, params=None, conn=None: calls.append("query") or pd.DataFrame())
+    fifo.unmapped(conn=object(), yms="2024-02")
+    assert calls == ["schema", "query"]
@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+import landed
+
+ITEM_COLS = ["batch_id", "internal_sku", "category", "qty_in", "fob_unit", "cbm_per_unit"]
+
+
+def costs(items, batch_cost, duty):
+    out = landed.compute_lot_costs(
+        pd.DataFrame(items, columns=ITEM_COLS),
+        pd.DataFrame(batch_cost, columns=["batch_id", "freight_total", "clearance_total"]),
+        pd.DataFrame(duty, columns=["batch_id", "category", "duty_total"]),
+    )
+    return out.set_index(["batch_id", "internal_sku"])
+
+
+def test_freight_by_cbm_and_duty_by_category_value():
+    out = costs(
+        [("X", "A", "toys", 10, 2.0, 0.1),    # cbm 1, value 20
+         ("X", "B", "toys", 30, 1.0, 0.1),    # cbm 3, value 30
+         ("X", "C", "tools", 5, 4.0, 0.2)],   # cbm 1, value 20
+        [("X", 400, 100)],
+        [("X", "toys", 50), ("X", "tools", 8)],
+    )
+    assert out.loc[("X", "A"), "freight_unit"] == pytest.approx(10.0)  # 500 × 1/5 / 10
+    assert out.loc[("X", "C"), "freight_unit"] == pytest.approx(20.0)  # 500 × 1/5 / 5
+    assert out.loc[("X", "A"), "duty_unit"] == pytest.approx(2.0)      # 50 × 20/50 / 10
+    assert out.loc[("X", "C"), "duty_unit"] == pytest.approx(1.6)      # 8 × 20/20 / 5
+    assert out["unit_cost"].to_dict() == pytest.approx({("X", "A"): 14.0, ("X", "B"): 12.0, ("X", "C"): 25.6})
+    # The pools are fully spread over the lots.
+    total = (out["freight_unit"] * [10, 30, 5]).sum()
+    assert total == pytest.approx(500)
+
+
+def test_missing_cbm_falls_back_to_quantity_share():
+    out = costs([("Y", "D", None, 1, 1.0, 0), ("Y", "E", None, 3, None, None)], [("Y", 30, 10)], [])
+    assert out["freight_unit"].tolist() == pytest.approx([10.0, 10.0])
+    assert out["duty_unit"].tolist() == [0.0, 0.0]
+    assert out["unit_cost"].tolist() == pytest.approx([11.0, 10.0])  # missing FOB counts as 0
+
+
+def test_zero_quantity_lot_costs_its_fob_and_takes_no_pool():
+    out = costs([("Z", "F", "toys", 0, 5.0, 0.5), ("Z", "G", "toys", 2, 1.0, 0.5)], [("Z", 10, 0)], [("Z", "toys", 4)])
+    assert out.loc[("Z", "F"), "unit_cost"] == pytest.approx(5.0)
+    assert out.loc[("Z", "G"), "unit_cost"] == pytest.approx(1.0 + 5.0 + 2.0)
+
+
+def test_batch_without_cost_rows_is_fob_only():
+    out = costs([("W", "H", "toys", 4, 3.0, 0.1)], [], [])
+    assert out["unit_cost"].tolist() == [3.0]
+    assert list(out.reset_index().columns) == landed.LOT_COLS + ["freight_unit", "duty_unit"]
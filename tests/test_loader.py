@@ -0,0 +1,67 @@
+import contextlib
+
+import pandas as pd
+
+import fifo
+import loader
+
+
+def test_settlement_rows_mark_their_skus_dirty_from_the_earliest_date(monkeypatch):
+    marked = []
+    monkeypatch.setattr(loader, "connection", contextlib.nullcontext)
+    monkeypatch.setattr(fifo, "mark_dirty_sales_rows", lambda conn, rows: marked.extend(rows))
+    loader._sales_changed(pd.DataFrame({
+        "amazon_sku": ["A", "A", "B"],
+        "marketplace": ["amazon.de", "amazon.de", "amazon.com"],
+        "happened_at": pd.to_datetime(["2024-03-05 10:00", "2024-02-10 08:00", "2024-03-01 00:00"], utc=True),
+    }))
+    assert sorted(marked) == [("A", "amazon.de", "2024-02-10"), ("B", "amazon.com", "2024-03-01")]
+
+
+def test_infer_marketplace_needs_a_domain_or_a_delimited_code():
+    assert loader.infer_marketplace("amazon.de_2024-01.csv") == "amazon.de"
+    assert loader.infer_marketplace("zips/sales_UK_2024-01.csv") == "amazon.co.uk"
+    assert loader.infer_marketplace("orders-jp.csv") == "amazon.co.jp"
+    assert loader.infer_marketplace("sales_IT_2024-01.csv") == "amazon.it"
+    # Codes that are also words only count in capitals; conflicting codes give nothing.
+    assert loader.infer_marketplace("settlement_in_2024.csv") is None
+    assert loader.infer_marketplace("it_is_com_report.csv") is None
+    assert loader.infer_marketplace("uk_vs_de.csv") is None
+
+
+def test_parse_sales_file_reports_where_the_marketplace_came_from():
+    data = b"date/time,type,order id,sku,quantity\n2024-01-05 10:00:00,Order,o1,A,2\n"
+    res = loader.parse_sales_file("sales_DE_2024-01.csv", data, "2024-01")
+    assert (res["marketplace"], res["marketplace_source"], res["error"]) == ("amazon.de", "file name", None)
+    res = loader.parse_sales_file("settlement_in_2024.csv", data, "2024-01")
+    assert (res["marketplace"], res["marketplace_source"]) == ("amazon.com", "default")
+
+
+def test_parse_datetimes_guesses_each_shape_separately():
+    out = loader.parse_datetimes(pd.Series([
+        "Jan 1, 2024 12:03:04 AM PST",   # US, with a zone abbreviation
+        "01.02.2024 10:00:00",           # DE: day first
+        "02.03.2024 11:00:00 CET",
+        "2024/03/04 09:30:00",           # JP
+        "not a date",
+    ]))
+    assert out.dt.tz is not None
+    assert out.iloc[:4].dt.strftime("%Y-%m-%d %H:%M").tolist() == [
+        "2024-01-01 08:03", "2024-02-01 10:00", "2024-03-02 10:00", "2024-03-04 09:30",
+    ]
+    assert pd.isna(out.iloc[4])
+
+
+def test_parse_sales_csv_keeps_orders_with_units():
+    data = (
+        "date/time,type,order id,sku,quantity,marketplace\n"
+        "01.02.2024 10:00:00,Order,o1,A,2,amazon.de\n"
+        "01.02.2024 10:00:00,Order,o1,A,3,amazon.de\n"     # same key: the last row wins
+        "02.02.2024 10:00:00,Refund,o2,A,1,amazon.de\n"
+        "03.02.2024 10:00:00,Order,o3,B,0,amazon.de\n"
+        "bad,Order,o4,B,1,amazon.de\n"
+    ).encode()
+    df = loader.parse_sales_csv(data, marketplace=None)
+    assert df[["order_id", "amazon_sku", "quantity", "marketplace"]].values.tolist() == [["o1", "A", 3, "amazon.de"]]
+    assert df["happened_at"].iloc[0] == pd.Timestamp("2024-02-01 10:00", tz="UTC")
+    assert loader.parse_sales_csv(data, "amazon.fr")["marketplace"].tolist() == ["amazon.fr"]
@@ -0,0 +1,42 @@
+import pandas as pd
+
+import snapshots
+
+
+def test_keyframe_counts_months_since_the_last_keyframe():
+    # No January snapshot: the chain still restarts a year after the first keyframe.
+    months = ["2023-03", "2023-05", "2023-09", "2024-02", "2024-03", "2024-04", "2025-03", "2025-04"]
+    last, keyframes = None, []
+    for ym in months:
+        if snapshots._is_keyframe(ym, last, 12):
+            keyframes.append(ym)
+            last = ym
+    assert keyframes == ["2023-03", "2024-03", "2025-03"]
+
+
+def test_keyframe_every_month():
+    assert snapshots._is_keyframe("2024-02", "2024-01", 1)
+    assert not snapshots._is_keyframe("2024-02", "2024-01", 2)
+
+
+def state(rows):
+    return snapshots._state(pd.DataFrame(rows, columns=snapshots.COLS))
+
+
+def test_delta_keeps_changed_and_new_lots_and_zeroes_gone_ones():
+    base = state([("A", "B1", 5), ("A", "B2", 3), ("B", "B9", 2)])
+    new = state([("A", "B1", 5), ("A", "B2", 1), ("C", "B3", 4)])
+    delta = snapshots._delta(base, new)
+    assert delta.to_dict() == {("A", "B2"): 1, ("B", "B9"): 0, ("C", "B3"): 4}
+    assert delta.dtype == "int64"
+
+
+def test_delta_new_lot_at_zero_is_stored():
+    # Absent from the base and 0 now: still a row, or reading the month would fall back to an older value.
+    delta = snapshots._delta(state([]), state([("A", "B1", 0)]))
+    assert delta.to_dict() == {("A", "B1"): 0}
+
+
+def test_delta_of_identical_states_is_empty():
+    s = state([("A", "B1", 5)])
+    assert snapshots._delta(s, s).empty
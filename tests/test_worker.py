@@ -0,0 +1,43 @@
+import contextlib
+import time
+
+import pytest
+
+import worker
+
+
+def test_heartbeat_beats_during_a_long_stage(monkeypatch):
+    beats = []
+
+    @contextlib.contextmanager
+    def connection(conn=None):
+        yield object()
+
+    monkeypatch.setattr(worker, "connection", connection)
+    monkeypatch.setattr(worker, "run_sql", lambda sql, params=(), conn=None: beats.append(params))
+    with worker._heartbeat(7, every=0.01):
+        time.sleep(0.2)  # one stage, no on_stage callback in between
+    n = len(beats)
+    assert n >= 3 and all(p == (7,) for p in beats)
+    time.sleep(0.05)
+    assert len(beats) == n  # stopped with the job
+
+
+def test_statement_timeout_is_reset_before_the_connection_returns(monkeypatch):
+    sqls = []
+
+    @contextlib.contextmanager
+    def connection(conn=None):
+        yield object()
+
+    def run_job(conn, job):
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(worker, "connection", connection)
+    monkeypatch.setattr(worker, "ensure_job_schema", lambda conn: None)
+    monkeypatch.setattr(worker, "claim_next", lambda conn, worker_id, stale: (1, "rebuild", None))
+    monkeypatch.setattr(worker, "run_job", run_job)
+    monkeypatch.setattr(worker, "run_sql", lambda sql, params=(), conn=None: sqls.append(sql))
+    with pytest.raises(RuntimeError):
+        worker.main()
+    assert sqls == ["set statement_timeout = 0", "reset statement_timeout"]
@@ -0,0 +1,168 @@
+# whatif.py — what-if landed cost / COGS for one month, in memory
+# -----------------------------------------------
+# "What would March COGS be with 20% more freight on batch X, or another duty on
+# category Y?" without touching batch_cost / duty_pool:
+#   - load_model(ym) reads the month's fifo_alloc (per lot) and the inbound items,
+#     batch_cost and duty_pool rows of the batches it consumed, once
+#   - landed.compute_lot_costs run on unit pools gives each lot's share of its batch's
+#     freight/clearance and of its category's duty pool, so
+#       unit_cost = fob_unit + (freight + clearance) × freight_coef + duty × duty_coef
+#     (the same allocation rules as reprice / rebuild_lot_costs)
+#   - simulate(model, overrides) scales the pools and recomputes every consumed lot's
+#     unit cost and the month's COGS with NumPy only — milliseconds per scenario
+#
+# Quantities come from the stored allocations: a cost change does not move FIFO
+# (which lot is consumed never depends on cost). Allocation rows whose lot is no longer
+# in inbound_items, and shortfall rows, keep their stored cost.
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from db import connection, fetch_df, fetch_frame
+import fifo
+import landed
+import rollup
+
+POOLS = ("freight", "clearance", "duty")
+
+ALLOC_SQL = """
+select batch_id, internal_sku, sum(qty)::bigint as qty, sum(qty * coalesce(unit_cost, 0)) as cogs
+from fifo_alloc where ym = %s
+group by batch_id, internal_sku
+"""
+
+
+def load_model(ym: str, conn=None) -> dict:
+    """
+    Everything simulate() needs for month `ym`, as flat per-lot arrays. ValueError when
+    the month has no allocations to start from (rollup.uncovered: e.g. run by the SQL engine).
+    """
+    t = time.perf_counter()
+    with connection(conn) as conn:
+        fifo.ensure_schema(conn)
+        gaps = rollup.uncovered([ym], conn=conn)
+        if not gaps.empty:
+            raise ValueError(f"{ym} has no allocations to simulate from ({gaps['reason'].iloc[0]}); "
+                             "run it with the Python engine first.")
+        alloc = fetch_frame(ALLOC_SQL, (ym,), conn=conn, categories=())
+        stored = fetch_df("select cogs from month_summary where ym = %s", (ym,), conn=conn)
+        batch_ids = sorted(alloc["batch_id"].dropna().unique().tolist())
+        items, batch_cost, duty = landed.load_inputs(conn, batch_ids)
+
+    items = items.assign(category=items["category"].fillna(""))
+    # Unit pools: freight_unit / duty_unit of a lot are then its allocation coefficients.
+    unit_cost = pd.DataFrame({"batch_id": items["batch_id"].unique(), "freight_total": 1.0, "clearance_total": 0.0})
+    unit_duty = items[["batch_id", "category"]].drop_duplicates().assign(duty_total=1.0)
+    coef = landed.compute_lot_costs(items, unit_cost, unit_duty)
+
+    bc = batch_cost.set_index("batch_id")
+    duty = duty.assign(category=duty["category"].fillna(""))
+    lots = pd.DataFrame({
+        "batch_id": items["batch_id"].astype(str),
+        "internal_sku": items["internal_sku"].astype(str),
+        "category": items["category"].astype(str),
+        "fob_unit": pd.to_numeric(items["fob_unit"], errors="coerce").fillna(0.0).astype(float),
+        "freight_coef": coef["freight_unit"].astype(float),
+        "duty_coef": coef["duty_unit"].astype(float),
+        "freight": items["batch_id"].map(pd.to_numeric(bc["freight_total"], errors="coerce")).fillna(0.0),
+        "clearance": items["batch_id"].map(pd.to_numeric(bc["clearance_total"], errors="coerce")).fillna(0.0),
+    }).reset_index(drop=True)
+    lots["duty"] = pd.to_numeric(
+        items[["batch_id", "category"]].merge(duty, on=["batch_id", "category"], how="left")["duty_total"],
+        errors="coerce",
+    ).fillna(0.0).to_numpy()
+
+    # Consumed quantity per lot; the rest of the month's COGS is fixed.
+    alloc = alloc.merge(lots[["batch_id", "internal_sku"]].reset_index(names="lot"),
+                        on=["batch_id", "internal_sku"], how="left")
+    matched = alloc["lot"].notna()
+    lots["qty"] = 0
+    lots.loc[alloc.loc[matched, "lot"].astype(int), "qty"] = alloc.loc[matched, "qty"].astype("int64").to_numpy()
+    lots = lots[lots["qty"] > 0].reset_index(drop=True)
+
+    model = {
+        "ym": ym,
+        "lots": lots,
+        "arrays": {c: lots[c].to_numpy(dtype=float) for c in
+                   ("fob_unit", "freight_coef", "duty_coef", "freight", "clearance", "duty", "qty")},
+        "batch": lots["batch_id"].to_numpy(dtype=object),
+        "category": lots["category"].to_numpy(dtype=object),
+        "fixed_cogs": float(alloc.loc[~matched, "cogs"].sum()),
+        "alloc_cogs": float(alloc["cogs"].sum()),
+        "stored_cogs": float(stored["cogs"].iloc[0]) if not stored.empty and pd.notna(stored["cogs"].iloc[0]) else None,
+        "load_seconds": time.perf_counter() - t,
+    }
+    model["base"] = simulate(model, [])
+    return model
+
+
+def _text(v) -> str:
+    return "" if v is None or pd.isna(v) else str(v).strip()
+
+
+def _factors(model, overrides):
+    """Pool multipliers per lot; overlapping overrides add up. Also how many lots each one matched."""
+    n = len(model["batch"])
+    factors = {p: np.ones(n) for p in POOLS}
+    report = []
+    for o in overrides:
+        pool = _text(o.get("pool")).lower()
+        if pool not in POOLS:
+            raise ValueError(f"Unknown cost pool: {o.get('pool')!r} (one of {', '.join(POOLS)})")
+        mask = np.ones(n, dtype=bool)
+        batch = _text(o.get("batch_id"))
+        category = _text(o.get("category"))
+        if batch:
+            mask &= model["batch"] == batch
+        if category:
+            mask &= model["category"] == category
+        pct = float(_text(o.get("pct")) or 0)
+        factors[pool] += mask * pct / 100.0
+        report.append({"pool": pool, "batch_id": batch or "*", "category": category or "*",
+                       "pct": pct, "lots": int(mask.sum())})
+    return factors, report
+
+
+def simulate(model: dict, overrides) -> dict:
+    """
+    overrides: [{pool: freight|clearance|duty, batch_id, category, pct}] — blank batch_id /
+    category match every lot; pct 20 = +20%. Freight and clearance are per batch, so a
+    category only narrows which lots' costs move.
+    -> cogs, unit_cost (per consumed lot, aligned with model["lots"]), overrides (with matched lots), seconds
+    """
+    t = time.perf_counter()
+    a = model["arrays"]
+    f, report = _factors(model, overrides)
+    unit = (a["fob_unit"]
+            + (a["freight"] * f["freight"] + a["clearance"] * f["clearance"]) * a["freight_coef"]
+            + a["duty"] * f["duty"] * a["duty_coef"]).round(6)
+    cogs = model["fixed_cogs"] + float(a["qty"] @ unit)
+    return {"cogs": cogs, "unit_cost": unit, "overrides": report, "seconds": time.perf_counter() - t}
+
+
+def compare(model: dict, result: dict) -> pd.DataFrame:
+    """COGS of month_summary, of the stored allocations, recomputed from current costs and under the scenario."""
+    stored = model["stored_cogs"]
+    rows = [
+        ("month_summary", stored),
+        ("fifo_alloc (stored unit costs)", model["alloc_cogs"]),
+        ("recomputed (current costs)", model["base"]["cogs"]),
+        ("scenario", result["cogs"]),
+    ]
+    df = pd.DataFrame(rows, columns=["basis", "cogs"])
+    df["vs_month_summary"] = df["cogs"] - stored if stored is not None else np.nan
+    df["vs_month_summary_pct"] = (df["vs_month_summary"] / stored * 100) if stored else np.nan
+    return df
+
+
+def lot_changes(model: dict, result: dict, top: int | None = None) -> pd.DataFrame:
+    """Consumed lots whose unit cost the scenario moves, biggest COGS change first."""
+    lots = model["lots"][["batch_id", "internal_sku", "category", "qty"]].copy()
+    lots["unit_cost"] = model["base"]["unit_cost"]
+    lots["scenario_unit_cost"] = result["unit_cost"]
+    lots["cogs_delta"] = (lots["scenario_unit_cost"] - lots["unit_cost"]) * lots["qty"]
+    lots = lots[lots["cogs_delta"].abs() > 1e-9]
+    lots = lots.reindex(lots["cogs_delta"].abs().sort_values(ascending=False).index)
+    return (lots.head(top) if top else lots).reset_index(drop=True)
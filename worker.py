@@ -1,28 +1,309 @@
 # worker.py
-from db import get_conn
+# -----------------------------------------------
+# Month processing outside the Streamlit request:
+#   - the app enqueues a row in `job` (Run Month / Snapshot Month / Rebuild Costs & Inventory)
+#   - `python worker.py` claims queued jobs with FOR UPDATE SKIP LOCKED and runs their stages,
+#     writing per-stage progress and timing back to the row; the Summary tab polls it
+#   - pipeline jobs run one at a time (claiming is serialized and waits for the running job),
+#     so two months queued back to back are processed in order
+#
+# Env: WORKER_POLL_SECONDS (default 2), WORKER_STALE_MINUTES (default 30: a running job whose
+# heartbeat is older is marked failed so the queue can move on), WORKER_HEARTBEAT_SECONDS
+# (default 30: a thread refreshes the running job's heartbeat, even inside one long stage), LANDED_INCREMENTAL (default 0:
+# costs are rebuilt with rebuild_lot_costs(); 1 reprices only dirty batches, see landed.py).
+#
+# The pipeline modules (fifo, landed, ledger, rollup: pandas / NumPy) are imported when a stage
+# list is built, so reading job status or run history (cli.py last-runs) does not load them.
 
-def run_sql(sql: str, params: tuple = ()):
-    with get_conn() as conn:
+import os
+import time
+import socket
+import threading
+import traceback
+import contextlib
+from psycopg.types.json import Jsonb
+from db import connection, fetch_df
+import perf
+
+JOB_DDL = """
+create table if not exists job (
+  id           bigserial primary key,
+  kind         text        not null,           -- run_month | snapshot | rebuild | run_all
+  ym           text,
+  params       jsonb       not null default '{}',
+  status       text        not null default 'queued',   -- queued | running | done | failed
+  stage        text,
+  progress     real        not null default 0,
+  stages       jsonb       not null default '[]',       -- [{stage, seconds}]
+  error        text,
+  worker       text,
+  created_at   timestamptz not null default now(),
+  started_at   timestamptz,
+  heartbeat_at timestamptz,
+  finished_at  timestamptz
+);
+create index if not exists job_status_idx on job(status, id)
+"""
+
+_job_schema_ready = False
+
+
+def ensure_job_schema(conn):
+    global _job_schema_ready
+    if _job_schema_ready:
+        return
+    with conn.cursor() as cur:
+        for stmt in JOB_DDL.split(";"):
+            if stmt.strip():
+                cur.execute(stmt)
+    _job_schema_ready = True
+
+
+def run_sql(sql: str, params: tuple = (), conn=None):
+    with perf.timed("run_sql", sql) as t, connection(conn) as conn:
         cur = conn.cursor()
         cur.execute(sql, params)
         try:
             rows = cur.fetchall()
         except Exception:
             rows = []
+        t["rows"] = cur.rowcount
         cur.close()
     return rows
 
-def run_all(selected_month: str):
+
+# ---------- Stages ----------
+def _cost_stage(full: bool):
+    import landed
+    # Incremental repricing only once landed.reconcile() agrees with rebuild_lot_costs() (LANDED_INCREMENTAL).
+    if full or not landed.incremental_enabled():
+        return ("rebuild_lot_costs", _rebuild_lot_costs)
+    return ("reprice_dirty", landed.reprice_dirty)
+
+
+def _rebuild_lot_costs(conn):
+    import landed
+    landed.ensure_schema(conn)
+    with conn.transaction():
+        run_sql("select rebuild_lot_costs()", conn=conn)
+        run_sql("delete from cost_dirty", conn=conn)  # every batch is repriced now
+
+
+def _lot_balance_stage(full: bool):
+    import fifo
+    if full:
+        return ("rebuild_lot_balance", lambda conn: run_sql("select rebuild_lot_balance()", conn=conn))
+    return ("recompute_dirty", fifo.recompute_dirty)
+
+
+def _resolve_stage():
+    import fifo
+    # Full rebuild also re-resolves every SKU (covers mapping edits made outside the app).
+    return ("refresh_resolution", fifo.refresh_resolution)
+
+
+def _month_stages(ym: str, end_ym: str | None, engine: str, workers: int | None):
+    """FIFO + summarize for ym, or for ym..end_ym (python: one in-memory pass over the range)."""
+    import fifo
+    if engine == "python":
+        if end_ym:
+            return fifo.range_stages(ym, end_ym, workers)
+        return [("fifo", lambda conn: fifo.run_month(conn, ym, workers))]
+    return [
+        (f"run_month {m}", lambda conn, m=m: _sql_month(conn, "run_month", m))
+        for m in (fifo.month_span(ym, end_ym) if end_ym else [ym])
+    ]
+
+
+def _sql_month(conn, fn: str, ym: str):
+    """
+    `select run_month(ym)` / `summarize_month(ym)`. They do not write fifo_alloc, which the
+    rollup is built from: the month is marked as not covered rather than re-aggregated.
+    """
+    import rollup
+    run_sql(f"select {fn}(%s)", (ym,), conn=conn)
+    rollup.mark_uncovered(conn, [ym])
+
+
+def stages_for(kind: str, ym: str | None = None, engine: str = "sql", full: bool = False,
+               workers: int | None = None, end_ym: str | None = None):
+    """Ordered (name, fn(conn)) stages of a job kind; end_ym turns run_month / run_all into a range."""
+    import fifo
+    import ledger
+    import rollup
+    costs = _cost_stage(full)
+    if kind == "run_month":
+        if engine == "python":
+            return [costs] + _month_stages(ym, end_ym, engine, workers)
+        return _month_stages(ym, end_ym, engine, workers)
+    if kind == "snapshot":
+        # Delta-encoded against the previous month (snapshots.py) instead of snapshot_month()'s full copy.
+        return [("snapshot", lambda conn: fifo.checkpoint_month(conn, ym))]
+    if kind == "rebuild":
+        stages = ([_resolve_stage()] if full else []) + [costs, _lot_balance_stage(full)]
+        return stages + ([("ledger", ledger.rebuild), ("rollup", rollup.rebuild)] if full else [])
+    if kind == "run_all":
+        if engine == "python":
+            return [costs, _lot_balance_stage(full)] + _month_stages(ym, end_ym, engine, workers)
+        return [costs, _lot_balance_stage(full)] + [
+            (f"summarize_month {m}", lambda conn, m=m: _sql_month(conn, "summarize_month", m))
+            for m in (fifo.month_span(ym, end_ym) if end_ym else [ym])
+        ]
+    raise ValueError(f"Unknown job kind: {kind}")
+
+
+def run_stages(stages, conn, on_stage=None):
+    """Run stages in order; on_stage(name, index, total, seconds) after each one."""
+    for i, (name, fn) in enumerate(stages):
+        t = time.perf_counter()
+        with perf.stage(name):
+            fn(conn)
+        if on_stage:
+            on_stage(name, i, len(stages), time.perf_counter() - t)
+
+
+def run_all(selected_month: str, engine: str = "sql", full: bool = False, workers: int | None = None,
+            end_month: str | None = None):
     """
     例：你把所有需要调用的 SQL 函数在这里串起来
+    engine="python" 用进程内 FIFO 引擎（fifo.run_month）代替 summarize_month；
+    full=True 全量 rebuild_lot_balance，否则只重放 fifo_dirty 里的 SKU。
+    workers>1 时 Python 引擎按 SKU 哈希分片在进程池里并行（默认 FIFO_WORKERS）。
+    end_month：从 selected_month 跑到 end_month；Python 引擎只加载一次期初批次，内存里逐月滚动，
+    每 FIFO_RANGE_FLUSH_MONTHS 个月批量写一次。
     """
-    run_sql("select rebuild_lot_costs()")
-    run_sql("select rebuild_lot_balance()")
-    run_sql("select summarize_month(%s)", (selected_month,))
+    with perf.run("run_all", selected_month), connection() as conn:
+        run_stages(stages_for("run_all", selected_month, engine, full, workers, end_month), conn)
     return True
 
+
+# ---------- Job queue ----------
+def enqueue(kind: str, ym: str | None = None, **params) -> int:
+    stages_for(kind, ym, **params)  # reject unknown kinds/params before queueing
+    with connection() as conn:
+        ensure_job_schema(conn)
+        return run_sql(
+            "insert into job(kind, ym, params) values (%s, %s, %s) returning id",
+            (kind, ym, Jsonb(params)), conn=conn,
+        )[0][0]
+
+
+def list_jobs(limit: int = 20):
+    """Latest jobs, read fresh (bypasses the query cache: the worker updates them from another process)."""
+    with connection() as conn:
+        ensure_job_schema(conn)
+        return fetch_df("""
+            select id, kind, ym, status, stage, round(progress * 100) as pct, stages, error,
+                   created_at, started_at, finished_at,
+                   extract(epoch from coalesce(finished_at, now()) - started_at) as seconds
+            from job order by id desc limit %s
+        """, (limit,), conn=conn)
+
+
+def claim_next(conn, worker_id: str, stale_minutes: int = 30):
+    """
+    Claim the oldest queued job, or None. Claims are serialized with an advisory
+    lock and refused while another job is running, so pipeline jobs never overlap.
+    """
+    with conn.transaction():
+        run_sql("select pg_advisory_xact_lock(hashtext('fifo_job_claim'))", conn=conn)
+        run_sql("""
+            update job set status = 'failed', error = 'worker lost (no heartbeat)', finished_at = now()
+            where status = 'running' and heartbeat_at < now() - make_interval(mins => %s)
+        """, (stale_minutes,), conn=conn)
+        if run_sql("select 1 from job where status = 'running' limit 1", conn=conn):
+            return None
+        rows = run_sql("""
+            update job set status = 'running', worker = %s, started_at = now(), heartbeat_at = now()
+            where id = (
+              select id from job where status = 'queued'
+              order by id
+              for update skip locked
+              limit 1
+            )
+            returning id, kind, ym, params
+        """, (worker_id,), conn=conn)
+    return rows[0] if rows else None
+
+
+@contextlib.contextmanager
+def _heartbeat(job_id: int, every: float):
+    """Refresh the job's heartbeat_at every `every` seconds from a thread, on its own pooled connection."""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(every):
+            try:
+                with connection() as c:
+                    run_sql("update job set heartbeat_at = now() where id = %s and status = 'running'",
+                            (job_id,), conn=c)
+            except Exception:
+                pass  # next beat retries; if the database stays away the job goes stale, as it should
+
+    thread = threading.Thread(target=beat, name=f"job-{job_id}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_job(conn, job):
+    job_id, kind, ym, params = job
+    done = []
+
+    def on_stage(name, i, total, seconds):
+        done.append({"stage": name, "seconds": round(seconds, 3)})
+        nxt = stages[i + 1][0] if i + 1 < total else None
+        run_sql("""
+            update job set stage = %s, progress = %s, stages = %s, heartbeat_at = now()
+            where id = %s
+        """, (nxt, (i + 1) / total, Jsonb(done), job_id), conn=conn)
+
+    try:
+        stages = stages_for(kind, ym, **(params or {}))
+        run_sql("update job set stage = %s where id = %s", (stages[0][0], job_id), conn=conn)
+        every = float(os.environ.get("WORKER_HEARTBEAT_SECONDS", 30))
+        with perf.run(kind, ym, run_id=f"job-{job_id}"), _heartbeat(job_id, every):
+            run_stages(stages, conn, on_stage)
+        # A job another worker already declared lost stays failed.
+        run_sql("update job set status = 'done', finished_at = now() where id = %s and status = 'running'",
+                (job_id,), conn=conn)
+    except Exception:
+        run_sql(
+            "update job set status = 'failed', error = %s, finished_at = now() where id = %s",
+            (traceback.format_exc(limit=5), job_id), conn=conn,
+        )
+
+
+def main():
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    poll = float(os.environ.get("WORKER_POLL_SECONDS", 2))
+    stale = int(os.environ.get("WORKER_STALE_MINUTES", 30))
+    print(f"worker {worker_id} polling every {poll}s")
+    while True:
+        with connection() as conn:
+            ensure_job_schema(conn)
+            job = claim_next(conn, worker_id, stale)
+            if job:
+                print(f"job {job[0]}: {job[1]} {job[2] or ''}")
+                # Long months must not hit the pooler's statement timeout. Session-level (the
+                # job runs in autocommit so its progress stays visible): reset before the
+                # connection goes back to the pool.
+                run_sql("set statement_timeout = 0", conn=conn)
+                try:
+                    run_job(conn, job)
+                finally:
+                    run_sql("reset statement_timeout", conn=conn)
+                continue
+        time.sleep(poll)
+
+
 def last_runs(limit: int = 20):
-    return run_sql(
-        "select happened_at, note from movement order by happened_at desc limit %s",
-        (limit,)
-    )
+    """Latest instrumented runs from run_log (see perf.py); stage rows via perf.stage_history()."""
+    return perf.runs(limit)
+
+
+if __name__ == "__main__":
+    main()